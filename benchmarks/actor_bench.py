@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how long the actor takes to find the handler for a command.
+
+The keywords are random phrases of two or three words. The commands are
+random sentences, some with a keyword in them. The compiled matcher is
+compared with trying each KeywordHandler in turn, as the actor used to, and
+checked to pick the same handler.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import actionbase  # noqa
+
+WORDS = ('turn on off the a my this that light lamp table tv music song play stop '
+         'up down volume kitchen bedroom living room fan heater door lock open close '
+         'what is time weather today tomorrow please next previous radio news').split()
+
+
+class NullAction(object):
+
+    def run(self, voice_command):
+        pass
+
+
+def linear_match(handlers, command):
+    for handler in handlers:
+        if handler.can_handle(command):
+            return handler
+    return None
+
+
+def timed(function, commands):
+    """Returns the results, and the mean time per command in µs."""
+    start = time.perf_counter()
+    results = [function(command) for command in commands]
+    return results, 1e6 * (time.perf_counter() - start) / len(commands)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keywords', type=int, default=3000,
+                        help='Number of keywords (default: 3000)')
+    parser.add_argument('--commands', type=int, default=2000,
+                        help='Number of commands (default: 2000)')
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    keywords = set()
+    while len(keywords) < args.keywords:
+        keywords.add(' '.join(rand.choice(WORDS) for _ in range(rand.randint(2, 3))))
+    actor = actionbase.Actor()
+    for keyword in sorted(keywords):
+        actor.add_keyword(keyword, NullAction())
+    commands = [' '.join(rand.choice(WORDS) for _ in range(rand.randint(3, 8))).capitalize()
+                for _ in range(args.commands)]
+
+    start = time.perf_counter()
+    actor.match('')
+    print('%d keywords compiled in %.0f ms' % (
+        len(keywords), 1000 * (time.perf_counter() - start)))
+
+    linear, linear_us = timed(lambda command: linear_match(actor.handlers, command), commands)
+    compiled, compiled_us = timed(actor.match, commands)
+    if linear != compiled:
+        sys.exit('the compiled matcher picked different handlers')
+    print('%d commands, %d handled' % (len(commands), sum(h is not None for h in compiled)))
+    print('each handler in turn: %8.1f µs per command' % linear_us)
+    print('compiled matcher:     %8.1f µs per command' % compiled_us)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure time to first response with and without gRPC channel reuse.
+
+Runs a local Cloud Speech stub server over TLS with a self-signed
+certificate, so each new channel pays for a TCP connection and a TLS
+handshake like it would with speech.googleapis.com, minus the network.
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+from concurrent import futures
+
+import grpc
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import speech  # noqa
+
+AUDIO_CHUNK = b'\0' * 3200
+
+
+def make_certificate():
+    """Returns a self-signed (key, certificate) pair for localhost, as PEM."""
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost')]), False) \
+        .sign(key, hashes.SHA256(), default_backend())
+    key_pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+    return key_pem, cert.public_bytes(serialization.Encoding.PEM)
+
+
+class StubSpeech(cloud_speech.SpeechServicer):
+
+    """Answers as soon as the first audio arrives, then drains the stream."""
+
+    def StreamingRecognize(self, request_iterator, context):
+        next(request_iterator)  # config
+        next(request_iterator)  # first audio
+        yield cloud_speech.StreamingRecognizeResponse(results=[
+            cloud_speech.StreamingRecognitionResult(alternatives=[
+                cloud_speech.SpeechRecognitionAlternative(transcript='hello')])])
+        for _ in request_iterator:
+            pass
+
+
+class _LocalChannelFactory(speech._ChannelFactory):  # pylint: disable=protected-access
+
+    def __init__(self, target, root_cert):
+        super().__init__(target, None)
+        self._target = target
+        self._root_cert = root_cert
+
+    def _create_channel(self):
+        credentials = grpc.ssl_channel_credentials(root_certificates=self._root_cert)
+        return grpc.secure_channel(self._target, credentials, options=self.CHANNEL_OPTIONS)
+
+
+class TimedRequest(speech.CloudSpeechRequest):
+
+    """A CloudSpeechRequest against the stub that records the first response."""
+
+    def __init__(self, target, root_cert):
+        super().__init__(None, target)
+        # Over TLS, unlike the plain local target the base class connects to.
+        self._channel_factory = _LocalChannelFactory(target, root_cert)
+        self.first_response = None
+
+    def _handle_response(self, resp):
+        if self.first_response is None:
+            self.first_response = time.monotonic()
+        super()._handle_response(resp)
+
+
+def run(request, count, reuse):
+    times = []
+    for _ in range(count):
+        if not reuse:
+            request._channel_factory.reset_channel()  # pylint: disable=protected-access
+        request.reset()
+        request.first_response = None
+        for _ in range(10):
+            request.add_data(AUDIO_CHUNK)
+        request.end_audio()
+
+        start = time.monotonic()
+        request.do_request()
+        times.append(1000 * (request.first_response - start))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--requests', type=int, default=50,
+                        help='Requests per mode (default: 50)')
+    args = parser.parse_args()
+
+    key, cert = make_certificate()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    cloud_speech.add_SpeechServicer_to_server(StubSpeech(), server)
+    port = server.add_secure_port('localhost:0', grpc.ssl_server_credentials([(key, cert)]))
+    server.start()
+
+    request = TimedRequest('localhost:%d' % port, cert)
+    request.warm_up()
+    # Warm up the server and the client code paths.
+    run(request, 3, reuse=True)
+
+    for name, reuse in (('new channel', False), ('reused', True)):
+        times = run(request, args.requests, reuse)
+        print('%-12s time to first response: median %6.2f ms  p90 %6.2f ms  max %6.2f ms' % (
+            name, statistics.median(times), sorted(times)[int(0.9 * len(times))],
+            max(times)))
+
+    server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how much earlier commands run with early dispatch.
+
+The fake speech server replays the interim results the server sends for
+"turn off the table", timed by how much audio it has received, then ends the
+utterance after the server's end of speech delay. Audio is sent in real time.
+The command time is when the action would start: on the final transcript
+without early dispatch, or on the stable partial transcript with it.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import actionbase  # noqa
+import fake_speech_server  # noqa
+import speech  # noqa
+
+CHUNK_S = 0.1
+AUDIO_CHUNK = b'\0' * int(CHUNK_S * speech.AUDIO_SAMPLE_RATE_HZ * speech.AUDIO_SAMPLE_SIZE)
+
+COMMAND = 'turn off the table'
+
+# The speech ends at 1.5 s, and the server ends the utterance 0.7 s later.
+SCRIPT = fake_speech_server.Script(
+    COMMAND,
+    interim=[
+        (0.5, 'turn', 0.01),
+        (0.8, 'turn off', 0.9),
+        (1.1, 'turn off the', 0.9),
+        (1.4, 'turn off the table', 0.9),
+        (1.6, 'turn off the table', 0.9),
+    ],
+    endpoint_after_s=2.2,
+    latency_s=0.3,
+)
+
+
+class CommandAction(object):
+
+    def is_complete(self, voice_command):
+        return voice_command == COMMAND
+
+    def run(self, voice_command):
+        pass
+
+
+def feed_audio(request, stop):
+    """Sends audio in real time until the request ends it."""
+    while not stop.is_set():
+        request.add_data(AUDIO_CHUNK)
+        time.sleep(CHUNK_S)
+
+
+def run(request, actor, count, early, confirmations):
+    times = []
+    for _ in range(count):
+        command_time = []
+
+        def on_partial(transcript):
+            handler = actor.match(transcript)
+            if handler is None or not handler.is_complete(transcript):
+                return False
+            command_time.append(time.monotonic())
+            request.end_of_speech()
+            actor.run(handler, transcript)
+            return True
+
+        request.set_partial_transcript_cb(on_partial if early else None,
+                                          confirmations=confirmations)
+        request.reset()
+        stop = threading.Event()
+        request.set_endpointer_cb(stop.set)
+        feeder = threading.Thread(target=feed_audio, args=(request, stop))
+
+        start = time.monotonic()
+        feeder.start()
+        result = request.do_request()
+        if not command_time and actor.handle(result.transcript):
+            command_time.append(time.monotonic())
+        stop.set()
+        feeder.join()
+        times.append(1000 * (command_time[0] - start))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--requests', type=int, default=10,
+                        help='Requests per mode (default: 10)')
+    args = parser.parse_args()
+
+    server = fake_speech_server.FakeSpeechServer([SCRIPT])
+    target = server.start()
+
+    actor = actionbase.Actor()
+    actor.add_keyword('turn off', CommandAction())
+    request = speech.CloudSpeechRequest(None, target)
+    request.warm_up()
+
+    for name, early, confirmations in (('final only', False, 1),
+                                       ('early', True, 1),
+                                       ('early x2', True, 2)):
+        times = run(request, actor, args.requests, early, confirmations)
+        print('%-10s command starts: median %6.0f ms  max %6.0f ms after audio start' % (
+            name, statistics.median(times), max(times)))
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
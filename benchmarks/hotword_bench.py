@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the CPU use, false accepts and latency of the wake word detector.
+
+The noise corpus, WAVs without the wake word such as TV or conversation, is
+streamed through the detector in 100 ms chunks, as from the recorder, to count
+false accepts per hour and measure CPU use. Then each test recording of the
+wake word is streamed after a second of noise, to measure how often it is
+detected, and the latency from the end of the word, as found by the VAD, to the
+detection. The latency can be negative if the word matches before its last
+sounds have faded.
+
+Without recordings, synthetic ones are used: tone sequences stand in for
+the wake word and other speech, in white noise. These only show that the
+detector works and how much CPU it takes, not how accurate it is.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import kws  # noqa
+import vad  # noqa
+from triggers import hotword  # noqa
+
+CHUNK_S = 0.1
+CHUNK_BYTES = int(CHUNK_S * kws.SAMPLE_RATE_HZ) * 2
+BYTES_PER_SECOND = 2 * kws.SAMPLE_RATE_HZ
+
+HOTWORD = [700, 300, 1100, 500]
+OTHER_PHRASES = [[300, 1200, 600], [1000, 400, 1500], [500, 500, 2000], [700, 300, 1500]]
+
+
+def synthetic_phrase(freqs, stretch, rand, noise=100):
+    parts = [np.zeros(int(0.3 * kws.SAMPLE_RATE_HZ))]
+    for freq in freqs:
+        t = np.arange(int(0.25 * stretch * kws.SAMPLE_RATE_HZ)) / kws.SAMPLE_RATE_HZ
+        parts.append(6000 * (np.sin(2 * np.pi * freq * t) + 0.5 * np.sin(4 * np.pi * freq * t)))
+    parts.append(np.zeros(int(0.3 * kws.SAMPLE_RATE_HZ)))
+    samples = np.concatenate(parts)
+    return (samples + rand.randn(len(samples)) * noise).astype(np.int16).tobytes()
+
+
+def synthetic_corpus(minutes):
+    """Returns (recordings, positives, noise) made of tone sequences."""
+    rand = np.random.RandomState(0)
+    recordings = [synthetic_phrase(HOTWORD, stretch, rand) for stretch in (0.9, 1.0, 1.1)]
+    positives = [synthetic_phrase(HOTWORD, rand.uniform(0.9, 1.1), rand) for _ in range(20)]
+
+    noise = []
+    for _ in range(int(minutes * 60 / 5)):
+        # Five seconds: noise and a phrase that isn't the wake word.
+        noise.append((rand.randn(3 * kws.SAMPLE_RATE_HZ) * 200).astype(np.int16).tobytes())
+        noise.append(synthetic_phrase(OTHER_PHRASES[rand.randint(len(OTHER_PHRASES))],
+                                      rand.uniform(0.8, 1.2), rand, noise=200))
+    return recordings, positives, noise
+
+
+def read_dir(directory):
+    return [kws.read_wav(os.path.join(root, name))
+            for root, dirs, files in sorted(os.walk(directory))
+            for name in sorted(files) if name.endswith('.wav')]
+
+
+def stream(detector, data):
+    """Returns the times in the audio at which the wake word was detected,
+    and the CPU seconds and worst chunk time it took."""
+    detections = []
+    cpu = worst = 0.0
+    for i in range(0, len(data) - CHUNK_BYTES + 1, CHUNK_BYTES):
+        start = time.process_time()
+        detected = detector.process(data[i:i + CHUNK_BYTES])
+        elapsed = time.process_time() - start
+        cpu += elapsed
+        worst = max(worst, elapsed)
+        if detected:
+            detections.append((i + CHUNK_BYTES) / BYTES_PER_SECOND)
+            detector.reset()
+    return detections, cpu, worst
+
+
+def speech_end_s(data):
+    """Returns the end of the last speech in a recording, in seconds."""
+    speech = vad.VoiceActivityDetector().classify(data)
+    indices = np.flatnonzero(speech)
+    return (indices[-1] + 1) * vad.VoiceActivityDetector.FRAME_S if len(indices) else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hotword', help='Directory of enrolled wake word recordings')
+    parser.add_argument('--positives', help='Directory of other recordings of the wake word')
+    parser.add_argument('--noise', help='Directory of recordings without the wake word')
+    parser.add_argument('--synthetic-minutes', type=float, default=10,
+                        help='Minutes of synthetic noise, without recordings (default: 10)')
+    parser.add_argument('--threshold', type=float,
+                        default=hotword.HotwordDetector.DEFAULT_THRESHOLD,
+                        help='Match threshold (default: %(default)s)')
+    parser.add_argument('--cpu-budget', type=float,
+                        default=hotword.HotwordDetector.DEFAULT_CPU_BUDGET,
+                        help='Fraction of real time the detector may use (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.hotword:
+        if not (args.positives and args.noise):
+            sys.exit('--hotword needs --positives and --noise')
+        recordings = hotword.load_hotword(args.hotword)
+        positives, noise = read_dir(args.positives), read_dir(args.noise)
+    else:
+        print('synthetic wake word and noise')
+        recordings, positives, noise = synthetic_corpus(args.synthetic_minutes)
+        recordings = [hotword.hotword_features(r) for r in recordings]
+
+    detector = hotword.HotwordDetector(recordings, args.threshold, args.cpu_budget)
+
+    noise_data = b''.join(noise)
+    noise_hours = len(noise_data) / BYTES_PER_SECOND / 3600
+    false_accepts, cpu, worst = stream(detector, noise_data)
+    print('noise: %.2f h, %d false accepts, %.1f per hour' % (
+        noise_hours, len(false_accepts), len(false_accepts) / noise_hours))
+    print('CPU: %.2f%% of real time, worst chunk %.1f ms, using every %d frames' % (
+        100 * cpu / (noise_hours * 3600), 1000 * worst, detector.stride))
+
+    lead_in = noise_data[:BYTES_PER_SECOND]
+    latencies = []
+    for data in positives:
+        detector.reset()
+        detections, _, _ = stream(detector, lead_in + data + lead_in)
+        end = len(lead_in) / BYTES_PER_SECOND + speech_end_s(data)
+        hits = [t for t in detections if t >= end - 1.0]
+        if hits:
+            latencies.append(1000 * (hits[0] - end))
+    print('wake word: %d of %d detected' % (len(latencies), len(positives)))
+    if latencies:
+        latencies.sort()
+        print('latency after the end of the word (ms): median %.0f  p90 %.0f  max %.0f' % (
+            statistics.median(latencies), latencies[int(0.9 * (len(latencies) - 1))],
+            latencies[-1]))
+
+
+if __name__ == '__main__':
+    main()
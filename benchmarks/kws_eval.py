@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the accuracy and latency of local keyword spotting on a WAV corpus.
+
+The corpus is laid out like the enrolled recordings, with one subdirectory of
+WAVs per phrase, and should be other recordings than the enrolled ones.
+Recordings in subdirectories starting with _, such as _other, are not
+commands, and should be left to the server.
+
+Each file goes through the KeywordSpotter in 100 ms chunks, as from the
+recorder, followed by silence until it decides. The decision delay is the
+audio after the end of the file before the decision, and the match time is
+how long the comparison with the templates took.
+"""
+
+import argparse
+import collections
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import kws  # noqa
+
+CHUNK_S = 0.1
+CHUNK_BYTES = int(CHUNK_S * kws.SAMPLE_RATE_HZ) * 2
+MAX_SILENCE_S = 2.0
+
+
+def find_corpus(directory):
+    """Returns (path, phrase) for each file, with phrase None for non-commands."""
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path):
+            continue
+        phrase = None if name.startswith('_') else name.replace('_', ' ')
+        files.extend((os.path.join(path, wav), phrase)
+                     for wav in sorted(os.listdir(path)) if wav.endswith('.wav'))
+    return files
+
+
+def run_file(spotter, path, noise_level):
+    """Returns (phrase, decision delay s, match ms, CPU s, audio s) for a file."""
+    data = kws.read_wav(path)
+    rand = np.random.RandomState(0)
+    silence = (rand.randn(int(MAX_SILENCE_S / CHUNK_S), CHUNK_BYTES // 2) *
+               noise_level).astype(np.int16)
+
+    spotter.reset()
+    cpu = 0.0
+    for i in range(0, len(data), CHUNK_BYTES):
+        start = time.process_time()
+        spotter.add_data(data[i:i + CHUNK_BYTES])
+        cpu += time.process_time() - start
+
+    delay = 0.0
+    for chunk in silence:
+        if spotter.decided:
+            break
+        start = time.process_time()
+        spotter.add_data(chunk.tobytes())
+        cpu += time.process_time() - start
+        delay += CHUNK_S
+    spotter.end_of_utterance()
+
+    return (spotter.phrase, delay, spotter.match_ms, cpu,
+            len(data) / (2 * kws.SAMPLE_RATE_HZ))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    return 'median %.0f  p90 %.0f  max %.0f' % (
+        statistics.median(values), values[int(0.9 * (len(values) - 1))], values[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('templates', help='Directory of enrolled recordings')
+    parser.add_argument('corpus', help='Directory of test recordings')
+    parser.add_argument('--threshold', type=float, default=kws.DEFAULT_THRESHOLD,
+                        help='Match threshold (default: %(default)s)')
+    parser.add_argument('--margin', type=float, default=kws.DEFAULT_MARGIN,
+                        help='Margin over the next phrase (default: %(default)s)')
+    parser.add_argument('--vad-aggressiveness', type=int, default=2, choices=[0, 1, 2, 3])
+    parser.add_argument('--noise-level', type=float, default=30,
+                        help='RMS of the noise that follows each file (default: 30)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the result for every file')
+    args = parser.parse_args()
+
+    templates = kws.load_templates(args.templates, args.vad_aggressiveness)
+    spotter = kws.KeywordSpotter(templates, threshold=args.threshold,
+                                 margin=args.margin, aggressiveness=args.vad_aggressiveness)
+    files = find_corpus(args.corpus)
+    if not files:
+        sys.exit('no WAV files in %s' % args.corpus)
+
+    counts = collections.Counter()
+    confusions = collections.Counter()
+    delays, match_ms = [], []
+    cpu_s = audio_s = 0.0
+    for path, expected in files:
+        heard, delay, match, cpu, audio = run_file(spotter, path, args.noise_level)
+        cpu_s += cpu
+        audio_s += audio
+        if match is not None:
+            delays.append(1000 * delay)
+            match_ms.append(match)
+
+        if expected is None:
+            outcome = 'false_accept' if heard else 'rejected_other'
+        elif heard is None:
+            outcome = 'rejected'
+        elif heard == expected:
+            outcome = 'correct'
+        else:
+            outcome = 'wrong'
+            confusions[(expected, heard)] += 1
+        counts[outcome] += 1
+        if args.verbose:
+            print('%-15s %-50s heard %r' % (outcome, path, heard))
+
+    commands = counts['correct'] + counts['rejected'] + counts['wrong']
+    others = counts['false_accept'] + counts['rejected_other']
+    print('%d templates for %d phrases, threshold %.2f, margin %.2f' % (
+        len(templates), len(templates.get_phrases()), args.threshold, args.margin))
+    if commands:
+        print('commands:      %d files, %.1f%% correct, %.1f%% left to the server,'
+              ' %.1f%% wrong' % (commands, 100.0 * counts['correct'] / commands,
+                                 100.0 * counts['rejected'] / commands,
+                                 100.0 * counts['wrong'] / commands))
+    if others:
+        print('non-commands:  %d files, %.1f%% false accepts' % (
+            others, 100.0 * counts['false_accept'] / others))
+    for (expected, heard), count in confusions.most_common():
+        print('  %r heard as %r: %d' % (expected, heard, count))
+    print('decision delay after the audio (ms): %s' % percentiles(delays))
+    print('match time (ms):                     %s' % percentiles(match_ms))
+    print('CPU: %.1f%% of real time' % (100.0 * cpu_s / audio_s if audio_s else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare chunk assembly in the Recorder against the old bytes-concat loop.
+
+Reports allocations and CPU time per second of audio. Runs on any machine:
+the audio comes from a temporary raw file instead of arecord.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.realpath(os.path.join(__file__, '..', '..')) + '/src/')
+
+import aiy._drivers._recorder  # noqa
+
+SAMPLE_RATE_HZ = 16000
+BYTES_PER_SAMPLE = 2
+
+
+class _NullProcessor(object):
+
+    """Counts chunks without keeping them, like a processor that only inspects."""
+
+    def __init__(self):
+        self.chunks = 0
+
+    def add_data(self, data):
+        self.chunks += 1
+
+
+def legacy_capture(stream, chunk_bytes, processor):
+    """The chunk assembly loop Recorder.run used before the ring buffer."""
+    this_chunk = b''
+    while True:
+        input_data = stream.read(chunk_bytes)
+        if not input_data:
+            break
+
+        this_chunk += input_data
+        if len(this_chunk) >= chunk_bytes:
+            processor.add_data(this_chunk[:chunk_bytes])
+            this_chunk = this_chunk[chunk_bytes:]
+
+
+def make_legacy():
+    return legacy_capture
+
+
+def make_ring():
+    # Preallocation happens here, outside the measured loop.
+    recorder = aiy._drivers._recorder.Recorder()
+
+    def ring_capture(stream, chunk_bytes, processor):
+        recorder.add_processor(processor)
+        recorder._capture(stream)  # pylint: disable=protected-access
+    return ring_capture
+
+
+def measure(name, make_capture, path, seconds, chunk_bytes, read_size):
+    """Run once for CPU time, then again under tracemalloc for allocations."""
+    processor = _NullProcessor()
+    with open(path, 'rb', buffering=0) as raw:
+        capture = make_capture()
+        start = time.process_time()
+        capture(_ShortReads(raw, read_size), chunk_bytes, processor)
+        cpu = time.process_time() - start
+
+    with open(path, 'rb', buffering=0) as raw:
+        capture = make_capture()
+        tracemalloc.start()
+        capture(_ShortReads(raw, read_size), chunk_bytes, _NullProcessor())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print('%-8s read=%-5d chunks=%-6d cpu=%7.3f ms/s-audio  peak alloc=%6d B' % (
+        name, read_size, processor.chunks, 1000 * cpu / seconds, peak))
+
+
+class _ShortReads(object):
+
+    """Mimics a pipe, which returns at most read_size bytes per call."""
+
+    def __init__(self, raw, read_size):
+        self._raw = raw
+        self._read_size = read_size
+
+    def read(self, size):
+        return self._raw.read(min(size, self._read_size))
+
+    def readinto(self, buf):
+        if len(buf) > self._read_size:
+            buf = buf[:self._read_size]
+        return self._raw.readinto(buf)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--seconds', type=int, default=600,
+                        help='Seconds of audio to push through (default: 600)')
+    parser.add_argument('-r', '--read-size', type=int, action='append',
+                        help='Max bytes returned per read, like a pipe. May be '
+                        'repeated (default: 4096 and 1024)')
+    args = parser.parse_args()
+
+    chunk_bytes = int(aiy._drivers._recorder.Recorder.CHUNK_S * SAMPLE_RATE_HZ) * BYTES_PER_SAMPLE
+
+    with tempfile.NamedTemporaryFile(suffix='.raw') as audio:
+        audio.write(os.urandom(args.seconds * SAMPLE_RATE_HZ * BYTES_PER_SAMPLE))
+        audio.flush()
+
+        print('%d s of audio, %d byte chunks' % (args.seconds, chunk_bytes))
+        for read_size in args.read_size or [4096, 1024]:
+            for name, make_capture in (('legacy', make_legacy), ('ring', make_ring)):
+                measure(name, make_capture, audio.name, args.seconds,
+                        chunk_bytes, read_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,6 @@ import datetime
 import logging
 import subprocess
 
-import phue
 from rgbxy import Converter
 
 import actionbase
@@ -219,6 +218,10 @@ class ChangeLightColor(object):
         self.bulb_name = bulb_name
         self.bridge_address = bridge_address
 
+    def get_serial_key(self, voice_command):
+        """Commands for the same bulb run in order."""
+        return self.bulb_name
+
     def run(self):
         bridge = self.find_bridge()
         if bridge:
@@ -228,6 +231,8 @@ class ChangeLightColor(object):
             self.say(_("Ok"))
 
     def find_bridge(self):
+        # Only loaded when a light is first changed, to keep startup fast.
+        import phue
         try:
             bridge = phue.Bridge(self.bridge_address)
             bridge.connect()
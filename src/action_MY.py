@@ -15,13 +15,16 @@
 """Carry out voice commands by recognising keywords."""
 
 import datetime
+import json
 import logging
+import os
+import re
 import subprocess
-import wemo_backend
-import pychromecast
+import threading
 
 import actionbase
 import aiy.audio
+import tracing
 
 # Wave file for OK voice
 OK_VOICE_FILE = "/home/pi/voice-recognizer/resource/okay.wav"
@@ -29,87 +32,254 @@ OK_VOICE_FILE = "/home/pi/voice-recognizer/resource/okay.wav"
 # Chromecast Audio Frendly name
 CASTAUDIO_NAME = "MY Cast"
 
+# Where the Chromecast Audio was last found, so it can be used straight away
+# after a restart.
+CASTAUDIO_CACHE_FILE = os.path.expanduser("~/.cache/voice-recognizer/chromecast.json")
+
 POWER_GROUP_STRING = "living room"
 
+# Actions for the same device run one at a time, in order.
+WEMO_SERIAL_KEY = "wemo"
+CASTAUDIO_SERIAL_KEY = "chromecast"
+
+class CastDevice(object):
+    """The Chromecast Audio, found in the background.
+
+    It starts from the address it was last found at, and discovery runs on
+    its own thread to check it, so startup doesn't wait for mDNS or fail if
+    the device is off. The device is connected on first use, and connected
+    again after the connection is lost.
+    """
+    CONNECT_TRIES = 2
+    CONNECT_TIMEOUT_S = 3.0
+    CONNECT_RETRY_WAIT_S = 1.0
+    DISCOVER_RETRY_S = 60.0
+
+    def __init__(self, name, cache_file=CASTAUDIO_CACHE_FILE):
+        self.name = name
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._found = threading.Event()
+        self._cast = None
+        self._discovering = False
+        self._address = self._load_cache()
+        if self._address:
+            self._found.set()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache["name"] == self.name:
+                return cache["host"], cache["port"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _save_cache(self, host, port):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file = self.cache_file + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump({"name": self.name, "host": host, "port": port}, f)
+            os.replace(temp_file, self.cache_file)
+        except OSError:
+            logging.exception("Couldn't save the Chromecast address")
+
+    def start_discovery(self):
+        """Look for the device on the network, on another thread."""
+        with self._lock:
+            if self._discovering:
+                return
+            self._discovering = True
+        threading.Thread(target=self._discover, daemon=True).start()
+
+    def _discover(self):
+        import pychromecast
+        found = None
+        try:
+            with tracing.span('chromecast', op='discover'):
+                chromecasts = pychromecast.get_chromecasts(
+                    tries=self.CONNECT_TRIES, timeout=self.CONNECT_TIMEOUT_S)
+            for cc in chromecasts:
+                if found is None and cc.device.friendly_name == self.name:
+                    found = cc
+                else:
+                    cc.disconnect(blocking=False)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Chromecast discovery failed")
+
+        with self._lock:
+            self._discovering = False
+            if found is None:
+                logging.warning("Chromecast %r not found, trying again in %.0f s",
+                                self.name, self.DISCOVER_RETRY_S)
+                if not self._found.is_set():
+                    timer = threading.Timer(self.DISCOVER_RETRY_S, self.start_discovery)
+                    timer.daemon = True
+                    timer.start()
+                return
+
+            logging.info("Chromecast %r found at %s:%d", self.name, found.host, found.port)
+            if self._address != (found.host, found.port):
+                self._address = found.host, found.port
+                self._save_cache(found.host, found.port)
+            if self._cast is None:
+                self._cast = found
+            else:
+                found.disconnect(blocking=False)
+            self._found.set()
+
+    def get(self, timeout=CONNECT_TIMEOUT_S):
+        """Returns the connected Chromecast, or None if it can't be reached.
+
+        Waits up to timeout for discovery if the address isn't known yet."""
+        import pychromecast
+        if not self._found.wait(timeout):
+            logging.warning("Chromecast %r hasn't been found yet", self.name)
+            return None
+
+        with self._lock:
+            if self._cast is not None and not self._cast.socket_client.is_connected:
+                self._cast.disconnect(blocking=False)
+                self._cast = None
+            if self._cast is None:
+                host, port = self._address
+                try:
+                    with tracing.span('chromecast', op='connect'):
+                        cast = pychromecast.Chromecast(
+                            host, port, tries=self.CONNECT_TRIES,
+                            timeout=self.CONNECT_TIMEOUT_S,
+                            retry_wait=self.CONNECT_RETRY_WAIT_S)
+                        cast.wait(timeout)
+                    self._cast = cast
+                except pychromecast.PyChromecastError:
+                    logging.exception("Couldn't connect to the Chromecast at %s:%d",
+                                      host, port)
+            cast = self._cast
+
+        if cast is None:
+            # It may have a new address.
+            self.start_discovery()
+        return cast
+
+    def reset(self):
+        """Connect again on the next get(), eg after an error."""
+        with self._lock:
+            if self._cast is not None:
+                self._cast.disconnect(blocking=False)
+                self._cast = None
+        self.start_discovery()
+
+
 # Chromecast Audio
+@tracing.traced('chromecast', op='play')
 def CastPlay_Operation(cast, say):
     logging.info("Cast Play")
-    if cast != []:
+    if cast is not None:
         mc = cast.media_controller
         mc.block_until_active(timeout=1)
         mc.play()
 
+@tracing.traced('chromecast', op='pause')
 def CastPause_Operation(cast, say):
     logging.info("Cast Pause")
-    if cast != []:
+    if cast is not None:
         mc = cast.media_controller
         mc.block_until_active(timeout=1)
         mc.pause()
 
+@tracing.traced('chromecast', op='skip')
 def CastSkip_Operation(cast, say):
     logging.info("Cast Skip")
-    if cast != []:
+    if cast is not None:
         mc = cast.media_controller
         mc.block_until_active(timeout=1)
         mc.skip()
 
+@tracing.traced('chromecast', op='stop')
 def CastStop_Operation(cast, say):
     logging.info("Cast Stop")
-    if cast != []:
+    if cast is not None:
         mc = cast.media_controller
         mc.block_until_active(timeout=1)
         mc.pause()
 
+@tracing.traced('chromecast', op='volume_up')
 def CastVolumeUp_Operation(cast, say):
     logging.info("Cast Volume Up")
-    if cast != []:
+    if cast is not None:
         cast.volume_up()
 
+@tracing.traced('chromecast', op='volume_down')
 def CastVolumeDown_Operation(cast, say):
     logging.info("Cast Volume Down")
-    if cast != []:
+    if cast is not None:
         cast.volume_down()
 
+@tracing.traced('chromecast', op='tell_title')
 def CastTellTitle_Operation(cast, say):
     logging.info("Cast Tell Title")
-    if cast != []:
+    if cast is not None:
         mc = cast.media_controller
         say("This sone is " + mc.status.title + " by " + mc.status.artist)
 
 
-# [0] : voice command
-# [1] : Operation
-CASTAUDIO_OPERATION_LIST = [
-    ["play", CastPlay_Operation],
-    ["pause", CastPause_Operation],
-    ["next", CastSkip_Operation],
-    ["skip", CastSkip_Operation],
-    ["stop", CastStop_Operation],
-    ["volume up", CastVolumeUp_Operation],
-    ["volume down", CastVolumeDown_Operation],
-    ["what is", CastTellTitle_Operation],
-]
-
-# [0] : voice command
-# [1] : Wemo Device
-# [2] : On/Off flag for TV control
-OPERATION_LIST = [
-    ["TV", "TV", 0],
-    ["table", "Table", 0],
-    ["center", "Center", 0],
-    ["window", "Window", 0],
-    ["play", "Trick", 1],
-    ["pause", "Trick", 0],
-    ["stop", "Stop", 0],
-    ["volume up", "Volume", 1],
-    ["volume down", "Volume", 0],
-]
-
-POWER_GROUP_LIST = [
-    ["table", "Table"],
-    ["center", "Center"],
-    ["window", "Window"],
-]
+# Voice command: operation
+CASTAUDIO_OPERATIONS = {
+    "play": CastPlay_Operation,
+    "pause": CastPause_Operation,
+    "next": CastSkip_Operation,
+    "skip": CastSkip_Operation,
+    "stop": CastStop_Operation,
+    "volume up": CastVolumeUp_Operation,
+    "volume down": CastVolumeDown_Operation,
+    "what is": CastTellTitle_Operation,
+}
+
+# Voice command: (Wemo Device, On/Off flag for TV control)
+OPERATIONS = {
+    "TV": ("TV", 0),
+    "table": ("Table", 0),
+    "center": ("Center", 0),
+    "window": ("Window", 0),
+    "play": ("Trick", 1),
+    "pause": ("Trick", 0),
+    "stop": ("Stop", 0),
+    "volume up": ("Volume", 1),
+    "volume down": ("Volume", 0),
+}
+
+# Voice command: Wemo Devices
+POWER_GROUPS = {
+    "living room": ["Table", "Center", "Window"],
+}
+
+# The commands for each action, which is named by its keyword. The phrase
+# hints for the recognizer come from these too.
+COMMANDS = actionbase.Grammar()
+COMMANDS.add_slot('device', OPERATIONS)
+COMMANDS.add_slot('group', POWER_GROUPS)
+COMMANDS.add_slot('cast_operation', CASTAUDIO_OPERATIONS)
+for keyword in ('turn on', 'turn off', 'turn up'):
+    COMMANDS.add_rule(keyword, keyword + ' the {group}')
+    COMMANDS.add_rule(keyword, keyword + ' the {device}')
+COMMANDS.add_rule('on TV', '{device} on TV')
+COMMANDS.add_rule('on TV', 'on TV {device}')
+for keyword in ('my music', 'the music', 'this song'):
+    COMMANDS.add_rule(keyword, '{cast_operation} ' + keyword)
+    COMMANDS.add_rule(keyword, keyword + ' {cast_operation}')
+
+
+def parse_command(voice_command, keyword):
+    """Returns the slots of the command for the action with keyword, or None."""
+    match = COMMANDS.parse(voice_command)
+    return match.slots if match and match.intent == keyword else None
+
+
+def strip_keyword(voice_command, keyword):
+    """Returns what the user said besides the keyword, for error messages."""
+    return re.sub(re.escape(keyword), '', voice_command, flags=re.IGNORECASE).strip()
 
 # Example: Change the volume
 # ==========================
@@ -147,29 +317,35 @@ class PowerControl(object):
         self.keyword = keyword
         self.flag = flag
 
+    def get_phrases(self):
+        return COMMANDS.get_phrases(self.keyword)
+
+    def is_complete(self, voice_command):
+        """True if the command already names a device, for early dispatch."""
+        return parse_command(voice_command, self.keyword) is not None
+
+    def get_serial_key(self, voice_command):
+        """Wemo commands run in order, since a group overlaps its devices."""
+        return WEMO_SERIAL_KEY
+
     def run(self, voice_command):
-        command = voice_command.replace(self.keyword, "").strip()
-        logging.info("Power %s on/off %d", command, self.flag)
+        import wemo_backend
+        slots = parse_command(voice_command, self.keyword)
+        logging.info("Power %s on/off %d", slots, self.flag)
         aiy.audio.play_wave(OK_VOICE_FILE)
-        result = False
-        if command == POWER_GROUP_STRING:
-            for operation in POWER_GROUP_LIST:
-                if self.flag == 1:
-                    wemo_backend.wemo_dict[operation[1]].on()
-                else:
-                    wemo_backend.wemo_dict[operation[1]].off()
-                result = True
-        else:
-            for operation in OPERATION_LIST:
-                if operation[0] == command:
-                    if self.flag == 1:
-                        wemo_backend.wemo_dict[operation[1]].on()
-                    else:
-                        wemo_backend.wemo_dict[operation[1]].off()
-                    result = True
+        if slots is None:
+            self.say(_("I couldn't find " + strip_keyword(voice_command, self.keyword)))
+            return
 
-        if result != True:
-            self.say(_("I couldn't find " + command))
+        if 'group' in slots:
+            devices = slots['group']
+        else:
+            devices = [slots['device'][0]]
+        for device in devices:
+            if self.flag == 1:
+                wemo_backend.wemo_dict[device].on()
+            else:
+                wemo_backend.wemo_dict[device].off()
 
 
 class TVControl(object):
@@ -178,21 +354,31 @@ class TVControl(object):
         self.say = say
         self.keyword = keyword
 
+    def get_phrases(self):
+        return COMMANDS.get_phrases(self.keyword)
+
+    def is_complete(self, voice_command):
+        """True if the command already names an operation, for early dispatch."""
+        return parse_command(voice_command, self.keyword) is not None
+
+    def get_serial_key(self, voice_command):
+        """Wemo commands run in order."""
+        return WEMO_SERIAL_KEY
+
     def run(self, voice_command):
-        command = voice_command.replace(self.keyword, "").strip()
-        logging.info("TV command : %s", command)
+        import wemo_backend
+        slots = parse_command(voice_command, self.keyword)
+        logging.info("TV command : %s", slots)
         aiy.audio.play_wave(OK_VOICE_FILE)
-        result = False
-        for operation in OPERATION_LIST:
-            if operation[0] == command:
-                if operation[2] == 1:
-                    wemo_backend.wemo_dict[operation[1]].on()
-                else:
-                    wemo_backend.wemo_dict[operation[1]].off()
-                result = True
+        if slots is None:
+            self.say(_("I couldn't find " + strip_keyword(voice_command, self.keyword)))
+            return
 
-        if result != True:
-            self.say(_("I couldn't find " + command))
+        device, flag = slots['device']
+        if flag == 1:
+            wemo_backend.wemo_dict[device].on()
+        else:
+            wemo_backend.wemo_dict[device].off()
 
 
 class CastAudioControl(object):
@@ -202,18 +388,31 @@ class CastAudioControl(object):
         self.keyword = keyword
         self.cast = cast
 
+    def get_phrases(self):
+        return COMMANDS.get_phrases(self.keyword)
+
+    def is_complete(self, voice_command):
+        """True if the command already names an operation, for early dispatch."""
+        return parse_command(voice_command, self.keyword) is not None
+
+    def get_serial_key(self, voice_command):
+        """Chromecast commands run in order."""
+        return CASTAUDIO_SERIAL_KEY
+
     def run(self, voice_command):
-        command = voice_command.replace(self.keyword, "").strip()
-        logging.info("Chromecast command : %s", command)
+        import pychromecast
+        slots = parse_command(voice_command, self.keyword)
+        logging.info("Chromecast command : %s", slots)
         aiy.audio.play_wave(OK_VOICE_FILE)
-        result = False
-        for operation in CASTAUDIO_OPERATION_LIST:
-            if operation[0] == command:
-                operation[1](self.cast, self.say)
-                result = True
+        if slots is None:
+            self.say(_(strip_keyword(voice_command, self.keyword) + "is invalid command"))
+            return
 
-        if result != True:
-            self.say(_(command  + "is invalid command"))
+        try:
+            slots['cast_operation'](self.cast.get(), self.say)
+        except pychromecast.PyChromecastError:
+            logging.exception("Chromecast command failed")
+            self.cast.reset()
 
 
 def make_actor(say, actor):
@@ -223,20 +422,13 @@ def make_actor(say, actor):
 #    actor.add_keyword(_('volume down'), VolumeControl(say, -10))
 #    actor.add_keyword(_('max volume'), VolumeControl(say, 100))
 
-    # Get Chromecast audio devive
-    cast = []
-    chromecasts = pychromecast.get_chromecasts()
-    print(chromecasts)
-    if chromecasts != []:
-        for cc in chromecasts:
-            if cc.device.friendly_name == CASTAUDIO_NAME:
-                cast = cc
-                cast.wait()
-                break
-
-    actor.add_keyword(_('turn on'), PowerControl(say, 'turn on the', 1))
-    actor.add_keyword(_('turn off'), PowerControl(say, 'turn off the', 0))
-    actor.add_keyword(_('turn up'), PowerControl(say, 'turn up the', 0))
+    # Find the Chromecast Audio in the background
+    cast = CastDevice(CASTAUDIO_NAME)
+    cast.start_discovery()
+
+    actor.add_keyword(_('turn on'), PowerControl(say, 'turn on', 1))
+    actor.add_keyword(_('turn off'), PowerControl(say, 'turn off', 0))
+    actor.add_keyword(_('turn up'), PowerControl(say, 'turn up', 0))
 
     actor.add_keyword(_('on TV'), TVControl(say, "on TV"))
 
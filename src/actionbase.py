@@ -18,6 +18,17 @@ This code lets you link keywords to actions. The actions are declared in
 action.py.
 """
 
+import collections
+import itertools
+import logging
+import re
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger('action')
+
 
 class Actor(object):
 
@@ -25,33 +36,448 @@ class Actor(object):
 
     def __init__(self):
         self.handlers = []
+        self.executor = None
+        self._matcher = None
+
+    def set_executor(self, executor):
+        """Run actions on executor, an ActionExecutor, instead of on the
+        caller's thread."""
+        self.executor = executor
 
     def add_keyword(self, keyword, action):
         self.handlers.append(KeywordHandler(keyword, action))
+        self._matcher = None
 
     def get_phrases(self):
         """Get a list of all phrases that are expected by the handlers."""
         return [phrase for h in self.handlers for phrase in h.get_phrases()]
 
+    def match(self, command):
+        """Find the handler for command, without running it.
+
+        Returns the first added handler whose keyword is in the command, or
+        None. To check a command and then run it, pass the handler to run()
+        instead of calling can_handle() and handle(), so it is only searched
+        once."""
+
+        start = time.perf_counter()
+        if self._matcher is None:
+            self._matcher = KeywordMatcher([h.keyword for h in self.handlers])
+        index = self._matcher.find(command)
+        handler = None if index is None else self.handlers[index]
+        tracing.get_registry().record(
+            'match', time.perf_counter() - start,
+            keyword=handler.keyword if handler else None)
+        return handler
+
     def can_handle(self, command):
         """Check if command is handled without running the handlers.
 
         Returns True if the command would be handled."""
 
-        for handler in self.handlers:
-            if handler.can_handle(command):
-                return True
-        return False
+        return self.match(command) is not None
 
     def handle(self, command):
         """Pass command to handlers, stopping after one has handled the command.
 
         Returns True if the command was handled."""
 
-        for handler in self.handlers:
-            if handler.handle(command):
-                return True
-        return False
+        handler = self.match(command)
+        if handler is None:
+            return False
+        self.run(handler, command)
+        return True
+
+    def run(self, handler, command):
+        """Run the handler's action for command, from match().
+
+        With an executor, this returns once the action is queued."""
+
+        if self.executor:
+            self.executor.submit(handler.action, command, handler.keyword)
+        else:
+            handler.run(command)
+
+
+class KeywordMatcher(object):
+
+    """Finds keywords in a command, ignoring case, in one pass.
+
+    The keywords are compiled into an Aho-Corasick automaton, so the time to
+    search a command depends on its length, not on the number of keywords.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = [keyword.lower() for keyword in keywords]
+
+        # A trie of the keywords, where state 0 is the root.
+        self._goto = [{}]
+        self._outputs = [[]]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._outputs.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._outputs[state].append(index)
+
+        # Each state falls back to the longest suffix of its text that is also
+        # in the trie, and matches the keywords that suffix matches. States
+        # are visited breadth first, so their suffixes are done first.
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            self._outputs[state] += self._outputs[self._fail[state]]
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                queue.append(next_state)
+
+        self._first = [min(outputs) if outputs else None for outputs in self._outputs]
+
+    def _states(self, command):
+        """Yields the state after each character of the command."""
+        goto, fail = self._goto, self._fail
+        state = 0
+        yield state
+        for char in command.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            yield state
+
+    def find(self, command):
+        """Returns the index of the first keyword in the list that is in
+        command, or None."""
+        first = None
+        for state in self._states(command):
+            index = self._first[state]
+            if index is not None and (first is None or index < first):
+                first = index
+                if first == 0:
+                    break
+        return first
+
+    def find_all(self, command):
+        """Returns the indices of all the keywords in command, in order."""
+        found = set()
+        for state in self._states(command):
+            found.update(self._outputs[state])
+        return sorted(found)
+
+
+class ActionExecutor(object):
+
+    """Runs actions on a pool of worker threads, so a slow one, such as a call
+    to a smart plug, doesn't stop the recognizer listening again.
+
+    Actions can opt in to:
+        timeout: seconds to wait for the action before giving up on it
+        cancel(): called when the action times out or is cancelled
+        get_serial_key(command): a key such as the device the command
+            controls. Actions with the same key run one at a time, in the
+            order they were submitted.
+
+    A thread can't be stopped, so an action that times out keeps its worker
+    until it returns, but the next action with the same key can start.
+
+    Args:
+        max_workers: number of worker threads
+        timeout: seconds to wait for actions without a timeout of their own
+        max_pending: actions that may wait for a worker; more are dropped
+    """
+
+    DEFAULT_TIMEOUT_S = 10.0
+
+    def __init__(self, max_workers=4, timeout=DEFAULT_TIMEOUT_S, max_pending=16):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        # Jobs for keys with a job queued or running, waiting for it to end.
+        self._waiting = {}
+        self._busy_keys = set()
+        self._running = set()
+        self._workers = []
+        self._idle = 0
+        self._shutdown = False
+        self._stats = collections.Counter()
+        self._max_delay = 0.0
+
+    def submit(self, action, command, keyword=None):
+        """Queue action.run(command). The keyword labels its timings.
+        Returns an ActionJob, or None if too many actions are pending."""
+        get_serial_key = getattr(action, 'get_serial_key', None)
+        key = get_serial_key(command) if get_serial_key else None
+        job = ActionJob(action, command, key, getattr(action, 'timeout', self.timeout),
+                        keyword, tracing.current_span())
+
+        with self._cond:
+            pending = len(self._ready) + sum(len(jobs) for jobs in self._waiting.values())
+            if self._shutdown or pending >= self.max_pending:
+                logger.warning('dropped action for %r: %d pending', command, pending)
+                self._stats['dropped'] += 1
+                return None
+
+            self._stats['submitted'] += 1
+            if key is None:
+                self._ready.append(job)
+            elif key in self._busy_keys:
+                self._waiting.setdefault(key, collections.deque()).append(job)
+            else:
+                self._busy_keys.add(key)
+                self._ready.append(job)
+
+            self._notify_worker()
+        return job
+
+    def cancel(self, key=None):
+        """Cancel the pending and running actions, or only those with key.
+
+        Returns the number of actions cancelled."""
+        with self._cond:
+            jobs = [job for job in self._ready if key is None or job.key == key]
+            for job_key in list(self._waiting):
+                if key is None or job_key == key:
+                    jobs.extend(self._waiting.pop(job_key))
+            for job in jobs:
+                if job in self._ready:
+                    # Its key is free, as any others with it are cancelled too.
+                    self._ready.remove(job)
+                    self._busy_keys.discard(job.key)
+                job.finish(ActionJob.CANCELLED)
+            running = [job for job in self._running if key is None or job.key == key]
+            for job in running:
+                self._give_up(job, ActionJob.CANCELLED)
+            self._stats['cancelled'] += len(jobs) + len(running)
+        self._cancel_actions(running)
+        return len(jobs) + len(running)
+
+    def shutdown(self):
+        """Cancel all actions and stop the workers."""
+        self.cancel()
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['running'] = len(self._running)
+            stats['max_queue_delay_ms'] = 1000 * self._max_delay
+        return stats
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._ready and not self._shutdown:
+                    self._cond.wait()
+                self._idle -= 1
+                if self._shutdown:
+                    self._workers.remove(threading.current_thread())
+                    return
+                job = self._ready.popleft()
+                self._running.add(job)
+                delay = time.monotonic() - job.submitted
+                self._max_delay = max(self._max_delay, delay)
+            tracing.get_registry().record('action_queue', delay, keyword=job.keyword)
+
+            timer = threading.Timer(job.timeout, self._on_timeout, [job])
+            timer.daemon = True
+            timer.start()
+            try:
+                with tracing.span('action', job.parent_span, keyword=job.keyword):
+                    job.action.run(job.command)
+                outcome = ActionJob.DONE
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('action for %r failed', job.command)
+                outcome = ActionJob.FAILED
+            timer.cancel()
+
+            with self._cond:
+                if job in self._running:
+                    self._running.remove(job)
+                    self._release(job.key)
+                    job.finish(outcome)
+                    self._stats[outcome] += 1
+
+    def _on_timeout(self, job):
+        with self._cond:
+            if job not in self._running:
+                return
+            logger.warning('action for %r timed out after %.1f s', job.command, job.timeout)
+            self._give_up(job, ActionJob.TIMED_OUT)
+            self._stats[ActionJob.TIMED_OUT] += 1
+        self._cancel_actions([job])
+
+    def _give_up(self, job, outcome):
+        """Stop waiting for a running job. Called with the lock held; the caller
+        cancels its action with _cancel_actions() once the lock is released."""
+        self._running.remove(job)
+        self._release(job.key)
+        job.finish(outcome)
+
+    @staticmethod
+    def _cancel_actions(jobs):
+        """Call cancel() on the actions of jobs that were given up on. Called
+        without the lock, since cancel() may wait for another thread that
+        submits or cancels actions."""
+        for job in jobs:
+            cancel = getattr(job.action, 'cancel', None)
+            if not cancel:
+                continue
+            try:
+                cancel()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('failed to cancel action for %r', job.command)
+
+    def _release(self, key):
+        """Start the next job for key. Called with the lock held."""
+        if key is None:
+            return
+        waiting = self._waiting.get(key)
+        if waiting:
+            self._ready.append(waiting.popleft())
+            if not waiting:
+                del self._waiting[key]
+            self._notify_worker()
+        else:
+            self._busy_keys.discard(key)
+
+    def _notify_worker(self):
+        """Wake a worker for a ready job, starting one if they are all busy.
+        Called with the lock held."""
+        if self._idle < len(self._ready) and len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, daemon=True)
+            self._workers.append(worker)
+            worker.start()
+        self._cond.notify()
+
+
+class ActionJob(object):
+
+    """An action submitted to an ActionExecutor."""
+
+    DONE = 'done'
+    FAILED = 'failed'
+    TIMED_OUT = 'timed_out'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, action, command, key, timeout, keyword=None, parent_span=None):
+        self.action = action
+        self.command = command
+        self.key = key
+        self.timeout = timeout
+        self.keyword = keyword
+        self.parent_span = parent_span
+        self.submitted = time.monotonic()
+        self.outcome = None
+        self._done = threading.Event()
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the action to end. Returns its outcome, or None if it is
+        still pending or running."""
+        self._done.wait(timeout)
+        return self.outcome
+
+
+GrammarMatch = collections.namedtuple('GrammarMatch', ['intent', 'slots'])
+
+
+class Grammar(object):
+
+    """Parses commands into an intent and the values of its slots.
+
+    Rules are patterns of words and slots, such as 'turn on the {device}', and
+    each slot has a table from the phrases that fill it to their values. The
+    rules are compiled into a trie of words, with every phrase of every slot,
+    so a command is parsed in one pass over its words however many phrases
+    there are. Matching ignores case, and the whole command must match.
+
+        grammar = Grammar()
+        grammar.add_slot('device', {'table lamp': 'Table', 'fan': 'Fan'})
+        grammar.add_rule('power_on', 'turn on the {device}')
+        grammar.parse('Turn on the table lamp')
+        # GrammarMatch(intent='power_on', slots={'device': 'Table'})
+    """
+
+    _SLOT = re.compile(r'^{(\w+)}$')
+
+    def __init__(self):
+        self._slots = {}
+        self._rules = []
+        self._trie = None
+
+    def add_slot(self, name, values):
+        """Adds a slot, where values maps each phrase to its value."""
+        self._slots[name] = {_words(phrase): value for phrase, value in values.items()}
+        self._trie = None
+
+    def add_rule(self, intent, pattern):
+        """Adds a rule. If several rules match a command, the first added wins."""
+        self._rules.append((intent, pattern.split()))
+        self._trie = None
+
+    def _expand(self, intent=None):
+        """Yields (intent, words, slots) for every command the rules match."""
+        for rule_intent, pattern in self._rules:
+            if intent is not None and rule_intent != intent:
+                continue
+            parts = []
+            for part in pattern:
+                slot = self._SLOT.match(part)
+                if slot:
+                    parts.append([(words, {slot.group(1): value}) for words, value in
+                                  self._slots[slot.group(1)].items()])
+                else:
+                    parts.append([(_words(part), {})])
+            for choice in itertools.product(*parts):
+                words, slots = (), {}
+                for part_words, part_slots in choice:
+                    words += part_words
+                    slots.update(part_slots)
+                yield rule_intent, words, slots
+
+    def _compile(self):
+        # Each node is a dict from words to nodes, and None to the match.
+        trie = {}
+        for intent, words, slots in self._expand():
+            node = trie
+            for word in words:
+                node = node.setdefault(word, {})
+            node.setdefault(None, GrammarMatch(intent, slots))
+        return trie
+
+    def parse(self, command):
+        """Returns a GrammarMatch for command, or None if no rule matches."""
+        if self._trie is None:
+            self._trie = self._compile()
+        node = self._trie
+        for word in _words(command):
+            node = node.get(word)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def get_phrases(self, intent=None):
+        """Returns every command the rules for intent, or all rules, match,
+        for use as phrase hints."""
+        return [' '.join(words) for _, words, _ in self._expand(intent)]
+
+
+def _words(phrase):
+    return tuple(phrase.lower().split())
 
 
 class KeywordHandler(object):
@@ -63,13 +489,27 @@ class KeywordHandler(object):
         self.action = action
 
     def get_phrases(self):
-        return [self.keyword]
+        """Actions can add phrases, such as those from a Grammar, with a
+        get_phrases() method."""
+        get_phrases = getattr(self.action, 'get_phrases', None)
+        return [self.keyword] + (get_phrases() if get_phrases else [])
 
     def can_handle(self, command):
         return self.keyword in command.lower()
 
+    def run(self, command):
+        """Runs the action, for a command that was already matched."""
+        with tracing.span('action', keyword=self.keyword):
+            self.action.run(command)
+
     def handle(self, command):
         if self.can_handle(command):
-            self.action.run(command)
+            self.run(command)
             return True
         return False
+
+    def is_complete(self, command):
+        """Actions opt in with an is_complete(command) method, since most
+        can't tell if more words are coming."""
+        is_complete = getattr(self.action, 'is_complete', None)
+        return is_complete is not None and is_complete(command)
@@ -123,10 +123,11 @@ class GenericSpeechRequest(object):
         self.dialog_follow_on = False
 
     def add_data(self, data):
-        self._audio_queue.put(data)
+        # The recorder passes views into its ring buffer, so keep a copy.
+        self._audio_queue.put(bytes(data))
 
     def end_audio(self):
-        self.add_data(None)
+        self._audio_queue.put(None)
 
     def _get_speech_context(self):
         """Return a SpeechContext instance to bias recognition towards certain
@@ -15,7 +15,10 @@
 """A driver for audio playback."""
 
 import logging
+import queue
 import subprocess
+import threading
+import time
 import wave
 
 import aiy._drivers._alsa
@@ -39,15 +42,7 @@ class Player(object):
           sample_width: sample width in bytes (eg 2 for 16-bit audio)
         """
 
-        cmd = [
-            'aplay',
-            '-q',
-            '-t', 'raw',
-            '-D', self._output_device,
-            '-c', '1',
-            '-f', aiy._drivers._alsa.sample_width_to_string(sample_width),
-            '-r', str(sample_rate),
-        ]
+        cmd = self._make_command(sample_rate, sample_width)
 
         aplay = subprocess.Popen(cmd, stdin=subprocess.PIPE)
         aplay.stdin.write(audio_bytes)
@@ -57,6 +52,26 @@ class Player(object):
         if retcode:
             logger.error('aplay failed with %d', retcode)
 
+    def open_stream(self, sample_rate, sample_width=2):
+        """Start playing audio that arrives in pieces.
+
+        Returns a stream with a write(audio_bytes) method that queues mono audio
+        for playback without blocking, and a close() method that waits until
+        it has all been played. Playback starts with the first write.
+        """
+        return _PlaybackStream(self._make_command(sample_rate, sample_width))
+
+    def _make_command(self, sample_rate, sample_width):
+        return [
+            'aplay',
+            '-q',
+            '-t', 'raw',
+            '-D', self._output_device,
+            '-c', '1',
+            '-f', aiy._drivers._alsa.sample_width_to_string(sample_width),
+            '-r', str(sample_rate),
+        ]
+
     def play_wav(self, wav_path):
         """Play audio from the given WAV file.
 
@@ -71,3 +86,61 @@ class Player(object):
 
             frames = wav.readframes(wav.getnframes())
             self.play_bytes(frames, wav.getframerate(), wav.getsampwidth())
+
+
+class _PlaybackStream(object):
+
+    """Feeds audio to aplay from a background thread as it arrives."""
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._aplay = None
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+        # When the first audio was handed to aplay.
+        self.first_write_time = None
+        self.bytes_written = 0
+
+    def write(self, audio_bytes):
+        if audio_bytes:
+            self._queue.put(audio_bytes)
+
+    def _write_loop(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+
+            if self._aplay is None:
+                self._aplay = subprocess.Popen(self._cmd, stdin=subprocess.PIPE)
+                self.first_write_time = time.monotonic()
+            try:
+                self._aplay.stdin.write(data)
+            except BrokenPipeError:
+                logger.error('aplay exited early')
+                break
+            self.bytes_written += len(data)
+
+        if self._aplay:
+            try:
+                self._aplay.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def close(self):
+        """Waits until all the audio has been played."""
+        self._queue.put(None)
+        self._writer.join()
+
+        if self._aplay:
+            retcode = self._aplay.wait()
+            if retcode:
+                logger.error('aplay failed with %d', retcode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
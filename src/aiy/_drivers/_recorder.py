@@ -16,14 +16,18 @@
 
 import logging
 import os
-import subprocess
+import queue
 import threading
-import wave
+import time
 
-import aiy._drivers._alsa
+import aiy._drivers._sources
 
 logger = logging.getLogger('recorder')
 
+# What a dispatch worker does when its processor falls behind.
+OVERRUN_DROP = 'drop'    # discard the new chunk and count it
+OVERRUN_BLOCK = 'block'  # wait for room, stalling the capture thread
+
 
 class Recorder(threading.Thread):
 
@@ -32,17 +36,33 @@ class Recorder(threading.Thread):
     Stream audio from microphone in a background thread and run processing
     callbacks. It reads audio in a configurable format from the microphone,
     then converts it to a known format before passing it to the processors.
-
-    This driver accumulates input (audio samples) in a local buffer. Once the
-    buffer contains more than CHUNK_S seconds, it passes the chunk to all
-    processors. An audio processor defines a 'add_data' method that receives
-    the chunk of audio samples to process.
+    The audio can also come from another source, such as a WAV file, for
+    testing without a microphone (see aiy._drivers._sources).
+
+    This driver reads input (audio samples) straight into a preallocated ring
+    buffer of RING_CHUNKS slots. Once a slot holds CHUNK_S seconds, it passes
+    a read-only memoryview of the slot to all processors. An audio processor
+    defines a 'add_data' method that receives the chunk of audio samples to
+    process.
+
+    The memoryview is only valid during the 'add_data' call: the slot is
+    overwritten once the ring wraps around. Processors that keep the data
+    must copy it, or be added with as_bytes=True.
+
+    The ring also keeps a rolling window of recent audio, so a processor can
+    be added with the last few hundred milliseconds it would otherwise have
+    missed (see set_preroll_duration).
+
+    By default, processors run inline on the capture thread, so a slow one
+    delays the next read from arecord. With set_threaded_dispatch, each
+    processor gets its own worker thread and bounded queue instead.
     """
 
     CHUNK_S = 0.1
+    RING_CHUNKS = 16
 
     def __init__(self, input_device='default',
-                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000, source=None):
         """Create a Recorder with the given audio format.
 
         The Recorder will not start until start() is called. start() is called
@@ -52,27 +72,92 @@ class Recorder(threading.Thread):
         - channels: number of channels in audio read from the mic
         - bytes_per_sample: sample width in bytes (eg 2 for 16-bit audio)
         - sample_rate_hz: sample rate in hertz
+        - source: an AudioSource from aiy._drivers._sources to read instead of
+          the microphone. It must produce audio in the given format.
         """
 
         super().__init__()
 
-        self._processors = []
+        # Replaced, never mutated, so the capture thread can iterate it safely.
+        self._processors = ()
 
         self._chunk_bytes = int(self.CHUNK_S * sample_rate_hz) * channels * bytes_per_sample
-
-        self._cmd = [
-            'arecord',
-            '-q',
-            '-t', 'raw',
-            '-D', input_device,
-            '-c', str(channels),
-            '-f', aiy._drivers._alsa.sample_width_to_string(bytes_per_sample),
-            '-r', str(sample_rate_hz),
-        ]
-        self._arecord = None
+        self._ring_chunks = self.RING_CHUNKS
+        self._ring = bytearray(self._chunk_bytes * self._ring_chunks)
+
+        # Guards _committed and the preroll hand-off in add_processor.
+        self._lock = threading.Lock()
+        self._committed = 0
+        self._preroll_chunks = 0
+        # Maps the ids of sinks still waiting for their preroll to an Event set once it
+        # is delivered. Replaced, never mutated, like _processors.
+        self._preroll_pending = {}
+
+        self._dispatch_queue_chunks = 0
+        self._overrun_policy = OVERRUN_DROP
+        self._dispatch_stats = {}
+
+        if source is None:
+            source = aiy._drivers._sources.ArecordSource(
+                input_device, channels=channels, bytes_per_sample=bytes_per_sample,
+                sample_rate_hz=sample_rate_hz)
+        self._source = source
         self._closed = False
 
-    def add_processor(self, processor):
+    def set_preroll_duration(self, seconds):
+        """Keep the last `seconds` of audio for processors added with preroll.
+
+        Must be called before the recorder is started.
+        """
+        if self.is_alive():
+            raise RuntimeError('cannot change preroll while recording')
+
+        self._preroll_chunks = int(round(seconds / self.CHUNK_S))
+        # The slot being filled can't be part of the preroll window.
+        ring_chunks = max(self.RING_CHUNKS, self._preroll_chunks + 1)
+        if ring_chunks != self._ring_chunks:
+            self._ring_chunks = ring_chunks
+            self._ring = bytearray(self._chunk_bytes * ring_chunks)
+
+    def get_preroll(self):
+        """Returns a bytes copy of the most recent preroll window of audio."""
+        with self._lock:
+            return self._get_preroll_locked()
+
+    def _get_preroll_locked(self):
+        first = max(0, self._committed - self._preroll_chunks)
+        ring = memoryview(self._ring)
+        parts = []
+        for ix in range(first, self._committed):
+            start = (ix % self._ring_chunks) * self._chunk_bytes
+            parts.append(ring[start:start + self._chunk_bytes])
+        return b''.join(parts)
+
+    def set_threaded_dispatch(self, queue_chunks=10, overrun_policy=OVERRUN_DROP):
+        """Run processors added from now on in their own worker threads.
+
+        - queue_chunks: chunks a worker can queue before it overruns, or 0 to
+          go back to running processors on the capture thread
+        - overrun_policy: OVERRUN_DROP or OVERRUN_BLOCK
+        """
+        if overrun_policy not in (OVERRUN_DROP, OVERRUN_BLOCK):
+            raise ValueError('unknown overrun policy: %s' % overrun_policy)
+
+        self._dispatch_queue_chunks = queue_chunks
+        self._overrun_policy = overrun_policy
+
+    def get_dispatch_stats(self):
+        """Returns per-processor counters for threaded dispatch.
+
+        The result maps the processor name (see add_processor) to a dict with
+        the number of chunks processed and dropped, the current and maximum
+        queue depth, and the mean and maximum latency from capture to the end
+        of 'add_data'. A processor added under the name of a removed one
+        continues its counters.
+        """
+        return {name: stats.as_dict() for name, stats in self._dispatch_stats.items()}
+
+    def add_processor(self, processor, as_bytes=False, preroll=False, name=None):
         """Adds an audio processor.
 
         An audio processor is an object that has an 'add_data' method with the
@@ -85,52 +170,145 @@ class Recorder(threading.Thread):
             # processes the chunk of data here.
 
         The added processor may be called multiple times with chunks of audio data.
+        By default, the chunks are read-only memoryviews into the ring buffer.
+        If as_bytes is True, the processor gets an immutable bytes copy instead,
+        which it may keep after 'add_data' returns.
+
+        If preroll is True, the processor first gets one bytes chunk with the
+        audio recorded during the preroll window, then the live chunks without
+        gaps or overlap.
+
+        With threaded dispatch, the processor always gets bytes, since chunks
+        wait in its queue while the ring moves on. Its stats are kept under
+        `name`, which defaults to the class name, with a suffix if another
+        added processor already uses it.
         """
-        self._processors.append(processor)
+        sink = processor
+        if self._dispatch_queue_chunks:
+            name = self._unique_name(name or type(processor).__name__)
+            stats = self._dispatch_stats.setdefault(name, _DispatchStats())
+            sink = _DispatchWorker(processor, self._dispatch_queue_chunks,
+                                   self._overrun_policy, stats, name)
+            sink.start()
+
+        data = None
+        with self._lock:
+            if preroll:
+                data = self._get_preroll_locked()
+            if data:
+                # Deliver the preroll outside the lock, but hold back the live
+                # chunks until it's in.
+                delivered = threading.Event()
+                self._preroll_pending = dict(self._preroll_pending)
+                self._preroll_pending[id(sink)] = delivered
+            self._processors += ((processor, sink, as_bytes),)
+
+        if data:
+            try:
+                sink.add_data(data)
+            finally:
+                with self._lock:
+                    self._preroll_pending = {
+                        key: event for key, event in self._preroll_pending.items()
+                        if key != id(sink)}
+                delivered.set()
+
+    def _unique_name(self, name):
+        """Returns name, or name with a suffix if a worker already uses it."""
+        taken = {sink.name for _, sink, _ in self._processors
+                 if isinstance(sink, _DispatchWorker)}
+        unique = name
+        count = 1
+        while unique in taken:
+            count += 1
+            unique = '%s-%d' % (name, count)
+        return unique
 
     def remove_processor(self, processor):
         """Removes an added audio processor."""
 
-        try:
-            self._processors.remove(processor)
-        except ValueError:
-            logger.warn("processor was not found in the list")
+        with self._lock:
+            removed = [e for e in self._processors if e[0] is processor]
+            if not removed:
+                logger.warn("processor was not found in the list")
+            self._processors = tuple(e for e in self._processors if e[0] is not processor)
+
+        for _, sink, _ in removed:
+            if sink is not processor:
+                sink.stop()
 
     def run(self):
-        """Reads data from arecord and passes to processors."""
+        """Reads data from the audio source and passes to processors."""
 
-        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE)
-        logger.info("started recording")
+        stream = self._source.open()
+        logger.info("started recording from %s", self._source)
 
         # Check for race-condition when __exit__ is called at the same time as
-        # the process is started by the background thread
+        # the source is opened by the background thread
         if self._closed:
-            self._arecord.kill()
+            self._source.close()
             return
 
-        this_chunk = b''
+        self._capture(stream)
 
-        while True:
-            input_data = self._arecord.stdout.read(self._chunk_bytes)
-            if not input_data:
-                break
-
-            this_chunk += input_data
-            if len(this_chunk) >= self._chunk_bytes:
-                self._handle_chunk(this_chunk[:self._chunk_bytes])
-                this_chunk = this_chunk[self._chunk_bytes:]
-
-        if not self._closed:
+        if self._closed:
+            return
+        elif self._source.FINITE:
+            logger.info('audio source finished')
+        else:
             logger.error('Microphone recorder died unexpectedly, aborting...')
             # sys.exit doesn't work from background threads, so use os._exit as
             # an emergency measure.
             logging.shutdown()
             os._exit(1)  # pylint: disable=protected-access
 
-    def _handle_chunk(self, chunk):
-        """Send audio chunk to all processors."""
-        for p in self._processors:
-            p.add_data(chunk)
+    def _capture(self, stream):
+        """Fill the ring buffer from stream and pass each chunk to processors.
+
+        Returns when the stream reaches EOF. A trailing partial chunk is dropped.
+        """
+        ring = memoryview(self._ring)
+        slots = [ring[i * self._chunk_bytes:(i + 1) * self._chunk_bytes]
+                 for i in range(self._ring_chunks)]
+        views = [slot.toreadonly() for slot in slots]
+        slot = self._committed % self._ring_chunks
+
+        while self._fill(stream, slots[slot]):
+            with self._lock:
+                self._committed += 1
+                processors = self._processors
+                preroll_pending = self._preroll_pending
+            self._handle_chunk(views[slot], processors, preroll_pending)
+            slot = (slot + 1) % self._ring_chunks
+
+    @staticmethod
+    def _fill(stream, buf):
+        """Read from stream until buf is full. Returns False on EOF."""
+        filled = stream.readinto(buf)
+        while filled and filled < len(buf):
+            count = stream.readinto(buf[filled:])
+            if not count:
+                return False
+            filled += count
+        return bool(filled)
+
+    @staticmethod
+    def _handle_chunk(chunk, processors, preroll_pending=None):
+        """Send audio chunk to all processors.
+
+        Waits for the preroll of processors still being handed it, so that they
+        get it first.
+        """
+        chunk_bytes = None
+        for _, sink, as_bytes in processors:
+            if preroll_pending and id(sink) in preroll_pending:
+                preroll_pending[id(sink)].wait()
+            if as_bytes:
+                if chunk_bytes is None:
+                    chunk_bytes = chunk.tobytes()
+                sink.add_data(chunk_bytes)
+            else:
+                sink.add_data(chunk)
 
     def __enter__(self):
         self.start()
@@ -138,5 +316,125 @@ class Recorder(threading.Thread):
 
     def __exit__(self, *args):
         self._closed = True
-        if self._arecord:
-            self._arecord.kill()
+        self._source.close()
+
+        for processor, sink, _ in self._processors:
+            if sink is not processor:
+                sink.stop()
+
+
+class _DispatchStats(object):
+
+    """Counters for one processor's dispatch queue.
+
+    Updated from the capture thread and the worker threads, so they are
+    guarded by a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks = 0
+        self.dropped = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_dropped(self):
+        with self._lock:
+            self.dropped += 1
+
+    def add_queued(self, depth):
+        with self._lock:
+            self.queue_depth = depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def add_processed(self, latency, depth):
+        with self._lock:
+            self.chunks += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.queue_depth = depth
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'chunks': self.chunks,
+                'dropped': self.dropped,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'mean_latency_ms': 1000 * self.total_latency / max(1, self.chunks),
+                'max_latency_ms': 1000 * self.max_latency,
+            }
+
+
+class _DispatchWorker(threading.Thread):
+
+    """Feeds one processor from a bounded queue on its own thread."""
+
+    # How often a capture thread blocked on a full queue checks for stop().
+    BLOCK_POLL_S = 0.1
+
+    def __init__(self, processor, queue_chunks, overrun_policy, stats, name):
+        super().__init__(daemon=True)
+        self.name = name
+        self._processor = processor
+        self._queue = queue.Queue(maxsize=queue_chunks)
+        self._overrun_policy = overrun_policy
+        self._stats = stats
+        self._stopped = False
+        self._aborted = False
+
+    def add_data(self, data):
+        """Queue a copy of the chunk. Called on the capture thread."""
+        if self._stopped:
+            # The processor was removed while the chunk was being captured.
+            return
+
+        item = (time.monotonic(), bytes(data))
+        if self._overrun_policy == OVERRUN_BLOCK:
+            # Stop waiting if the processor is removed meanwhile.
+            while True:
+                try:
+                    self._queue.put(item, timeout=self.BLOCK_POLL_S)
+                    break
+                except queue.Full:
+                    if self._stopped:
+                        return
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._stats.add_dropped()
+                return
+
+        self._stats.add_queued(self._queue.qsize())
+
+    def stop(self):
+        """Stop after the queued chunks. Chunks added from now on are dropped.
+
+        If the queue is full, the queued chunks are dropped too, which wakes up
+        a capture thread blocked on it, and the worker stops after the current
+        chunk.
+        """
+        self._stopped = True
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                return
+            except queue.Full:
+                self._aborted = True
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while not self._aborted:
+            item = self._queue.get()
+            if item is None or self._aborted:
+                break
+
+            captured, data = item
+            self._processor.add_data(data)
+            self._stats.add_processed(time.monotonic() - captured, self._queue.qsize())
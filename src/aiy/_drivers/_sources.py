@@ -0,0 +1,372 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Audio sources for the recorder: the microphone, files, stdin or a generator.
+
+A source has an open() method that returns a stream with a readinto() method,
+and a close() method. The recorder reads raw PCM samples from the stream until
+EOF. Sources other than arecord can be paced to real time, so the rest of the
+pipeline behaves as it would with a microphone, or run as fast as the readers
+can go for load tests.
+"""
+
+from abc import ABC, abstractmethod
+import array
+import math
+import random
+import subprocess
+import sys
+import time
+import wave
+
+import aiy._drivers._alsa
+
+
+class AudioSource(ABC):
+
+    """Base class for an audio source. Subclasses must implement open().
+
+    FINITE is True if the stream is expected to reach EOF, so the recorder can
+    tell a finished file from a crashed microphone.
+    """
+
+    FINITE = True
+
+    def __init__(self, channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+        self.channels = channels
+        self.bytes_per_sample = bytes_per_sample
+        self.sample_rate_hz = sample_rate_hz
+
+    @property
+    def bytes_per_second(self):
+        return self.channels * self.bytes_per_sample * self.sample_rate_hz
+
+    @abstractmethod
+    def open(self):
+        """Returns a stream of raw PCM samples with a readinto() method."""
+
+    def close(self):
+        """Stops the stream, unblocking any pending readinto()."""
+        pass
+
+
+class ArecordSource(AudioSource):
+
+    """Records from an ALSA device with arecord."""
+
+    FINITE = False
+
+    def __init__(self, input_device='default', **kwargs):
+        super().__init__(**kwargs)
+        self._cmd = [
+            'arecord',
+            '-q',
+            '-t', 'raw',
+            '-D', input_device,
+            '-c', str(self.channels),
+            '-f', aiy._drivers._alsa.sample_width_to_string(self.bytes_per_sample),
+            '-r', str(self.sample_rate_hz),
+        ]
+        self._arecord = None
+
+    def open(self):
+        # Unbuffered, so readinto() goes straight from the pipe to the ring.
+        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, bufsize=0)
+        return self._arecord.stdout
+
+    def close(self):
+        if self._arecord:
+            self._arecord.kill()
+
+    def __str__(self):
+        return ' '.join(self._cmd)
+
+
+class _PacedStream(object):
+
+    """Delays reads from a stream so audio arrives no faster than real time."""
+
+    def __init__(self, stream, bytes_per_second):
+        self._stream = stream
+        self._bytes_per_second = bytes_per_second
+        self._start = None
+        self._bytes = 0
+
+    def readinto(self, buf):
+        if self._start is None:
+            self._start = time.monotonic()
+
+        count = self._stream.readinto(buf)
+        if count:
+            self._bytes += count
+            delay = self._start + self._bytes / self._bytes_per_second - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return count
+
+
+class _PacedSource(AudioSource):
+
+    """Base class for sources that may be paced to real time. Subclasses
+    must implement _open_stream()."""
+
+    def __init__(self, realtime=True, **kwargs):
+        super().__init__(**kwargs)
+        self.realtime = realtime
+        self._stream = None
+
+    @abstractmethod
+    def _open_stream(self):
+        """Returns the unpaced stream."""
+
+    def open(self):
+        self._stream = self._open_stream()
+        if self.realtime:
+            return _PacedStream(self._stream, self.bytes_per_second)
+        return self._stream
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+
+
+class _WaveStream(object):
+
+    """Reads the samples of a WAV file, optionally starting over at the end."""
+
+    def __init__(self, path, loop):
+        self._wav = wave.open(path, 'rb')
+        self._frame_bytes = self._wav.getsampwidth() * self._wav.getnchannels()
+        self._loop = loop
+        self._closed = False
+
+    def readinto(self, buf):
+        if self._closed:
+            return 0
+
+        data = self._wav.readframes(len(buf) // self._frame_bytes)
+        if not data and self._loop and self._wav.getnframes():
+            self._wav.rewind()
+            data = self._wav.readframes(len(buf) // self._frame_bytes)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._closed = True
+        self._wav.close()
+
+
+class _RawStream(object):
+
+    """Reads a raw PCM file, optionally starting over at the end."""
+
+    def __init__(self, path, loop):
+        self._file = open(path, 'rb', buffering=0)
+        self._loop = loop
+        self._closed = False
+
+    def readinto(self, buf):
+        if self._closed:
+            return 0
+
+        try:
+            count = self._file.readinto(buf)
+            if not count and self._loop and self._file.tell():
+                self._file.seek(0)
+                count = self._file.readinto(buf)
+        except ValueError:
+            # Closed by another thread while reading.
+            if self._closed:
+                return 0
+            raise
+        return count
+
+    def close(self):
+        self._closed = True
+        self._file.close()
+
+
+class FileSource(_PacedSource):
+
+    """Plays back a WAV file, or a raw file in the recorder's format."""
+
+    def __init__(self, path, loop=False, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.loop = loop
+
+    @property
+    def FINITE(self):  # pylint: disable=invalid-name
+        return not self.loop
+
+    def _open_stream(self):
+        if not self.path.endswith('.wav'):
+            return _RawStream(self.path, self.loop)
+
+        stream = _WaveStream(self.path, self.loop)
+        wav = stream._wav  # pylint: disable=protected-access
+        params = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+        if params != (self.channels, self.bytes_per_sample, self.sample_rate_hz):
+            stream.close()
+            raise ValueError('%s has channels, sample width, rate %s but %s is needed' % (
+                self.path, params,
+                (self.channels, self.bytes_per_sample, self.sample_rate_hz)))
+        return stream
+
+    def __str__(self):
+        return 'file %s%s' % (self.path, ' (looped)' if self.loop else '')
+
+
+class StdinSource(_PacedSource):
+
+    """Reads raw PCM in the recorder's format from stdin."""
+
+    def __init__(self, realtime=False, **kwargs):
+        super().__init__(realtime=realtime, **kwargs)
+
+    def _open_stream(self):
+        return sys.stdin.buffer.raw
+
+    def close(self):
+        # Don't close the process's stdin.
+        pass
+
+    def __str__(self):
+        return 'stdin'
+
+
+class _PatternStream(object):
+
+    """Repeats a buffer of samples, for up to limit bytes if limit is set."""
+
+    def __init__(self, pattern, limit):
+        self._pattern = memoryview(pattern).cast('B')
+        self._pos = 0
+        self._remaining = limit
+        self._closed = False
+
+    def readinto(self, buf):
+        if self._closed:
+            return 0
+
+        count = min(len(buf), len(self._pattern) - self._pos)
+        if self._remaining is not None:
+            count = min(count, self._remaining)
+            self._remaining -= count
+
+        buf[:count] = self._pattern[self._pos:self._pos + count]
+        self._pos = (self._pos + count) % len(self._pattern)
+        return count
+
+    def close(self):
+        self._closed = True
+
+
+class SyntheticSource(_PacedSource):
+
+    """Generates a test signal.
+
+    Signals:
+      silence: all zero samples
+      tone: a 440 Hz sine wave at a quarter of full scale
+      noise: low-level white noise, like a quiet room
+      speech: one second bursts of a modulated tone, separated by 1.5 seconds
+              of noise, which looks enough like speech to trigger energy-based
+              detectors
+    """
+
+    SIGNALS = ('silence', 'tone', 'noise', 'speech')
+
+    def __init__(self, signal='speech', duration=None, **kwargs):
+        super().__init__(**kwargs)
+        if signal not in self.SIGNALS:
+            raise ValueError('unknown signal %r, expected one of %s' % (
+                signal, ', '.join(self.SIGNALS)))
+        if self.bytes_per_sample != 2:
+            raise ValueError('synthetic audio is only available as 16-bit samples')
+
+        self.signal = signal
+        self.duration = duration
+
+    @property
+    def FINITE(self):  # pylint: disable=invalid-name
+        return self.duration is not None
+
+    def _make_pattern(self):
+        rate = self.sample_rate_hz
+        rand = random.Random(0)
+
+        def noise(count, level=300):
+            return [int(rand.gauss(0, level)) for _ in range(count)]
+
+        def tone(count, freq=440.0, level=8192):
+            return [int(level * math.sin(2 * math.pi * freq * i / rate))
+                    for i in range(count)]
+
+        if self.signal == 'silence':
+            samples = [0] * rate
+        elif self.signal == 'tone':
+            samples = tone(rate)
+        elif self.signal == 'noise':
+            samples = noise(rate)
+        else:
+            burst = tone(rate, freq=180.0)
+            # 4 Hz syllable-like amplitude envelope.
+            burst = [int(s * (0.6 + 0.4 * math.sin(2 * math.pi * 4 * i / rate)))
+                     for i, s in enumerate(burst)]
+            samples = burst + noise(int(1.5 * rate))
+
+        if self.channels > 1:
+            samples = [s for s in samples for _ in range(self.channels)]
+        return array.array('h', samples)
+
+    def _open_stream(self):
+        limit = None
+        if self.duration is not None:
+            frame_bytes = self.channels * self.bytes_per_sample
+            limit = int(self.duration * self.sample_rate_hz) * frame_bytes
+        return _PatternStream(self._make_pattern(), limit)
+
+    def __str__(self):
+        return 'synthetic %s' % self.signal
+
+
+def make_source(spec, realtime=True, **kwargs):
+    """Creates an audio source from a spec string.
+
+    Specs:
+      arecord[:DEVICE]      record from an ALSA device (default: 'default')
+      file:PATH             play back a WAV or raw file
+      loop:PATH             play back a WAV or raw file forever
+      synthetic[:SIGNAL]    generate a signal (see SyntheticSource)
+      stdin                 read raw PCM from stdin
+
+    realtime: pace file, synthetic and stdin sources to real time. If False,
+        they run as fast as they are read.
+    kwargs: audio format, passed to the source.
+    """
+    kind, _, arg = spec.partition(':')
+
+    if kind == 'arecord':
+        return ArecordSource(input_device=arg or 'default', **kwargs)
+    elif kind in ('file', 'loop'):
+        if not arg:
+            raise ValueError('audio source %r needs a path' % spec)
+        return FileSource(arg, loop=kind == 'loop', realtime=realtime, **kwargs)
+    elif kind == 'synthetic':
+        return SyntheticSource(arg or 'speech', realtime=realtime, **kwargs)
+    elif kind == 'stdin':
+        return StdinSource(realtime=realtime, **kwargs)
+
+    raise ValueError('unknown audio source %r' % spec)
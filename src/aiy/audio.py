@@ -19,6 +19,7 @@ import wave
 
 import aiy._drivers._player
 import aiy._drivers._recorder
+import aiy._drivers._sources
 import aiy._drivers._tts
 
 AUDIO_SAMPLE_SIZE = 2  # bytes per sample
@@ -29,6 +30,8 @@ _voicehat_recorder = None
 _voicehat_player = None
 _status_ui = None
 
+_audio_source = None
+
 
 class _WaveDump(object):
     """A processor that saves recorded audio to a wave file."""
@@ -71,6 +74,28 @@ def get_player():
     return _voicehat_player
 
 
+def set_audio_source(spec, realtime=True):
+    """Sets where the recorder reads audio from, instead of the microphones.
+
+    This must be called before the first call to get_recorder(). The spec is
+    one of:
+      arecord[:DEVICE]      record from an ALSA device (the default)
+      file:PATH             play back a WAV or raw file
+      loop:PATH             play back a WAV or raw file forever
+      synthetic[:SIGNAL]    generate silence, tone, noise or speech
+      stdin                 read raw 16-bit 16 kHz mono audio from stdin
+
+    If realtime is False, sources other than arecord run faster than real
+    time, for load tests.
+    """
+    global _audio_source
+    if _voicehat_recorder is not None:
+        raise ValueError('set_audio_source() must be called before get_recorder()')
+    _audio_source = aiy._drivers._sources.make_source(
+        spec, realtime=realtime, bytes_per_sample=AUDIO_SAMPLE_SIZE,
+        sample_rate_hz=AUDIO_SAMPLE_RATE_HZ)
+
+
 def get_recorder():
     """Returns a driver to control the VoiceHat microphones.
 
@@ -79,7 +104,7 @@ def get_recorder():
     """
     global _voicehat_recorder
     if _voicehat_recorder is None:
-        _voicehat_recorder = aiy._drivers._recorder.Recorder()
+        _voicehat_recorder = aiy._drivers._recorder.Recorder(source=_audio_source)
     return _voicehat_recorder
 
 
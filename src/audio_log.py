@@ -0,0 +1,277 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Log request and response audio to WAV files without slowing requests.
+
+Files are written by a background thread, so a slow SD card can't hold up the
+audio going to the server. If the thread falls behind, request audio is dropped
+from the log rather than waiting. Old logs are deleted to keep the directory
+under a size and age limit, and index.jsonl lists the logged requests with
+their time and transcript.
+"""
+
+import collections
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import wave
+
+logger = logging.getLogger('audio_log')
+
+INDEX_FILE = 'index.jsonl'
+
+# Most that is logged by default, if the log directory has room for it.
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+# Without a size limit, the logs use at most this much of the free space, as
+# the default directory is a tmpfs that may only be tens of MB.
+FREE_SPACE_FRACTION = 0.5
+
+_WAV_NAME = re.compile(r'^(request|response)\.(\d+)\.wav$')
+
+
+def default_log_dir():
+    """Returns a directory for the logs, preferring /run/user as it uses tmpfs."""
+    base = '/run/user/%d' % os.getuid()
+    if not os.path.isdir(base):
+        base = tempfile.gettempdir()
+    return os.path.join(base, 'voice-recognizer-audio')
+
+
+class _RequestLog(object):
+
+    """Logs the audio of one request. Returned by AudioLog.start_request()."""
+
+    def __init__(self, audio_log, entry):
+        self._audio_log = audio_log
+        self._entry = entry
+
+    def write(self, data):
+        """Queues request audio to be written, or drops it if the queue is full."""
+        self._audio_log.put(('write', self._entry, bytes(data)), block=False)
+
+    def finish(self, transcript=None, response_audio=None):
+        """Queues the end of the request, with the response if there is one."""
+        self._audio_log.put(('finish', self._entry, transcript, response_audio))
+
+
+class AudioLog(threading.Thread):
+
+    """Writes request and response audio to WAV files on a background thread.
+
+    Args:
+        log_dir: where to write the logs (default: see default_log_dir())
+        max_bytes: delete the oldest logs once the WAV files are bigger than this
+            (default: DEFAULT_MAX_BYTES, or less if the directory is short of
+            space)
+        max_age_s: delete logs older than this
+        queue_size: pending writes before request audio is dropped
+        sample_rate_hz, bytes_per_sample: format of the audio, which is mono
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, log_dir=None, max_bytes=None,
+                 max_age_s=7 * 24 * 3600, queue_size=100,
+                 sample_rate_hz=16000, bytes_per_sample=2):
+        super().__init__(daemon=True)
+
+        self.log_dir = log_dir or default_log_dir()
+        self.max_age_s = max_age_s
+        self._sample_rate_hz = sample_rate_hz
+        self._bytes_per_sample = bytes_per_sample
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.dropped_bytes = 0
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._entries = self._read_index()
+        self._add_unindexed_files()
+        for entry in self._entries:
+            if 'bytes' not in entry:
+                entry['bytes'] = self._size(entry)
+        # The size of the logs, kept up to date as they are added and deleted.
+        self.total_bytes = sum(entry['bytes'] for entry in self._entries)
+        self._next_ix = max((e['ix'] for e in self._entries), default=0) + 1
+
+        if max_bytes is None:
+            # Room for what is already logged, plus part of the free space.
+            stat = os.statvfs(self.log_dir)
+            free = stat.f_bavail * stat.f_frsize
+            max_bytes = min(DEFAULT_MAX_BYTES,
+                            int(FREE_SPACE_FRACTION * (free + self.total_bytes)))
+        self.max_bytes = max_bytes
+
+        self.start()
+
+    def start_request(self):
+        """Returns a log for the audio of a new request."""
+        with self._lock:
+            ix, self._next_ix = self._next_ix, self._next_ix + 1
+        entry = {
+            'ix': ix,
+            'time': time.time(),
+            'request': 'request.%03d.wav' % ix,
+            'dropped_bytes': 0,
+        }
+        self.put(('open', entry))
+        return _RequestLog(self, entry)
+
+    def put(self, item, block=True):
+        try:
+            self._queue.put(item, block=block)
+        except queue.Full:
+            dropped = len(item[2])
+            with self._lock:
+                item[1]['dropped_bytes'] += dropped
+                self.dropped_bytes += dropped
+
+    def close(self):
+        """Writes everything that is queued, then stops the thread."""
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        wavs = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            op, entry = item[0], item[1]
+            try:
+                if op == 'open':
+                    wavs[entry['ix']] = self._open_wav(entry['request'])
+                elif op == 'write':
+                    wavs[entry['ix']].writeframes(item[2])
+                else:
+                    wavs.pop(entry['ix']).close()
+                    self._finish(entry, *item[2:])
+            except (OSError, wave.Error, KeyError):
+                logger.exception('Failed to write audio log for request %d', entry['ix'])
+
+    def _open_wav(self, name):
+        wav = wave.open(os.path.join(self.log_dir, name), 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(self._bytes_per_sample)
+        wav.setframerate(self._sample_rate_hz)
+        return wav
+
+    def _finish(self, entry, transcript, response_audio):
+        if response_audio:
+            entry['response'] = 'response.%03d.wav' % entry['ix']
+            wav = self._open_wav(entry['response'])
+            wav.writeframes(response_audio)
+            wav.close()
+
+        entry['transcript'] = transcript
+        entry['bytes'] = self._size(entry)
+        self.total_bytes += entry['bytes']
+        if entry['dropped_bytes']:
+            logger.warning('Dropped %d bytes from audio log for request %d',
+                           entry['dropped_bytes'], entry['ix'])
+        logger.info('Wrote audio log for request %d to %s', entry['ix'], self.log_dir)
+
+        self._entries.append(entry)
+        if self._rotate():
+            self._write_index()
+        else:
+            with open(self._index_path(), 'a') as index:
+                index.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def _files(self, entry):
+        return [os.path.join(self.log_dir, entry[key])
+                for key in ('request', 'response') if key in entry]
+
+    def _size(self, entry):
+        return sum(os.path.getsize(path) for path in self._files(entry)
+                   if os.path.exists(path))
+
+    def _rotate(self):
+        """Deletes the oldest logs until the limits are met.
+
+        Returns True if any were deleted.
+        """
+        oldest = time.time() - self.max_age_s
+
+        deleted = 0
+        while len(self._entries) > 1 and (
+                self.total_bytes > self.max_bytes or self._entries[0]['time'] < oldest):
+            entry = self._entries.popleft()
+            for path in self._files(entry):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.total_bytes -= entry['bytes']
+            deleted += 1
+
+        if deleted:
+            logger.info('Deleted %d old audio logs', deleted)
+        return deleted > 0
+
+    def _index_path(self):
+        return os.path.join(self.log_dir, INDEX_FILE)
+
+    def _read_index(self):
+        entries = collections.deque()
+        try:
+            with open(self._index_path()) as index:
+                for line in index:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Partly written line, eg after a power cut.
+                        pass
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _add_unindexed_files(self):
+        """Adds the WAV files that aren't in the index, such as those of a
+        request that was being logged when the box crashed, so they are
+        rotated too."""
+        indexed = set()
+        for entry in self._entries:
+            indexed.update(entry[key] for key in ('request', 'response') if key in entry)
+
+        found = {}
+        for name in os.listdir(self.log_dir):
+            match = _WAV_NAME.match(name)
+            if match and name not in indexed:
+                kind, ix = match.group(1), int(match.group(2))
+                entry = found.setdefault(ix, {'ix': ix, 'dropped_bytes': 0, 'transcript': None})
+                entry[kind] = name
+                entry['time'] = min(entry.get('time', float('inf')),
+                                    os.path.getmtime(os.path.join(self.log_dir, name)))
+        if not found:
+            return
+
+        logger.info('Found %d audio logs missing from the index', len(found))
+        entries = sorted(list(self._entries) + list(found.values()), key=lambda e: e['time'])
+        self._entries = collections.deque(entries)
+        self._write_index()
+
+    def _write_index(self):
+        path = self._index_path()
+        with open(path + '.tmp', 'w') as index:
+            for entry in self._entries:
+                index.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.replace(path + '.tmp', path)
@@ -18,7 +18,6 @@
 import json
 import os.path
 
-import google_auth_oauthlib.flow
 import google.auth.transport
 import google.oauth2.credentials
 
@@ -47,6 +46,8 @@ def load_credentials(credentials_path):
 
 
 def credentials_flow_interactive(client_secrets_path):
+    # Only needed once, to authorize the box, and slow to import.
+    import google_auth_oauthlib.flow
     flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
         client_secrets_path,
         scopes=[ASSISTANT_OAUTH_SCOPE])
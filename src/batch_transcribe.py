@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Transcribe many audio files with the Cloud Speech API.
+
+Files are WAVs or raw audio, 16-bit mono at 16 kHz, such as the request logs
+written with --audio-logging. Several requests run at once, each on its own
+worker. Results are appended to a JSONL file as they finish, one line per file,
+and files that already have a result there are skipped, so an interrupted run
+can be resumed by running the same command again.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+import wave
+from concurrent import futures
+
+import aiy._drivers._sources
+import aiy.i18n
+import speech
+
+logger = logging.getLogger('batch')
+
+CHUNK_S = 0.1
+AUDIO_EXTENSIONS = ('.wav', '.raw')
+# The Assistant's spoken responses, in a directory of --audio-logging logs.
+RESPONSE_PREFIX = 'response.'
+
+
+class _PhraseList(object):
+
+    """Phrases from a file, one per line, for add_phrases()."""
+
+    def __init__(self, path):
+        with open(path) as f:
+            self._phrases = [line.strip() for line in f if line.strip()]
+
+    def get_phrases(self):
+        return self._phrases
+
+
+def find_files(inputs, manifest=None):
+    """Returns the audio files in the inputs, which are files or directories,
+    and in the manifest, which lists one file per line. Responses logged by
+    --audio-logging are skipped in directories."""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.endswith(AUDIO_EXTENSIONS) and
+                             not name.startswith(RESPONSE_PREFIX))
+        else:
+            paths.append(path)
+
+    if manifest:
+        base = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    paths.append(os.path.join(base, line))
+
+    return paths
+
+
+def load_checkpoint(output, retry_errors):
+    """Returns the files that already have a result in the output file."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+
+    with open(output) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Partly written line from an interrupted run.
+                continue
+            if not (retry_errors and result.get('error')):
+                done.add(result['path'])
+    return done
+
+
+class Transcriber(object):
+
+    """Runs requests for files on a pool of workers.
+
+    Each worker has its own CloudSpeechRequest, since a request holds the state
+    of the audio it is sending.
+    """
+
+    def __init__(self, workers, credentials_file, api_target=None, phrases=None,
+                 realtime=False):
+        self.realtime = realtime
+        self._requests = queue.Queue()
+        for _ in range(workers):
+            request = speech.CloudSpeechRequest(credentials_file, api_target)
+            # Files are read faster than real time, so keep all their audio.
+            request.set_audio_batching(request.BATCH_SECS, None)
+            if phrases:
+                request.add_phrases(phrases)
+            request.warm_up()
+            self._requests.put(request)
+        self._pool = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, path):
+        """Returns a future for the result of transcribing path."""
+        return self._pool.submit(self._transcribe, path)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+    def _transcribe(self, path):
+        request = self._requests.get()
+        try:
+            return self._run_request(request, path)
+        finally:
+            self._requests.put(request)
+
+    def _run_request(self, request, path):
+        result = {'path': path}
+        source = aiy._drivers._sources.FileSource(path, realtime=self.realtime)
+        try:
+            stream = source.open()
+        except (OSError, EOFError, ValueError, wave.Error) as e:
+            result['error'] = str(e)
+            return result
+
+        request.reset()
+        stopped = threading.Event()
+        request.set_endpointer_cb(stopped.set)
+        audio_end = []
+        feeder = threading.Thread(target=self._feed, args=(
+            request, stream, source.bytes_per_second, stopped, result, audio_end))
+
+        start = time.monotonic()
+        if self.realtime:
+            feeder.start()
+        else:
+            # Queue all the audio first, like a recording that is already over.
+            feeder.run()
+
+        try:
+            transcript = request.do_request().transcript
+            result['transcript'] = transcript or ''
+        except speech.Error as e:
+            result['error'] = str(e.__cause__ or e)
+        finally:
+            end = time.monotonic()
+            stopped.set()
+            if feeder.is_alive():
+                feeder.join()
+            source.close()
+
+        result['request_ms'] = round(1000 * (end - start), 1)
+        # From the end of the audio, or the server's endpointer if it was
+        # earlier, to the transcript.
+        audio_end.append(request.endpoint_times.get('server', end))
+        result['latency_ms'] = round(1000 * (end - max(start, min(audio_end))), 1)
+        return result
+
+    @staticmethod
+    def _feed(request, stream, bytes_per_second, stopped, result, audio_end):
+        """Adds the file's audio to the request until the end or until the
+        request stops listening."""
+        buf = bytearray(int(CHUNK_S * bytes_per_second))
+        total = 0
+        while not stopped.is_set():
+            count = stream.readinto(buf)
+            if not count:
+                break
+            request.add_data(memoryview(buf)[:count])
+            total += count
+
+        request.end_audio()
+        audio_end.append(time.monotonic())
+        result['audio_s'] = round(total / bytes_per_second, 2)
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if 'error' not in r]
+    logger.info('%d files in %.1f s, %d errors', len(results), elapsed,
+                len(results) - len(ok))
+    if ok:
+        latencies = sorted(r['latency_ms'] for r in ok)
+        audio_s = sum(r.get('audio_s', 0) for r in ok)
+        logger.info('latency: median %.0f ms, p90 %.0f ms, max %.0f ms',
+                    statistics.median(latencies),
+                    latencies[int(0.9 * (len(latencies) - 1))], latencies[-1])
+        logger.info('%.1f s of audio, %.1fx real time', audio_s,
+                    audio_s / elapsed if elapsed else 0)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('inputs', nargs='*',
+                        help='Audio files, or directories to search for them')
+    parser.add_argument('-m', '--manifest',
+                        help='File listing audio files, one per line, relative'
+                        ' to the manifest')
+    parser.add_argument('-o', '--output', required=True,
+                        help='JSONL file to append results to')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help='Number of requests to run at once (default: 4)')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Send audio at real time, like the microphone,'
+                        ' instead of all at once')
+    parser.add_argument('--phrases',
+                        help='File of phrases to bias recognition towards, one'
+                        ' per line')
+    parser.add_argument('--retry-errors', action='store_true',
+                        help='Transcribe files again if their result is an error')
+    parser.add_argument('-L', '--language', default='en-US',
+                        help='Language code to use for speech (default: en-US)')
+    parser.add_argument('--cloud-speech-secrets',
+                        default=os.path.expanduser('~/cloud_speech.json'),
+                        help='Path to service account credentials for the '
+                        'Cloud Speech API')
+    parser.add_argument('--speech-api-target',
+                        help='host:port of a local server to use instead of the'
+                        ' Cloud Speech API, without TLS or credentials')
+    args = parser.parse_args()
+
+    paths = find_files(args.inputs, args.manifest)
+    done = load_checkpoint(args.output, args.retry_errors)
+    todo = [path for path in paths if path not in done]
+    logger.info('%d files, %d already done', len(paths), len(paths) - len(todo))
+    if not todo:
+        return
+
+    aiy.i18n.set_language_code(args.language)
+    phrases = _PhraseList(args.phrases) if args.phrases else None
+    transcriber = Transcriber(args.workers, args.cloud_speech_secrets,
+                              args.speech_api_target, phrases, args.realtime)
+
+    results = []
+    start = time.monotonic()
+    with open(args.output, 'a') as output:
+        pending = [transcriber.submit(path) for path in todo]
+        try:
+            for future in futures.as_completed(pending):
+                result = future.result()
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+                results.append(result)
+                if 'error' in result:
+                    logger.warning('%s: %s', result['path'], result['error'])
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            logger.info('interrupted, run again to resume')
+            sys.exit(1)
+        finally:
+            transcriber.shutdown()
+
+    summarize(results, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    main()
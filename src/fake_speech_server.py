@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the Cloud Speech and Assistant APIs.
+
+Serves both APIs without TLS, so the recognizer can be tested and benchmarked
+without Google's servers, eg with main.py --speech-api-target localhost:50051.
+Without a script, every utterance ends after --endpoint-after seconds of audio
+with the --transcript. What the server does for each request is set by a script: when to end the
+utterance, the transcript, interim results, how long to take, how much response
+audio to send and which errors to return. Requests take turns through a list
+of scripts, which can be loaded from a JSON file:
+
+    [
+      {"transcript": "turn off the table", "endpoint_after_s": 2.0,
+       "latency_s": 0.3},
+      {"error": "UNAVAILABLE", "error_after_s": 0.5}
+    ]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent import futures
+
+from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
+from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
+import grpc
+
+logger = logging.getLogger('fake_speech_server')
+
+AUDIO_BYTES_PER_SECOND = 2 * 16000
+
+
+class Script(object):
+
+    """What the server does for one request.
+
+    Args:
+        transcript: final transcript, or '' for no speech
+        interim: list of (audio_s, transcript, stability) interim results for
+            Cloud Speech, each sent once audio_s seconds of audio have arrived
+        endpoint_after_s: seconds of audio after which the server ends the
+            utterance, or None to wait for the client to stop sending
+        latency_s: delay between the end of the utterance and the result
+        response_audio_s: seconds of Assistant response audio
+        audio_chunk_s: seconds of response audio per response
+        audio_interval_s: delay between response audio chunks
+        error: gRPC status code name, such as 'UNAVAILABLE', to fail with
+        error_after_s: seconds of audio after which the error is returned
+        follow_on: ask the client to listen again after the Assistant response
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self, transcript='', interim=(), endpoint_after_s=None,
+                 latency_s=0.0, response_audio_s=0.0, audio_chunk_s=0.1,
+                 audio_interval_s=0.0, error=None, error_after_s=0.0,
+                 follow_on=False):
+        if error is not None and not hasattr(grpc.StatusCode, error):
+            raise ValueError('unknown gRPC status code %r' % error)
+
+        self.transcript = transcript
+        self.interim = [tuple(result) for result in interim]
+        self.endpoint_after_s = endpoint_after_s
+        self.latency_s = latency_s
+        self.response_audio_s = response_audio_s
+        self.audio_chunk_s = audio_chunk_s
+        self.audio_interval_s = audio_interval_s
+        self.error = error
+        self.error_after_s = error_after_s
+        self.follow_on = follow_on
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+def load_scripts(path):
+    """Returns the list of scripts in a JSON file."""
+    with open(path) as f:
+        values = json.load(f)
+    if isinstance(values, dict):
+        values = [values]
+    return [Script.from_dict(v) for v in values]
+
+
+class _Utterance(object):
+
+    """Reads a request stream and decides what happens when, per the script."""
+
+    def __init__(self, server, script):
+        self._server = server
+        self.script = script
+        self.received_s = 0.0
+
+    def receive(self, request_iterator, get_audio):
+        """Yields the interim results that are due as audio arrives.
+
+        Returns when the script ends the utterance, or the client stops
+        sending. Raises _InjectedError if the script fails the request.
+        """
+        script = self.script
+        interim = list(script.interim)
+        for request in request_iterator:
+            audio = get_audio(request)
+            self.received_s += len(audio) / AUDIO_BYTES_PER_SECOND
+            self._server.add_audio(len(audio))
+
+            if script.error and self.received_s >= script.error_after_s:
+                raise _InjectedError(script.error)
+
+            while interim and interim[0][0] <= self.received_s:
+                _, transcript, stability = interim.pop(0)
+                yield transcript, stability
+
+            if script.endpoint_after_s is not None and \
+                    self.received_s >= script.endpoint_after_s:
+                return
+
+        if script.error:
+            raise _InjectedError(script.error)
+
+
+class _InjectedError(Exception):
+    pass
+
+
+class _FakeSpeech(cloud_speech.SpeechServicer):
+
+    def __init__(self, server):
+        self._server = server
+
+    def StreamingRecognize(self, request_iterator, context):
+        utterance = self._server.start_request('speech', context.peer())
+        config = next(request_iterator).streaming_config
+        Response = cloud_speech.StreamingRecognizeResponse
+
+        try:
+            for transcript, stability in utterance.receive(
+                    request_iterator, lambda request: request.audio_content):
+                if config.interim_results:
+                    yield Response(results=[cloud_speech.StreamingRecognitionResult(
+                        alternatives=[cloud_speech.SpeechRecognitionAlternative(
+                            transcript=transcript)],
+                        stability=stability)])
+        except _InjectedError as e:
+            self._server.fail(context, str(e))
+            return
+
+        script = utterance.script
+        yield Response(endpointer_type=Response.END_OF_SPEECH)
+        yield Response(endpointer_type=Response.END_OF_AUDIO)
+        time.sleep(script.latency_s)
+        if script.transcript:
+            yield Response(results=[cloud_speech.StreamingRecognitionResult(
+                alternatives=[cloud_speech.SpeechRecognitionAlternative(
+                    transcript=script.transcript)],
+                is_final=True)])
+        yield Response(endpointer_type=Response.END_OF_UTTERANCE)
+
+
+class _FakeAssistant(embedded_assistant_pb2.EmbeddedAssistantServicer):
+
+    def __init__(self, server):
+        self._server = server
+
+    def Converse(self, request_iterator, context):
+        utterance = self._server.start_request('assistant', context.peer())
+        next(request_iterator)  # config
+
+        try:
+            for _ in utterance.receive(request_iterator,
+                                       lambda request: request.audio_in):
+                pass
+        except _InjectedError as e:
+            self._server.fail(context, str(e))
+            return
+
+        script = utterance.script
+        Response = embedded_assistant_pb2.ConverseResponse
+        Result = embedded_assistant_pb2.ConverseResult
+        yield Response(event_type=Response.END_OF_UTTERANCE)
+        time.sleep(script.latency_s)
+        yield Response(result=Result(spoken_request_text=script.transcript))
+
+        chunk = b'\0' * (2 * int(script.audio_chunk_s * AUDIO_BYTES_PER_SECOND / 2))
+        remaining = int(script.response_audio_s * AUDIO_BYTES_PER_SECOND)
+        while remaining > 0:
+            yield Response(audio_out=embedded_assistant_pb2.AudioOut(
+                audio_data=chunk[:remaining]))
+            remaining -= len(chunk)
+            time.sleep(script.audio_interval_s)
+
+        yield Response(result=Result(
+            conversation_state=b'fake',
+            microphone_mode=Result.DIALOG_FOLLOW_ON if script.follow_on
+            else Result.CLOSE_MICROPHONE))
+
+
+class FakeSpeechServer(object):
+
+    """Serves the Cloud Speech and Assistant APIs, following scripts.
+
+    Scripts are used in turn, one per request, starting over at the end. If
+    assistant_scripts are given, Assistant requests take turns through those
+    instead, so both APIs can be scripted when they run at the same time. The
+    stats count requests, audio, injected errors and the client connections
+    the requests came on.
+    """
+
+    def __init__(self, scripts=None, max_workers=10, assistant_scripts=None):
+        speech_scripts = itertools.cycle(scripts or [Script()])
+        self._scripts = {
+            'speech': speech_scripts,
+            'assistant': itertools.cycle(assistant_scripts) if assistant_scripts
+                         else speech_scripts,
+        }
+        self._lock = threading.Lock()
+        self.stats = {'speech': 0, 'assistant': 0, 'audio_bytes': 0, 'errors': 0,
+                      'connections': 0}
+        self._peers = set()
+
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+        cloud_speech.add_SpeechServicer_to_server(_FakeSpeech(self), self._server)
+        embedded_assistant_pb2.add_EmbeddedAssistantServicer_to_server(
+            _FakeAssistant(self), self._server)
+
+    def start(self, host='localhost', port=0):
+        """Starts serving. Returns the host:port target to connect to."""
+        port = self._server.add_insecure_port('%s:%d' % (host, port))
+        self._server.start()
+        return '%s:%d' % (host, port)
+
+    def stop(self):
+        self._server.stop(None)
+
+    def start_request(self, api, peer):
+        with self._lock:
+            self.stats[api] += 1
+            self._peers.add(peer)
+            self.stats['connections'] = len(self._peers)
+            script = next(self._scripts[api])
+        logger.info('%s request, transcript %r', api, script.transcript)
+        return _Utterance(self, script)
+
+    def add_audio(self, count):
+        with self._lock:
+            self.stats['audio_bytes'] += count
+
+    def fail(self, context, code):
+        with self._lock:
+            self.stats['errors'] += 1
+        logger.info('failing request with %s', code)
+        context.set_code(getattr(grpc.StatusCode, code))
+        context.set_details('injected by fake_speech_server')
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=50051,
+                        help='Port to listen on (default: 50051)')
+    parser.add_argument('--host', default='localhost',
+                        help='Address to listen on (default: localhost)')
+    parser.add_argument('-s', '--script',
+                        help='JSON file with a script or a list of scripts')
+    parser.add_argument('-t', '--transcript', default='hello',
+                        help='Transcript for every request, without --script')
+    parser.add_argument('-e', '--endpoint-after', type=float, default=2.0,
+                        help='Seconds of audio after which the utterance ends,'
+                        ' without --script (default: 2.0)')
+    args = parser.parse_args()
+
+    if args.script:
+        scripts = load_scripts(args.script)
+    else:
+        scripts = [Script(args.transcript, endpoint_after_s=args.endpoint_after,
+                          response_audio_s=1.0)]
+
+    server = FakeSpeechServer(scripts)
+    target = server.start(args.host, args.port)
+    logger.info('serving on %s', target)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        logger.info('stats: %s', server.stats)
+
+
+if __name__ == '__main__':
+    main()
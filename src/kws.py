@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recognize a fixed set of commands locally, without a server round trip.
+
+Each command is enrolled from a few recordings of the phrase, which are kept
+in a directory with one subdirectory per phrase, with underscores for spaces:
+
+    keywords/turn_on_the_table/01.wav
+    keywords/turn_on_the_table/02.wav
+    keywords/my_music_pause/01.wav
+
+The recordings are WAVs, 16-bit mono at 16 kHz, and can be made with:
+
+    src/kws.py record keywords "turn on the table"
+
+Speech is compared with the recordings by dynamic time warping (DTW) of MFCC
+features, so a few recordings by the same speaker are enough. Only a close
+match that is clearly better than any other phrase is used; anything else is
+left to the server.
+"""
+
+import argparse
+import logging
+import os
+import time
+import wave
+
+import numpy as np
+
+import vad
+
+logger = logging.getLogger('kws')
+
+SAMPLE_RATE_HZ = 16000
+FRAME_SAMPLES = 400  # 25 ms
+HOP_SAMPLES = 160  # 10 ms, the same as the VAD frames
+FFT_SIZE = 512
+NUM_FILTERS = 26
+NUM_CEPSTRA = 13
+PRE_EMPHASIS = 0.97
+
+# Frames of audio kept either side of the speech, in 10 ms frames.
+SPEECH_PAD_FRAMES = 5
+
+# A match must be this close, relative to how far apart the recordings of the
+# phrase are from each other...
+DEFAULT_THRESHOLD = 1.5
+# ...and this much closer than the best match of any other phrase.
+DEFAULT_MARGIN = 0.8
+
+# DTW only matches speech between half and twice as long as a recording.
+_MAX_STRETCH = 2.0
+
+
+def _mel(hz):
+    return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+
+def _mel_filterbank(low_hz=20.0, high_hz=SAMPLE_RATE_HZ / 2):
+    """Returns triangular filters on the mel scale, shape (filters, FFT bins)."""
+    mels = np.linspace(_mel(low_hz), _mel(high_hz), NUM_FILTERS + 2)
+    hz = 700.0 * (10 ** (mels / 2595.0) - 1.0)
+    bins = np.floor((FFT_SIZE + 1) * hz / SAMPLE_RATE_HZ).astype(int)
+
+    filters = np.zeros((NUM_FILTERS, FFT_SIZE // 2 + 1), np.float32)
+    for i in range(NUM_FILTERS):
+        left, center, right = bins[i:i + 3]
+        if center > left:
+            filters[i, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            filters[i, center:right] = (right - np.arange(center, right)) / (right - center)
+    return filters
+
+
+def _dct_matrix():
+    """Returns the orthonormal DCT-II, shape (cepstra, filters)."""
+    n = np.arange(NUM_FILTERS)
+    k = np.arange(NUM_CEPSTRA)[:, None]
+    dct = np.cos(np.pi * k * (2 * n + 1) / (2 * NUM_FILTERS)) * np.sqrt(2.0 / NUM_FILTERS)
+    dct[0] /= np.sqrt(2.0)
+    return dct.astype(np.float32)
+
+
+class MfccExtractor(object):
+
+    """Computes MFCC features from a stream of audio.
+
+    Audio is mono 16-bit signed at 16 kHz. There is one frame of features
+    every 10 ms, for the 25 ms of audio that starts there.
+    """
+
+    _WINDOW = np.hamming(FRAME_SAMPLES).astype(np.float32)
+    _FILTERS = _mel_filterbank()
+    _DCT = _dct_matrix()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._leftover = np.zeros(0, np.float32)
+        self._last_sample = 0.0
+
+    def process(self, data):
+        """Returns the features of the frames completed by data, shape
+        (frames, NUM_CEPSTRA)."""
+        samples = np.frombuffer(data, np.int16).astype(np.float32)
+        if not samples.size:
+            return np.zeros((0, NUM_CEPSTRA), np.float32)
+
+        emphasized = np.empty_like(samples)
+        emphasized[0] = samples[0] - PRE_EMPHASIS * self._last_sample
+        emphasized[1:] = samples[1:] - PRE_EMPHASIS * samples[:-1]
+        self._last_sample = samples[-1]
+
+        samples = np.concatenate((self._leftover, emphasized))
+        count = max(0, (len(samples) - FRAME_SAMPLES) // HOP_SAMPLES + 1)
+        self._leftover = samples[count * HOP_SAMPLES:]
+        if not count:
+            return np.zeros((0, NUM_CEPSTRA), np.float32)
+
+        starts = np.arange(count)[:, None] * HOP_SAMPLES
+        frames = samples[starts + np.arange(FRAME_SAMPLES)] * self._WINDOW
+        power = np.abs(np.fft.rfft(frames, FFT_SIZE)) ** 2 / FFT_SIZE
+        energies = np.log(np.maximum(power.dot(self._FILTERS.T), 1e-10))
+        return energies.dot(self._DCT.T).astype(np.float32)
+
+
+class _UtteranceFeatures(object):
+
+    """Collects the features and speech frames of one utterance."""
+
+    def __init__(self, aggressiveness):
+        self._mfcc = MfccExtractor()
+        self._vad = vad.VoiceActivityDetector(aggressiveness)
+        self.reset()
+
+    def reset(self):
+        self._mfcc.reset()
+        self._vad.reset()
+        self._features = []
+        self._speech = []
+        self.speech_frames = 0
+        self.silent_frames = 0
+
+    def add_data(self, data):
+        self._features.append(self._mfcc.process(data))
+        speech = self._vad.classify(data)
+        self._speech.append(speech)
+        if speech.any():
+            self.speech_frames += int(np.count_nonzero(speech))
+            self.silent_frames = len(speech) - 1 - int(np.flatnonzero(speech)[-1])
+        else:
+            self.silent_frames += len(speech)
+
+    def get(self, normalize=True):
+        """Returns the features of the speech, or None if there was no speech.
+
+        If normalize is True, the mean of each coefficient is subtracted.
+        """
+        speech = np.concatenate(self._speech) if self._speech else np.zeros(0, bool)
+        if not speech.any():
+            return None
+        features = np.concatenate(self._features)
+        indices = np.flatnonzero(speech)
+        start = max(0, indices[0] - SPEECH_PAD_FRAMES)
+        end = min(len(features), indices[-1] + 1 + SPEECH_PAD_FRAMES)
+        features = features[start:end]
+        if not len(features):
+            return None
+        if not normalize:
+            return features
+        # Cepstral mean normalization takes out the microphone and room.
+        return features - features.mean(axis=0)
+
+
+def utterance_features(data, aggressiveness=2, normalize=True):
+    """Returns the features of the speech in a recording, or None if there is
+    no speech. See _UtteranceFeatures.get() for normalize."""
+    utterance = _UtteranceFeatures(aggressiveness)
+    utterance.add_data(data)
+    return utterance.get(normalize)
+
+
+def read_wav(path):
+    """Returns the samples of a 16-bit mono 16 kHz WAV file as bytes."""
+    with wave.open(path, 'rb') as wav:
+        params = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+        if params != (1, 2, SAMPLE_RATE_HZ):
+            raise ValueError('%s has channels, sample width, rate %s but %s is needed' % (
+                path, params, (1, 2, SAMPLE_RATE_HZ)))
+        return wav.readframes(wav.getnframes())
+
+
+def dtw_distances(templates, lengths, query):
+    """Returns the DTW distance from each template to the query.
+
+    All templates are aligned at once. Each template frame is matched to one
+    query frame, moving on by 0, 1 or 2 query frames each time, so the query
+    can be up to twice as long as the template. The distance is the mean
+    Euclidean distance between matched frames.
+
+    Args:
+        templates: features padded to the same length, shape (n, frames, dims)
+        lengths: the number of frames in each template
+        query: features, shape (frames, dims)
+    """
+    count, max_frames, _ = templates.shape
+    query_frames = len(query)
+    # |t - q|^2 = |t|^2 + |q|^2 - 2 t.q, for every pair of frames.
+    cost = (np.sum(templates * templates, axis=2)[:, :, None] +
+            np.sum(query * query, axis=1)[None, None, :] -
+            2 * templates.dot(query.T))
+    cost = np.sqrt(np.maximum(cost, 0))
+
+    totals = np.full(count, np.inf)
+    prev = np.full((count, query_frames), np.inf)
+    prev[:, 0] = cost[:, 0, 0]
+    totals[lengths == 1] = prev[lengths == 1, query_frames - 1]
+    for i in range(1, max_frames):
+        best = prev.copy()
+        np.minimum(best[:, 1:], prev[:, :-1], out=best[:, 1:])
+        np.minimum(best[:, 2:], prev[:, :-2], out=best[:, 2:])
+        prev = cost[:, i] + best
+        ended = lengths == i + 1
+        totals[ended] = prev[ended, query_frames - 1]
+
+    distances = totals / lengths
+    ratio = query_frames / lengths
+    distances[(ratio < 1 / _MAX_STRETCH) | (ratio > _MAX_STRETCH)] = np.inf
+    return distances
+
+
+class Templates(object):
+
+    """The enrolled recordings of each phrase.
+
+    Each phrase needs at least two recordings. How far apart they are sets how
+    close a match must be, so phrases that are said less consistently are
+    matched more loosely.
+    """
+
+    def __init__(self):
+        self.phrases = []
+        self._features = []
+        self._scales = {}
+        self._padded = None
+
+    def add(self, phrase, features):
+        if features is None:
+            raise ValueError('no speech in a recording of %r' % phrase)
+        self.phrases.append(phrase)
+        self._features.append(features)
+        self._padded = None
+
+    def __len__(self):
+        return len(self._features)
+
+    def get_phrases(self):
+        """Returns the enrolled phrases, for Actor.can_handle() or as phrase
+        hints."""
+        return sorted(set(self.phrases))
+
+    def prepare(self):
+        """Checks the recordings and works out how close matches must be.
+
+        Called on first use, if not before. Raises ValueError if a phrase
+        doesn't have enough usable recordings.
+        """
+        if self._padded is not None:
+            return
+        lengths = np.array([len(f) for f in self._features])
+        padded = np.zeros((len(self._features), lengths.max(), self._features[0].shape[1]),
+                          np.float32)
+        for i, features in enumerate(self._features):
+            padded[i, :len(features)] = features
+        self._padded, self._lengths = padded, lengths
+
+        phrases = np.array(self.phrases)
+        self._scales = {}
+        for phrase in set(self.phrases):
+            indices = np.flatnonzero(phrases == phrase)
+            if len(indices) < 2:
+                raise ValueError('%r needs at least two recordings' % phrase)
+            # How far each recording is from the nearest other one.
+            nearest = []
+            for i in indices:
+                others = [j for j in indices if j != i]
+                nearest.append(np.min(dtw_distances(
+                    padded[others], lengths[others], self._features[i])))
+            finite = [d for d in nearest if np.isfinite(d)]
+            if not finite:
+                raise ValueError('the recordings of %r are too different in length' % phrase)
+            self._scales[phrase] = float(np.mean(finite))
+
+    def get_scale(self, phrase):
+        """Returns the mean distance between the recordings of a phrase."""
+        self.prepare()
+        return self._scales[phrase]
+
+    def match(self, features):
+        """Returns (phrase, distance, scale, runner_up_distance) for the closest
+        phrase."""
+        self.prepare()
+        distances = dtw_distances(self._padded, self._lengths, features)
+        best = {}
+        for phrase, distance in zip(self.phrases, distances):
+            best[phrase] = min(distance, best.get(phrase, np.inf))
+        ranked = sorted(best, key=best.get)
+        phrase = ranked[0]
+        runner_up = best[ranked[1]] if len(ranked) > 1 else np.inf
+        return phrase, float(best[phrase]), self._scales[phrase], float(runner_up)
+
+
+def load_templates(directory, aggressiveness=2):
+    """Returns the Templates for the recordings in directory.
+
+    Subdirectories starting with _ are ignored, so negative examples can be
+    kept alongside for evaluation.
+    """
+    templates = Templates()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.startswith('_') or not os.path.isdir(path):
+            continue
+        phrase = name.replace('_', ' ')
+        for wav in sorted(os.listdir(path)):
+            if wav.endswith('.wav'):
+                templates.add(phrase, utterance_features(
+                    read_wav(os.path.join(path, wav)), aggressiveness))
+    if not len(templates):
+        raise ValueError('no recordings in %s' % directory)
+    templates.prepare()
+    return templates
+
+
+class KeywordSpotter(object):
+
+    """A recorder processor that recognizes enrolled commands locally.
+
+    Once the speech has ended, by the same rule as vad.LocalEndpointer, or the
+    request ends first, it is compared with the templates. A confident match
+    calls callback(phrase); otherwise the server's transcript is used as
+    usual. In shadow mode, the callback is never called, and the match is only
+    compared with the server's transcript afterwards, to tune the threshold.
+
+    Args:
+        templates: the Templates to match
+        callback: called with the phrase of a confident match, from the
+            recorder thread
+        threshold: how close a match must be, relative to how far apart the
+            phrase's recordings are
+        margin: how much closer than the next phrase a match must be
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    MIN_SPEECH_S = 0.2
+    HANGOVER_S = 0.4
+    # Anything longer isn't one of the commands.
+    MAX_SPEECH_S = 4.0
+
+    def __init__(self, templates, callback=None, threshold=DEFAULT_THRESHOLD,
+                 margin=DEFAULT_MARGIN, aggressiveness=2, shadow=False):
+        self.templates = templates
+        self.callback = callback
+        self.threshold = threshold
+        self.margin = margin
+        self.shadow = shadow
+        self._utterance = _UtteranceFeatures(aggressiveness)
+
+        frame_s = vad.VoiceActivityDetector.FRAME_S
+        self._min_speech_frames = int(round(self.MIN_SPEECH_S / frame_s))
+        self._hangover_frames = int(round(self.HANGOVER_S / frame_s))
+        self._max_speech_frames = int(round(self.MAX_SPEECH_S / frame_s))
+
+        self._stats = {'requests': 0, 'matched': 0, 'rejected': 0, 'no_speech': 0,
+                       'agreed': 0, 'disagreed': 0, 'total_match_ms': 0.0}
+        self.reset()
+
+    def reset(self):
+        """Get ready for a new request."""
+        self._utterance.reset()
+        self.decided = False
+        self.phrase = None
+        self.match_ms = None
+
+    def add_data(self, data):
+        if self.decided:
+            return
+        self._utterance.add_data(data)
+
+        utterance = self._utterance
+        if utterance.speech_frames > self._max_speech_frames:
+            logger.info('too long for a local command')
+            self._decide(None)
+        elif utterance.speech_frames >= self._min_speech_frames and \
+                utterance.silent_frames >= self._hangover_frames:
+            self._decide(utterance.get())
+
+    def end_of_utterance(self):
+        """Decide on the audio so far, if the request ends before the local
+        end of speech."""
+        if not self.decided:
+            self._decide(self._utterance.get())
+
+    def _decide(self, features):
+        self.decided = True
+        if features is None:
+            return
+
+        start = time.monotonic()
+        phrase, distance, scale, runner_up = self.templates.match(features)
+        self.match_ms = 1000 * (time.monotonic() - start)
+
+        confident = distance <= self.threshold * scale and \
+            distance <= self.margin * runner_up
+        logger.info('%s %r: distance %.2f (scale %.2f, next %.2f) in %.0f ms%s',
+                    'matched' if confident else 'rejected', phrase, distance,
+                    scale, runner_up, self.match_ms, ' (shadow)' if self.shadow else '')
+        if confident:
+            self.phrase = phrase
+            if self.callback and not self.shadow:
+                self.callback(phrase)
+
+    def request_finished(self, transcript=None):
+        """Updates the stats after the request is done, comparing the match
+        with the server's transcript if there is one."""
+        stats = self._stats
+        stats['requests'] += 1
+        if self.match_ms is None:
+            stats['no_speech'] += 1
+            return
+        stats['total_match_ms'] += self.match_ms
+        if self.phrase is None:
+            stats['rejected'] += 1
+            return
+
+        stats['matched'] += 1
+        if transcript is not None:
+            if transcript.strip().lower() == self.phrase.lower():
+                stats['agreed'] += 1
+            else:
+                stats['disagreed'] += 1
+                logger.info('keyword spotter heard %r, server %r', self.phrase, transcript)
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        total = stats.pop('total_match_ms')
+        decided = stats['matched'] + stats['rejected']
+        stats['mean_match_ms'] = total / decided if decided else 0
+        return stats
+
+
+def record(directory, phrase, count, seconds):
+    """Records count samples of phrase into its subdirectory of directory."""
+    import aiy.audio
+
+    path = os.path.join(directory, phrase.strip().lower().replace(' ', '_'))
+    os.makedirs(path, exist_ok=True)
+    index = len([name for name in os.listdir(path) if name.endswith('.wav')])
+    recorded = 0
+    while recorded < count:
+        input('Press Enter, then say "%s"...' % phrase)
+        filename = os.path.join(path, '%02d.wav' % (index + 1))
+        aiy.audio.record_to_wave(filename, seconds)
+        if utterance_features(read_wav(filename)) is None:
+            print('No speech heard, try again.')
+            os.remove(filename)
+            continue
+        print('Saved', filename)
+        index += 1
+        recorded += 1
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help='Record samples of a phrase')
+    record_parser.add_argument('directory', help='Directory of recordings')
+    record_parser.add_argument('phrase', help='Phrase to record, as the actor expects it')
+    record_parser.add_argument('-n', '--count', type=int, default=3,
+                               help='Number of samples to record (default: 3)')
+    record_parser.add_argument('-s', '--seconds', type=float, default=2.5,
+                               help='Length of each sample (default: 2.5)')
+    check_parser = subparsers.add_parser(
+        'check', help='Show how consistent the recordings of each phrase are')
+    check_parser.add_argument('directory', help='Directory of recordings')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.directory, args.phrase, args.count, args.seconds)
+    elif args.command == 'check':
+        templates = load_templates(args.directory)
+        for phrase in templates.get_phrases():
+            print('%-30s %d recordings, scale %.2f' % (
+                phrase, templates.phrases.count(phrase), templates.get_scale(phrase)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,13 +23,26 @@ import sys
 import threading
 import time
 
+import startup
+
+# First, so it times the imports below. Timing slows imports down, so it is
+# only done when asked for.
+if '--startup-profile' in sys.argv:
+    startup.PROFILE.start_import_timing()
+
+# pylint: disable=wrong-import-position
 import configargparse
 
 import aiy.audio
 import aiy.i18n
-import auth_helpers
 import action
-import speech
+import actionbase
+import tracing
+
+# This imports google.auth, which is slow, so it is only loaded when first
+# used, on the credentials phase's thread. speech imports grpc, and is used
+# from several threads, so it is imported by the recognizer phase instead.
+auth_helpers = startup.lazy_import('auth_helpers')
 
 # =============================================================================
 #
@@ -120,9 +133,24 @@ def main():
         default_config_files=CONFIG_FILES,
         description="Act on voice commands using Google's speech recognition")
     parser.add_argument('-T', '--trigger', default='gpio',
-                        choices=['clap', 'gpio', 'ok-google'], help='Trigger to use')
+                        choices=['clap', 'gpio', 'hotword', 'ok-google'],
+                        help='Trigger to use')
+    parser.add_argument('--hotword-dir',
+                        default=os.path.join(CONFIG_DIR, 'voice-recognizer', 'hotword'),
+                        help='Directory of recordings of the wake word for'
+                        ' trigger=hotword, made with src/kws.py record')
+    parser.add_argument('--hotword-threshold', type=float, default=2.0,
+                        help='How close the wake word must be to the recordings,'
+                        ' relative to how far apart they are (default: 2.0)')
+    parser.add_argument('--hotword-cpu-budget', type=float, default=0.2,
+                        help='Fraction of a CPU core the wake word detector may'
+                        ' use (default: 0.2)')
     parser.add_argument('--cloud-speech', action='store_true',
                         help='Use the Cloud Speech API instead of the Assistant API')
+    parser.add_argument('--hedged', action='store_true',
+                        help='Send each request to both the Cloud Speech API and'
+                        ' the Assistant API, and use the first transcript that'
+                        ' is a local command, or else the Assistant response')
     parser.add_argument('-L', '--language', default='en-US',
                         help='Language code to use for speech (default: en-US)')
     parser.add_argument('-l', '--led-fifo', default='/tmp/status-led',
@@ -130,7 +158,16 @@ def main():
     parser.add_argument('-p', '--pid-file',
                         help='File containing our process id for monitoring')
     parser.add_argument('--audio-logging', action='store_true',
-                        help='Log all requests and responses to WAV files in /tmp')
+                        help='Log all requests and responses to WAV files')
+    parser.add_argument('--audio-log-dir',
+                        help='Directory for audio logs (default: under /run/user'
+                        ' if it exists, otherwise /tmp)')
+    parser.add_argument('--audio-log-max-mb', type=float,
+                        help='Delete the oldest audio logs above this size'
+                        ' (default: 100, or half the free space of the log'
+                        ' directory if that is less)')
+    parser.add_argument('--audio-log-max-age-days', type=float, default=7,
+                        help='Delete audio logs older than this (default: 7)')
     parser.add_argument('--assistant-always-responds', action='store_true',
                         help='Play Assistant responses for local actions.'
                         ' You should make sure that you have IFTTT applets for'
@@ -143,44 +180,222 @@ def main():
                         default=os.path.expanduser('~/cloud_speech.json'),
                         help='Path to service account credentials for the '
                         'Cloud Speech API')
+    parser.add_argument('--speech-api-target',
+                        help='host:port of a local server, such as'
+                        ' fake_speech_server.py, to use instead of Google\'s'
+                        ' speech APIs, without TLS or credentials')
     parser.add_argument('--trigger-sound', default=None,
                         help='Sound when trigger is activated (WAV format)')
-
-    args = parser.parse_args()
+    parser.add_argument('--local-endpointer', default='off',
+                        choices=['off', 'shadow', 'on'],
+                        help='Detect the end of speech locally to stop sending'
+                        ' audio before the server does. shadow only logs how'
+                        ' much earlier it would have been (default: off)')
+    parser.add_argument('--vad-aggressiveness', type=int, default=2,
+                        choices=[0, 1, 2, 3],
+                        help='How quickly the local endpointer decides speech'
+                        ' has ended, from 0 (patient) to 3 (eager)')
+    parser.add_argument('--trim-leading-silence', action='store_true',
+                        help='Hold back audio until speech starts, so the silence'
+                        ' before a command is not sent to the server')
+    parser.add_argument('--audio-batch', type=float, default=0.5,
+                        help='Seconds of audio that can be merged into one'
+                        ' message when the uplink falls behind (default: %(default)s)')
+    parser.add_argument('--audio-max-queued', type=float, default=10,
+                        help='Seconds of audio that can wait to be sent before'
+                        ' the oldest silence is dropped (default: %(default)s)')
+    parser.add_argument('--speech-retries', type=int, default=2,
+                        help='Times to send the utterance again after a'
+                        ' transient server error (default: 2)')
+    parser.add_argument('--speech-retry-deadline', type=float, default=3.0,
+                        help='Seconds after the first error in which retries'
+                        ' may start (default: 3.0)')
+    parser.add_argument('--keyword-spotting', default='off',
+                        choices=['off', 'shadow', 'on'],
+                        help='Recognize enrolled commands locally, and only wait'
+                        ' for the server if there is no confident match. shadow'
+                        ' only logs the matches (default: off)')
+    parser.add_argument('--keyword-dir',
+                        default=os.path.join(CONFIG_DIR, 'voice-recognizer', 'keywords'),
+                        help='Directory of recordings of each command, made'
+                        ' with src/kws.py record')
+    parser.add_argument('--keyword-threshold', type=float, default=1.5,
+                        help='How close a local match must be, relative to how'
+                        ' far apart the recordings of the command are (default: 1.5)')
+    parser.add_argument('--early-dispatch', action='store_true',
+                        help='Run local commands from stable interim transcripts,'
+                        ' before the final transcript (Cloud Speech API only)')
+    parser.add_argument('--early-dispatch-stability', type=float, default=0.8,
+                        help='Minimum interim result stability for early dispatch,'
+                        ' from 0 to 1 (default: 0.8)')
+    parser.add_argument('--early-dispatch-confirmations', type=int, default=1,
+                        help='Number of interim responses in a row that must'
+                        ' agree before early dispatch (default: 1)')
+    parser.add_argument('--action-workers', type=int, default=2,
+                        help='Run actions on this many threads, so the recognizer'
+                        ' can listen again while they finish (default: 2, or 0'
+                        ' to run them on the recognizer thread)')
+    parser.add_argument('--action-timeout', type=float,
+                        default=actionbase.ActionExecutor.DEFAULT_TIMEOUT_S,
+                        help='Seconds to wait for an action before giving up on'
+                        ' it (default: %(default)s)')
+    parser.add_argument('--trace-file',
+                        help='Append the time taken by each action, and the'
+                        ' Wemo, Chromecast and speech calls it makes, to this'
+                        ' file as JSON lines. Summaries are always logged on'
+                        ' SIGUSR1')
+    parser.add_argument('--audio-source', default='arecord',
+                        help='Where to read audio from: arecord[:DEVICE],'
+                        ' file:PATH, loop:PATH, synthetic[:SIGNAL] or stdin'
+                        ' (default: arecord)')
+    parser.add_argument('--audio-free-running', action='store_true',
+                        help='Read file, synthetic and stdin audio sources as'
+                        ' fast as possible instead of in real time')
+    parser.add_argument('--audio-preroll', type=float, default=0.0,
+                        help='Seconds of audio from before the recognizer started'
+                        ' listening to send with each request (default: 0)')
+    parser.add_argument('--audio-dispatch-queue', type=int, default=0,
+                        help='Run each audio processor on its own thread with a'
+                        ' queue of this many 100 ms chunks (default: 0, run'
+                        ' processors on the recording thread)')
+    parser.add_argument('--audio-overrun', default='drop', choices=['drop', 'block'],
+                        help='What to do when a threaded audio processor falls'
+                        ' behind: drop new chunks, or block recording')
+
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Log how long each import and phase of startup'
+                        ' took, once ready')
+
+    with startup.PROFILE.phase('arguments'):
+        args = parser.parse_args()
+    startup.PROFILE.log_when_ready = args.startup_profile
 
     create_pid_file(args.pid_file)
     aiy.i18n.set_locale_dir(LOCALE_DIR)
     aiy.i18n.set_language_code(args.language, gettext_install=True)
 
-    player = aiy.audio.get_player()
-
-    if args.cloud_speech:
-        credentials_file = os.path.expanduser(args.cloud_speech_secrets)
-        if not os.path.exists(credentials_file) and os.path.exists(OLD_SERVICE_CREDENTIALS):
-            credentials_file = OLD_SERVICE_CREDENTIALS
-        recognizer = speech.CloudSpeechRequest(credentials_file)
-    else:
-        credentials = try_to_get_credentials(
-            os.path.expanduser(args.assistant_secrets))
-        recognizer = speech.AssistantSpeechRequest(credentials)
+    tracing.install_signal_handler()
+    if args.trace_file:
+        tracing.get_registry().set_trace_file(args.trace_file)
 
-    status_ui = StatusUi(player, args.led_fifo, args.trigger_sound)
+    if args.hedged and args.cloud_speech:
+        print('--hedged uses both the Cloud Speech API and the Assistant API, so '
+              'it cannot be used with --cloud-speech.')
+        sys.exit(1)
 
     # The ok-google trigger is handled with the Assistant Library, so we need
     # to catch this case early.
+    if args.trigger == 'ok-google' and \
+            (args.cloud_speech or args.hedged or args.speech_api_target):
+        print('trigger=ok-google only works with the Assistant, not with '
+              'the Cloud Speech API or a local server.')
+        sys.exit(1)
+
+    # Phases that don't depend on each other start together, and the box is
+    # ready once the ones it needs to take a command are done.
+    phases = startup.Startup()
+    say = tracing.traced('say')(aiy.audio.say)
+    phases.add('player', aiy.audio.get_player)
+    phases.add('credentials', lambda: get_credentials(args))
+    phases.add('actor', lambda: make_actor(args, say))
+
     if args.trigger == 'ok-google':
-        if args.cloud_speech:
-            print('trigger=ok-google only works with the Assistant, not with '
-                  'the Cloud Speech API.')
-            sys.exit(1)
-        do_assistant_library(args, credentials, player, status_ui)
+        status_ui = StatusUi(phases.result('player'), args.led_fifo, args.trigger_sound)
+        do_assistant_library(args, phases.result('credentials'), phases.result('actor'),
+                             status_ui)
     else:
-        recorder = aiy.audio.get_recorder()
+        phases.add('recognizer', lambda credentials: make_recognizer(args, credentials),
+                   requires=['credentials'])
+        phases.add('recorder', lambda: make_recorder(args))
+        phases.add('trigger', lambda recorder: make_trigger(args, recorder),
+                   requires=['recorder'])
+        phases.add('local endpointer',
+                   lambda recognizer: make_local_endpointer(args, recognizer),
+                   requires=['recognizer'])
+        if args.keyword_spotting != 'off':
+            phases.add('keyword spotter', lambda actor: make_keyword_spotter(args, actor),
+                       requires=['actor'], optional=True)
+
+        status_ui = StatusUi(phases.result('player'), args.led_fifo, args.trigger_sound)
+        recorder = phases.result('recorder')
         with recorder:
-            do_recognition(args, recorder, recognizer, player, status_ui)
+            do_recognition(args, phases, recorder, say, status_ui)
+
 
+def get_credentials(args):
+    """Returns the Assistant API credentials, or None if they aren't needed."""
+    if args.cloud_speech or args.speech_api_target:
+        return None
+    return try_to_get_credentials(os.path.expanduser(args.assistant_secrets))
 
-def do_assistant_library(args, credentials, player, status_ui):
+
+def make_recognizer(args, credentials):
+    """Create and configure the speech request for the APIs in args, and
+    start connecting to the server."""
+    import speech
+    if args.cloud_speech or args.hedged:
+        credentials_file = os.path.expanduser(args.cloud_speech_secrets)
+        if not os.path.exists(credentials_file) and os.path.exists(OLD_SERVICE_CREDENTIALS):
+            credentials_file = OLD_SERVICE_CREDENTIALS
+        recognizer = speech.CloudSpeechRequest(credentials_file, args.speech_api_target)
+    if not args.cloud_speech:
+        assistant = speech.AssistantSpeechRequest(credentials, args.speech_api_target)
+        if args.hedged:
+            recognizer = speech.HedgedSpeechRequest(recognizer, assistant)
+        else:
+            recognizer = assistant
+
+    recognizer.set_audio_batching(args.audio_batch, args.audio_max_queued)
+    recognizer.set_retry_policy(args.speech_retries, args.speech_retry_deadline)
+    if args.audio_logging:
+        import audio_log
+        max_bytes = None
+        if args.audio_log_max_mb is not None:
+            max_bytes = int(args.audio_log_max_mb * 1024 * 1024)
+        recognizer.set_audio_logging_enabled(True, audio_log.AudioLog(
+            args.audio_log_dir,
+            max_bytes=max_bytes,
+            max_age_s=args.audio_log_max_age_days * 24 * 3600,
+            sample_rate_hz=speech.AUDIO_SAMPLE_RATE_HZ,
+            bytes_per_sample=speech.AUDIO_SAMPLE_SIZE))
+    if args.trim_leading_silence:
+        import vad
+        recognizer.set_trimmer(vad.LeadingSilenceTrimmer(args.vad_aggressiveness))
+    recognizer.warm_up()
+    return recognizer
+
+
+def make_actor(args, say):
+    """Create the actor, running actions on worker threads if enabled."""
+    actor = action.make_actor(say)
+    if args.action_workers:
+        actor.set_executor(actionbase.ActionExecutor(
+            args.action_workers, args.action_timeout))
+    if args.cloud_speech or args.hedged:
+        action.add_commands_just_for_cloud_speech_api(actor, say)
+    return actor
+
+
+def make_recorder(args):
+    """Create the recorder for the audio source in args."""
+    aiy.audio.set_audio_source(args.audio_source, not args.audio_free_running)
+    recorder = aiy.audio.get_recorder()
+    recorder.set_preroll_duration(args.audio_preroll)
+    if args.audio_dispatch_queue:
+        recorder.set_threaded_dispatch(args.audio_dispatch_queue, args.audio_overrun)
+    return recorder
+
+
+def make_local_endpointer(args, recognizer):
+    """Returns the local endpointer for recognizer, or None if it is off."""
+    if args.local_endpointer == 'off':
+        return None
+    import vad
+    return vad.LocalEndpointer(recognizer, args.vad_aggressiveness,
+                               shadow=args.local_endpointer == 'shadow')
+
+
+def do_assistant_library(args, credentials, actor, status_ui):
     """Run a recognizer using the Google Assistant Library.
 
     The Google Assistant Library has direct access to the audio API, so this
@@ -198,9 +413,6 @@ installed with:
     env/bin/pip install google-assistant-library==0.0.2''')
         sys.exit(1)
 
-    say = aiy.audio.say
-    actor = action.make_actor(say)
-
     def process_event(event):
         logging.info(event)
 
@@ -215,11 +427,12 @@ installed with:
         elif event.type == EventType.ON_END_OF_UTTERANCE:
             status_ui.status('thinking')
 
-        elif event.type == EventType.ON_RECOGNIZING_SPEECH_FINISHED and \
-                event.args and actor.can_handle(event.args['text']):
-            if not args.assistant_always_responds:
-                assistant.stop_conversation()
-            actor.handle(event.args['text'])
+        elif event.type == EventType.ON_RECOGNIZING_SPEECH_FINISHED and event.args:
+            handler = actor.match(event.args['text'])
+            if handler:
+                if not args.assistant_always_responds:
+                    assistant.stop_conversation()
+                actor.run(handler, event.args['text'])
 
         elif event.type == EventType.ON_CONVERSATION_TURN_FINISHED:
             status_ui.status('ready')
@@ -233,32 +446,35 @@ installed with:
             process_event(event)
 
 
-def do_recognition(args, recorder, recognizer, player, status_ui):
-    """Configure and run the recognizer."""
-    say = aiy.audio.say
-    actor = action.make_actor(say)
-
-    if args.cloud_speech:
-        action.add_commands_just_for_cloud_speech_api(actor, say)
+def do_recognition(args, phases, recorder, say, status_ui):
+    """Run the recognizer once the phases it needs are done. Optional ones,
+    such as the keyword spotter, are attached when they finish."""
+    recognizer = phases.result('recognizer')
+    actor = phases.result('actor')
+    triggerer, msg = phases.result('trigger')
+    if triggerer is None:
+        return
 
+    if args.hedged:
+        recognizer.set_local_command_matcher(actor.can_handle)
     recognizer.add_phrases(actor)
-    recognizer.set_audio_logging_enabled(args.audio_logging)
-
-    if args.trigger == 'gpio':
-        import triggers.gpio
-        triggerer = triggers.gpio.GpioTrigger(channel=23)
-        msg = 'Press the button on GPIO 23'
-    elif args.trigger == 'clap':
-        import triggers.clap
-        triggerer = triggers.clap.ClapTrigger(recorder)
-        msg = 'Clap your hands'
-    else:
-        logger.error("Unknown trigger '%s'", args.trigger)
-        return
 
     mic_recognizer = SyncMicRecognizer(
-        actor, recognizer, recorder, player, say, triggerer, status_ui,
-        args.assistant_always_responds)
+        actor, recognizer, recorder, phases.result('player'), say, triggerer, status_ui,
+        args.assistant_always_responds, phases.result('local endpointer'))
+
+    if args.early_dispatch:
+        if args.cloud_speech or args.hedged:
+            mic_recognizer.set_early_dispatch(
+                args.early_dispatch_stability, args.early_dispatch_confirmations)
+        else:
+            logger.warning('--early-dispatch only works with the Cloud Speech API')
+
+    if args.keyword_spotting != 'off':
+        def attach_keyword_spotter(keyword_spotter):
+            if keyword_spotter:
+                mic_recognizer.set_keyword_spotter(keyword_spotter)
+        phases.when_done('keyword spotter', attach_keyword_spotter)
 
     with mic_recognizer:
         if sys.stdout.isatty():
@@ -269,6 +485,50 @@ def do_recognition(args, recorder, recognizer, player, status_ui):
             time.sleep(1)
 
 
+def make_trigger(args, recorder):
+    """Returns the trigger and what to tell the user to do, or (None, None)
+    if it cannot be created."""
+    if args.trigger == 'gpio':
+        import triggers.gpio
+        return triggers.gpio.GpioTrigger(channel=23), 'Press the button on GPIO 23'
+    elif args.trigger == 'clap':
+        import triggers.clap
+        return triggers.clap.ClapTrigger(recorder), 'Clap your hands'
+    elif args.trigger == 'hotword':
+        import triggers.hotword
+        try:
+            triggerer = triggers.hotword.HotwordTrigger(
+                recorder, args.hotword_dir, args.hotword_threshold,
+                args.hotword_cpu_budget)
+        except (OSError, ValueError) as e:
+            logger.error('Cannot load the wake word: %s', e)
+            return None, None
+        return triggerer, 'Say the wake word'
+
+    logger.error("Unknown trigger '%s'", args.trigger)
+    return None, None
+
+
+def make_keyword_spotter(args, actor):
+    """Returns a keyword spotter for the enrolled commands, or None if there
+    are none."""
+    import kws
+    try:
+        templates = kws.load_templates(args.keyword_dir, args.vad_aggressiveness)
+    except (OSError, ValueError) as e:
+        logger.warning('keyword spotting is off: %s', e)
+        return None
+
+    for phrase in templates.get_phrases():
+        if not actor.can_handle(phrase):
+            logger.warning('no action for keyword %r', phrase)
+    logger.info('keyword spotting for %d commands', len(templates.get_phrases()))
+    return kws.KeywordSpotter(
+        templates, threshold=args.keyword_threshold,
+        aggressiveness=args.vad_aggressiveness,
+        shadow=args.keyword_spotting == 'shadow')
+
+
 class StatusUi(object):
 
     """Gives the user status feedback.
@@ -304,6 +564,8 @@ class StatusUi(object):
                 led.write(status + '\n')
         logger.info('%s...', status)
 
+        if status == 'ready':
+            startup.PROFILE.ready()
         if status == 'listening' and self.trigger_sound:
             self.player.play_wav(self.trigger_sound)
 
@@ -319,7 +581,8 @@ class SyncMicRecognizer(object):
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self, actor, recognizer, recorder, player, say, triggerer,
-                 status_ui, assistant_always_responds):
+                 status_ui, assistant_always_responds, local_endpointer=None,
+                 keyword_spotter=None):
         self.actor = actor
         self.player = player
         self.recognizer = recognizer
@@ -330,6 +593,24 @@ class SyncMicRecognizer(object):
         self.triggerer.set_callback(self.recognize)
         self.status_ui = status_ui
         self.assistant_always_responds = assistant_always_responds
+        self.local_endpointer = local_endpointer
+        self.keyword_spotter = None
+        self._next_keyword_spotter = None
+        if keyword_spotter:
+            self.set_keyword_spotter(keyword_spotter)
+
+        # Assistant response audio is played as it arrives.
+        self._response_stream = None
+        self._response_suppressed = False
+        self._end_of_utterance_time = None
+        if hasattr(self.recognizer, 'set_audio_out_cb'):
+            self.recognizer.set_audio_out_cb(self._on_response_audio)
+
+        # Command run from an interim transcript, if any.
+        self._early_command = None
+        self._early_command_time = None
+        # Command recognized by the keyword spotter, if any.
+        self._local_command = None
 
         self.running = False
 
@@ -347,33 +628,98 @@ class SyncMicRecognizer(object):
 
         self.recognizer.end_audio()
 
+    def set_keyword_spotter(self, keyword_spotter):
+        """Use keyword_spotter from the next request on. It can be set while
+        recognizing, when it has finished loading."""
+        keyword_spotter.callback = self._on_local_command
+        self._next_keyword_spotter = keyword_spotter
+
+    def set_early_dispatch(self, min_stability, confirmations):
+        """Run commands from stable interim transcripts, if the action can
+        tell they are complete."""
+        self.recognizer.set_partial_transcript_cb(
+            self._on_partial_transcript, min_stability, confirmations)
+
     def recognize(self):
         if self.recognizer_event.is_set():
             # Duplicate trigger (eg multiple button presses)
             return
 
+        # Connect while the trigger sound plays, if the channel went idle.
+        self.recognizer.warm_up()
         self.status_ui.status('listening')
         self.recognizer.reset()
-        self.recorder.add_processor(self.recognizer)
+        self._local_command = None
+        if self._next_keyword_spotter:
+            self.keyword_spotter, self._next_keyword_spotter = self._next_keyword_spotter, None
+        # Prepend the preroll, in case the user started speaking during the
+        # trigger sound.
+        self.recorder.add_processor(self.recognizer, preroll=True, name='recognizer')
+        if self.local_endpointer:
+            # No preroll here: the trigger sound would count as speech.
+            self.local_endpointer.reset()
+            self.recorder.add_processor(self.local_endpointer, name='endpointer')
+        if self.keyword_spotter:
+            self.keyword_spotter.reset()
+            self.recorder.add_processor(self.keyword_spotter, name='keyword spotter')
         # Tell recognizer to run
         self.recognizer_event.set()
 
     def endpointer_cb(self):
         self.recorder.remove_processor(self.recognizer)
+        if self.local_endpointer:
+            self.recorder.remove_processor(self.local_endpointer)
+        if self.keyword_spotter:
+            self.keyword_spotter.end_of_utterance()
+            self.recorder.remove_processor(self.keyword_spotter)
+        self._end_of_utterance_time = time.monotonic()
         self.status_ui.status('thinking')
 
     def _recognize(self):
+        # Already loaded by the recognizer phase.
+        import speech
         while self.running:
             self.recognizer_event.wait()
             if not self.running:
                 break
 
             logger.info('recognizing...')
+            self._response_stream = None
+            self._response_suppressed = False
+            self._end_of_utterance_time = None
+            self._early_command = None
+            self._early_command_time = None
+            result = None
             try:
-                self._handle_result(self.recognizer.do_request())
+                result = self.recognizer.do_request()
+                if not self._local_command:
+                    self._handle_result(result)
             except speech.Error:
-                logger.exception('Unexpected error')
-                self.say(_('Unexpected error. Try again or check the logs.'))
+                if not self._local_command:
+                    logger.exception('Unexpected error')
+                    self.say(_('Unexpected error. Try again or check the logs.'))
+            finally:
+                self._finish_response_stream()
+
+            if self._local_command and self.actor.handle(self._local_command):
+                logger.info('handled keyword spotter command: %s', self._local_command)
+            if self.keyword_spotter:
+                self.keyword_spotter.request_finished(result and result.transcript)
+                logger.info('keyword spotter: %s', self.keyword_spotter.get_stats())
+
+            if self.local_endpointer:
+                self.local_endpointer.request_finished()
+                logger.info('local endpointer: %s', self.local_endpointer.get_stats())
+
+            for name, stats in self.recorder.get_dispatch_stats().items():
+                logger.info('audio dispatch %s: %s', name, stats)
+            logger.info('audio queue: %s', self.recognizer.get_audio_queue_stats())
+            if hasattr(self.recognizer, 'get_hedge_stats'):
+                logger.info('hedged recognition: %s', self.recognizer.get_hedge_stats())
+            if self.actor.executor:
+                logger.info('actions: %s', self.actor.executor.get_stats())
+            logger.debug('credentials expire in %s s',
+                         self.recognizer.seconds_until_credentials_expire())
 
             self.recognizer_event.clear()
             if self.recognizer.dialog_follow_on:
@@ -383,6 +729,10 @@ class SyncMicRecognizer(object):
                 self.status_ui.status('ready')
 
     def _handle_result(self, result):
+        if self._early_command:
+            self._log_early_command(result.transcript)
+            return
+
         if result.transcript and self.actor.handle(result.transcript):
             logger.info('handled local command: %s', result.transcript)
             if result.response_audio and self.assistant_always_responds:
@@ -394,11 +744,98 @@ class SyncMicRecognizer(object):
         else:
             logger.warning('no command recognized')
 
+    def _on_partial_transcript(self, transcript):
+        """Run a command before the final transcript arrives.
+
+        Called from the recognizer thread with stable interim transcripts.
+        Returns True if the command was handled.
+        """
+        handler = None if self._local_command else self.actor.match(transcript)
+        if handler is None or not handler.is_complete(transcript):
+            return False
+
+        logger.info('handling partial command: %s', transcript)
+        self._early_command = transcript
+        self._early_command_time = time.monotonic()
+        # The command is complete, so there is no need to send more audio.
+        self.recognizer.end_of_speech()
+        self.actor.run(handler, transcript)
+        return True
+
+    def _on_local_command(self, command):
+        """Run a command recognized by the keyword spotter, instead of waiting
+        for the server.
+
+        Called from the recorder thread. The command is run on the recognizer
+        thread once the request has been cancelled.
+        """
+        if self._early_command:
+            return
+        logger.info('keyword spotter heard: %s', command)
+        self._local_command = command
+        self.recognizer.end_of_speech()
+        self.recognizer.cancel()
+
+    def _log_early_command(self, transcript):
+        if transcript != self._early_command:
+            logger.warning('final transcript %r differs from early command %r',
+                           transcript, self._early_command)
+        final_time = self.recognizer.final_result_time
+        if final_time:
+            logger.info('early command ran %.0f ms before the final transcript',
+                        1000 * (final_time - self._early_command_time))
+
+    def _on_response_audio(self, audio_bytes):
+        """Start playing the Assistant's response before it has all arrived.
+
+        Called from the recognizer thread for each piece of response audio.
+        """
+        if self._response_suppressed or self._local_command:
+            return
+
+        if self._response_stream is None:
+            # The transcript comes before the audio, so we can tell whether
+            # the command will be handled locally.
+            transcript = self.recognizer.transcript
+            if transcript and not self.assistant_always_responds and \
+                    self.actor.can_handle(transcript):
+                self._response_suppressed = True
+                return
+
+            import speech
+            self._response_stream = self.player.open_stream(
+                sample_rate=speech.AUDIO_SAMPLE_RATE_HZ,
+                sample_width=speech.AUDIO_SAMPLE_SIZE)
+
+        self._response_stream.write(audio_bytes)
+
+    def _finish_response_stream(self):
+        """Wait for the streamed response to finish playing."""
+        if self._response_stream is None:
+            return
+
+        stream, self._response_stream = self._response_stream, None
+        stream.close()
+        if stream.first_write_time:
+            self._log_response_latency(stream.first_write_time)
+
+    def _log_response_latency(self, first_audio_time):
+        if self._end_of_utterance_time:
+            logger.info('First response audio %.0f ms after end of utterance',
+                        1000 * (first_audio_time - self._end_of_utterance_time))
+
     def _play_assistant_response(self, audio_bytes):
+        import speech
         bytes_per_sample = speech.AUDIO_SAMPLE_SIZE
         sample_rate_hz = speech.AUDIO_SAMPLE_RATE_HZ
         logger.info('Playing %.4f seconds of audio...',
                     len(audio_bytes) / (bytes_per_sample * sample_rate_hz))
+        if self._response_stream:
+            # Already playing as it arrived.
+            self._finish_response_stream()
+            return
+
+        self._log_response_latency(time.monotonic())
         self.player.play_bytes(audio_bytes, sample_width=bytes_per_sample,
                                sample_rate=sample_rate_hz)
 
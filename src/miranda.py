@@ -154,7 +154,7 @@ class upnp:
 			return False
 
 	#Send SOAP request
-	def sendSOAP(self,hostName,serviceType,controlURL,actionName,actionArguments):
+	def sendSOAP(self,hostName,serviceType,controlURL,actionName,actionArguments,timeout=None):
 		argList = ''
 		soapResponse = ''
 
@@ -212,6 +212,8 @@ class upnp:
 		#Send data and go into recieve loop
 		try:
 			sock = socket()
+			#Give up on a device that stops responding, if a timeout is given
+			sock.settimeout(timeout)
 			sock.connect((host,port))
 			sock.send(soapRequest.encode())
 			while True:
@@ -233,7 +235,7 @@ class upnp:
 				return False
 			else:
 				return body
-		except Exception (e):
+		except Exception as e:
 			print ('Caught socket exception:', e)
 			sock.close()
 			return False
@@ -16,10 +16,13 @@
 
 from abc import abstractmethod
 import collections
+import copy
+import datetime
+import functools
 import logging
 import os
-import tempfile
-import wave
+import threading
+import time
 
 import google.auth
 import google.auth.exceptions
@@ -29,9 +32,9 @@ from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
 from google.rpc import code_pb2 as error_code
 from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
 import grpc
-from six.moves import queue
 
 import aiy.i18n
+import audio_log
 
 logger = logging.getLogger('speech')
 
@@ -46,30 +49,296 @@ class Error(Exception):
     pass
 
 
+def _rpc_error_code(exc):
+    """Returns the status code of a grpc.RpcError, or None if it has none."""
+    code = getattr(exc, 'code', None)
+    return code() if callable(code) else None
+
+
+class _CredentialRefresher(threading.Thread):
+
+    """Refreshes OAuth credentials on a background thread before they expire.
+
+    gRPC refreshes expired credentials inside the call that needs them, which
+    delays the first audio of that request. This thread refreshes every added
+    credential REFRESH_MARGIN_SECS before it expires, so requests always find
+    a valid token. It is shared by all speech requests.
+    """
+
+    REFRESH_MARGIN_SECS = 10 * 60
+    RETRY_SECS = 30
+    # How long to wait for credentials that don't report an expiry time.
+    NO_EXPIRY_RECHECK_SECS = 60 * 60
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._cond = threading.Condition()
+        self._credentials = []
+
+    def add(self, credentials):
+        """Keeps the credentials refreshed, starting now."""
+        with self._cond:
+            if not any(c is credentials for c in self._credentials):
+                self._credentials.append(credentials)
+                self._cond.notify()
+
+    @staticmethod
+    def seconds_until_expiry(credentials):
+        """Returns the seconds until the token expires, or None if unknown."""
+        if credentials.expiry is None:
+            return None
+        return (credentials.expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _refresh_if_needed(self, credentials, http_request):
+        """Refreshes if needed and returns the seconds until the next check."""
+        ttl = self.seconds_until_expiry(credentials)
+        if ttl is not None and ttl > self.REFRESH_MARGIN_SECS:
+            return ttl - self.REFRESH_MARGIN_SECS
+
+        try:
+            credentials.refresh(http_request)
+        except google.auth.exceptions.GoogleAuthError:
+            logger.exception('Failed to refresh credentials, retrying in %d s',
+                             self.RETRY_SECS)
+            return self.RETRY_SECS
+
+        ttl = self.seconds_until_expiry(credentials)
+        if ttl is None:
+            return self.NO_EXPIRY_RECHECK_SECS
+        logger.info('Refreshed credentials, valid for %d s', ttl)
+        return max(self.RETRY_SECS, ttl - self.REFRESH_MARGIN_SECS)
+
+    def run(self):
+        http_request = google.auth.transport.requests.Request()
+        while True:
+            with self._cond:
+                credentials = list(self._credentials)
+
+            wait = min([self._refresh_if_needed(c, http_request) for c in credentials],
+                       default=None)
+
+            with self._cond:
+                if len(self._credentials) == len(credentials):
+                    self._cond.wait(wait)
+
+
+_credential_refresher = None
+_credential_refresher_lock = threading.Lock()
+
+
+def _get_credential_refresher():
+    global _credential_refresher
+    with _credential_refresher_lock:
+        if _credential_refresher is None:
+            _credential_refresher = _CredentialRefresher()
+            _credential_refresher.start()
+        return _credential_refresher
+
+
 class _ChannelFactory(object):
 
-    """Creates gRPC channels with a given configuration."""
+    """Creates gRPC channels with a given configuration.
+
+    The channel is kept between requests, so only the first request pays for
+    the connection and TLS handshake. Keepalive pings stop idle connections
+    from being dropped silently, and reset_channel() starts over after the
+    connection fails.
+
+    Without credentials, api_host is a host:port to connect to without TLS,
+    such as a local test server.
+    """
+
+    # Google's frontends don't allow pings more often than every 5 minutes on
+    # connections without calls.
+    CHANNEL_OPTIONS = [
+        ('grpc.keepalive_time_ms', 5 * 60 * 1000),
+        ('grpc.keepalive_timeout_ms', 20 * 1000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
+
+    # gRPC polls the connectivity of a subscribed channel on a thread, which
+    # fails if the channel is closed under it. After the last unsubscribe, it
+    # stops within 0.2 s.
+    CLOSE_DELAY_SECS = 1.0
 
     def __init__(self, api_host, credentials):
         self._api_host = api_host
         self._credentials = credentials
 
-        self._checked = False
+        if credentials is not None:
+            # Refreshed in the background from now on, so requests don't wait
+            # for it, and errors are logged instead of being swallowed
+            # somewhere inside gRPC.
+            _get_credential_refresher().add(credentials)
+
+        self._lock = threading.Lock()
+        self._channel = None
+        self._closer = None
 
     def make_channel(self):
-        """Creates a secure channel."""
+        """Returns the shared secure channel, creating it if needed."""
+
+        with self._lock:
+            if self._channel is None:
+                self._channel = self._create_channel()
+                self._channel.subscribe(self._log_state)
+            return self._channel
+
+    def _create_channel(self):
+        if self._credentials is None:
+            return grpc.insecure_channel(self._api_host, options=self.CHANNEL_OPTIONS)
 
         request = google.auth.transport.requests.Request()
         target = self._api_host + ':443'
 
-        if not self._checked:
-            # Refresh now, to catch any errors early. Otherwise, they'll be
-            # raised and swallowed somewhere inside gRPC.
-            self._credentials.refresh(request)
-            self._checked = True
-
         return google.auth.transport.grpc.secure_authorized_channel(
-            self._credentials, request, target)
+            self._credentials, request, target, options=self.CHANNEL_OPTIONS)
+
+    def warm(self):
+        """Starts connecting in the background, if not connected already."""
+
+        channel = self.make_channel()
+        # Resubscribing with try_to_connect kicks an idle channel.
+        channel.unsubscribe(self._log_state)
+        channel.subscribe(self._log_state, try_to_connect=True)
+
+    def reset_channel(self):
+        """Drops the shared channel, so the next request reconnects."""
+
+        with self._lock:
+            channel, self._channel = self._channel, None
+        if channel is not None:
+            channel.unsubscribe(self._log_state)
+            self._closer = threading.Timer(self.CLOSE_DELAY_SECS, channel.close)
+            self._closer.daemon = True
+            self._closer.start()
+
+    def _log_state(self, state):
+        logger.debug('%s channel: %s', self._api_host, state)
+
+
+class _AudioQueue(object):
+
+    """A bounded queue of audio chunks that hands them out in batches.
+
+    get_batch() returns everything that is queued, up to a target size, as one
+    message. When the uplink keeps up, that is a single chunk and latency stays
+    low; when it falls behind, chunks are merged into fewer, bigger messages.
+    When the queue is full, the oldest silent chunk is dropped to make room, or
+    the oldest chunk if none are silent. A max_bytes of None never drops audio.
+    None marks the end of the audio and is never dropped.
+    """
+
+    # Peak amplitude below which a chunk is silence, about -30 dBFS.
+    SILENCE_PEAK = 1000
+
+    def __init__(self, max_bytes, batch_bytes, lock=None):
+        self.max_bytes = max_bytes
+        self.batch_bytes = batch_bytes
+        self._chunks = collections.deque()
+        self._bytes = 0
+        self._ready = threading.Condition(lock)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {
+            'messages': 0,
+            'max_batch_chunks': 0,
+            'total_batch_chunks': 0,
+            'max_depth_chunks': 0,
+            'dropped_silence': 0,
+            'dropped_speech': 0,
+        }
+
+    def get_stats(self):
+        """Returns the queue depth, batch size and drop counts since the last
+        reset_stats()."""
+        with self._ready:
+            stats = dict(self._stats)
+        messages = stats.pop('total_batch_chunks')
+        stats['mean_batch_chunks'] = messages / stats['messages'] if stats['messages'] else 0
+        return stats
+
+    def put(self, data):
+        with self._ready:
+            if data is not None:
+                while self.max_bytes is not None and \
+                        self._bytes + len(data) > self.max_bytes:
+                    if self._drop_oldest(self._is_silence):
+                        self._stats['dropped_silence'] += 1
+                    elif self._drop_oldest(lambda chunk: True):
+                        self._stats['dropped_speech'] += 1
+                    else:
+                        break
+                self._bytes += len(data)
+
+            self._chunks.append(data)
+            self._stats['max_depth_chunks'] = max(
+                self._stats['max_depth_chunks'], len(self._chunks))
+            self._ready.notify()
+
+    def _drop_oldest(self, predicate):
+        """Drops the oldest chunk of audio matching predicate, if any."""
+        for i, chunk in enumerate(self._chunks):
+            if chunk is not None and predicate(chunk):
+                del self._chunks[i]
+                self._bytes -= len(chunk)
+                return True
+        return False
+
+    def _is_silence(self, chunk):
+        samples = memoryview(chunk).cast('h')
+        return max(samples) < self.SILENCE_PEAK and -min(samples) < self.SILENCE_PEAK
+
+    def get_batch(self, cancelled=None):
+        """Waits for audio, and returns (data, ended).
+
+        data is the queued audio up to batch_bytes, or b'' if there is none;
+        ended is True if the audio ends after data. If cancelled() becomes
+        True while waiting, returns (None, False).
+        """
+        with self._ready:
+            while True:
+                if cancelled and cancelled():
+                    return None, False
+                if self._chunks:
+                    break
+                self._ready.wait()
+
+            parts = []
+            size = 0
+            ended = False
+            while self._chunks:
+                chunk = self._chunks[0]
+                if chunk is None:
+                    self._chunks.popleft()
+                    ended = True
+                    break
+                if parts and size + len(chunk) > self.batch_bytes:
+                    break
+                self._chunks.popleft()
+                parts.append(chunk)
+                size += len(chunk)
+            self._bytes -= size
+
+            if parts:
+                self._stats['messages'] += 1
+                self._stats['total_batch_chunks'] += len(parts)
+                self._stats['max_batch_chunks'] = max(
+                    self._stats['max_batch_chunks'], len(parts))
+
+        return b''.join(parts), ended
+
+    def wake(self):
+        """Wakes get_batch() calls to check if they have been cancelled."""
+        with self._ready:
+            self._ready.notify_all()
+
+    def clear(self):
+        with self._ready:
+            self._chunks.clear()
+            self._bytes = 0
 
 
 class GenericSpeechRequest(object):
@@ -81,14 +350,49 @@ class GenericSpeechRequest(object):
 
     DEADLINE_SECS = 185
 
+    # Audio is sent in messages of up to BATCH_SECS when the uplink is behind,
+    # and up to MAX_QUEUED_SECS of it is kept waiting to be sent.
+    BATCH_SECS = 0.5
+    MAX_QUEUED_SECS = 10
+
+    # Errors after which the channel is replaced for the next request.
+    RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.UNKNOWN)
+
+    # Errors after which the utterance is sent again on a new stream.
+    RETRY_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.UNKNOWN,
+                   grpc.StatusCode.INTERNAL, grpc.StatusCode.ABORTED)
+
     def __init__(self, api_host, credentials):
         self.dialog_follow_on = False
-        self._audio_queue = queue.Queue()
         self._phrases = []
+        self._credentials = credentials
         self._channel_factory = _ChannelFactory(api_host, credentials)
         self._endpointer_cb = None
-        self._audio_logging_enabled = False
-        self._request_log_wav = None
+        # The local endpointer and the server can both end the audio, from
+        # different threads.
+        self._end_lock = threading.Lock()
+        self._audio_ended = False
+        self.endpoint_times = {}
+        self._trimmer = None
+        self._audio_log = None
+        self._request_log = None
+
+        # The audio sent so far, to send again if the stream fails. The lock
+        # is shared with the audio queue, so taking audio from the queue and
+        # adding it to the utterance happen together.
+        self._utterance = []
+        self._utterance_lock = threading.RLock()
+        self._consume_lock = threading.Lock()
+        self._stream_id = 0
+        self._all_audio_sent = False
+        self._call = None
+        self._cancelled = False
+        self._transcript_cb = None
+        self.max_retries = 2
+        self.retry_deadline_secs = 3.0
+        self._audio_queue = _AudioQueue(self._seconds_to_bytes(self.MAX_QUEUED_SECS),
+                                        self._seconds_to_bytes(self.BATCH_SECS),
+                                        self._utterance_lock)
 
     def add_phrases(self, phrases):
         """Makes the recognition more likely to recognize the given phrase(s).
@@ -98,31 +402,110 @@ class GenericSpeechRequest(object):
 
         self._phrases.extend(phrases.get_phrases())
 
+    @staticmethod
+    def _seconds_to_bytes(seconds):
+        return AUDIO_SAMPLE_SIZE * int(seconds * AUDIO_SAMPLE_RATE_HZ)
+
+    def set_audio_batching(self, batch_secs, max_queued_secs):
+        """Sets how much audio can be merged into one message when the uplink
+        falls behind, and how much can wait before the oldest silence is
+        dropped. With max_queued_secs None, no audio is dropped, for audio that
+        is queued faster than real time, such as a whole file."""
+        self._audio_queue.batch_bytes = self._seconds_to_bytes(batch_secs)
+        if max_queued_secs is None:
+            self._audio_queue.max_bytes = None
+        else:
+            self._audio_queue.max_bytes = self._seconds_to_bytes(max_queued_secs)
+
+    def set_retry_policy(self, max_retries, deadline_secs):
+        """Sets how often a request is sent again after a transient error.
+
+        The audio is kept, so the retry doesn't need the user to speak again.
+        No retry starts more than deadline_secs after the first error.
+        """
+        self.max_retries = max_retries
+        self.retry_deadline_secs = deadline_secs
+
+    def get_audio_queue_stats(self):
+        """Returns the audio queue depth and message sizes for the last request."""
+        return self._audio_queue.get_stats()
+
     def set_endpointer_cb(self, cb):
         """Callback to invoke on end of speech."""
         self._endpointer_cb = cb
 
-    def set_audio_logging_enabled(self, audio_logging_enabled=True):
-        self._audio_logging_enabled = audio_logging_enabled
+    def set_transcript_cb(self, cb):
+        """Callback to invoke with the transcript as soon as it arrives, before
+        the request is finished."""
+        self._transcript_cb = cb
+
+    def _notify_transcript(self, transcript):
+        if self._transcript_cb:
+            self._transcript_cb(transcript)
+
+    def seconds_until_credentials_expire(self):
+        """Returns the seconds until the current OAuth token expires.
+
+        Returns None if the credentials have not been refreshed yet, or if
+        there are none, as with a local server.
+        """
+        if self._credentials is None:
+            return None
+        return _CredentialRefresher.seconds_until_expiry(self._credentials)
+
+    def warm_up(self):
+        """Connects to the server in the background, ahead of the request."""
+        self._channel_factory.warm()
+
+    def set_trimmer(self, trimmer):
+        """Hold back audio until speech starts.
 
+        trimmer: an object like vad.LeadingSilenceTrimmer, with reset(),
+            process(data) returning the chunks to send, and finish().
+        """
+        self._trimmer = trimmer
+
+    def set_audio_logging_enabled(self, audio_logging_enabled=True, log=None):
+        """Log request and response audio to WAV files.
+
+        log: an audio_log.AudioLog to write to, or None for one with the
+            default settings.
+        """
         if audio_logging_enabled:
-            self._audio_log_dir = tempfile.mkdtemp()
-            self._audio_log_ix = 0
+            self._audio_log = log or audio_log.AudioLog(
+                sample_rate_hz=AUDIO_SAMPLE_RATE_HZ, bytes_per_sample=AUDIO_SAMPLE_SIZE)
+        else:
+            self._audio_log = None
 
     def reset(self):
-        while True:
-            try:
-                self._audio_queue.get(False)
-            except queue.Empty:
-                return
+        with self._end_lock:
+            self._audio_ended = False
+            self.endpoint_times = {}
+        self._audio_queue.clear()
+        self._audio_queue.reset_stats()
+        with self._utterance_lock:
+            self._utterance = []
+            self._stream_id += 1
+            self._call = None
+            self._cancelled = False
+        self._all_audio_sent = False
 
         self.dialog_follow_on = False
 
     def add_data(self, data):
-        self._audio_queue.put(data)
+        # The recorder passes views into its ring buffer, so keep a copy.
+        self._audio_queue.put(bytes(data))
 
     def end_audio(self):
-        self.add_data(None)
+        self._audio_queue.put(None)
+
+    def end_of_speech(self, source='local'):
+        """Stop sending audio because the end of speech was detected locally.
+
+        This has the same effect as an endpointer event from the server. source
+        is what endpoint_times records it as.
+        """
+        self._end_audio_request(source)
 
     def _get_speech_context(self):
         """Return a SpeechContext instance to bias recognition towards certain
@@ -154,22 +537,53 @@ class GenericSpeechRequest(object):
         """
         return
 
-    def _request_stream(self):
+    def _request_stream(self, stream_id):
         """Yields a config request followed by requests constructed from the
         audio queue.
+
+        On a retry, the audio that was already sent comes first, as fast as
+        the stream takes it. A stream that has been replaced by a retry stops
+        taking audio from the queue.
         """
         yield self._create_config_request()
 
-        while True:
-            data = self._audio_queue.get()
+        def cancelled():
+            return stream_id != self._stream_id
 
-            if not data:
+        sent = 0
+        while True:
+            # Only one stream takes audio from the queue at a time, so a retry
+            # doesn't start taking it until the audio taken by the stream it
+            # replaces is in the utterance. The utterance lock isn't held
+            # while trimming, since the capture thread needs it to queue audio.
+            with self._consume_lock:
+                with self._utterance_lock:
+                    if cancelled():
+                        return
+                    chunks = self._utterance[sent:]
+                    ended = self._all_audio_sent
+                if not chunks and not ended:
+                    data, ended = self._audio_queue.get_batch(cancelled)
+                    new_chunks = []
+                    if data:
+                        new_chunks = self._trimmer.process(data) if self._trimmer else [data]
+                        new_chunks = [chunk for chunk in new_chunks if chunk]
+                    with self._utterance_lock:
+                        # Kept even if cancelled meanwhile, for the retry.
+                        self._utterance.extend(new_chunks)
+                        self._all_audio_sent = ended
+                    if self._request_log:
+                        for chunk in new_chunks:
+                            self._request_log.write(chunk)
+                    chunks = new_chunks
+
+            if not chunks and ended:
                 return
-
-            if self._request_log_wav:
-                self._request_log_wav.writeframes(data)
-
-            yield self._create_audio_request(data)
+            for chunk in chunks:
+                if cancelled():
+                    return
+                sent += 1
+                yield self._create_audio_request(chunk)
 
     @abstractmethod
     def _create_response_stream(self, service, request_stream, deadline):
@@ -195,7 +609,19 @@ class GenericSpeechRequest(object):
         """
         return
 
-    def _end_audio_request(self):
+    def _end_audio_request(self, source='server'):
+        """Stop sending audio and notify the endpointer callback once.
+
+        endpoint_times records when each source (server, local, hedge or error)
+        first asked for the audio to end, to compare local and server
+        endpointing.
+        """
+        with self._end_lock:
+            self.endpoint_times.setdefault(source, time.monotonic())
+            if self._audio_ended:
+                return
+            self._audio_ended = True
+
         self.end_audio()
         if self._endpointer_cb:
             self._endpointer_cb()
@@ -203,7 +629,7 @@ class GenericSpeechRequest(object):
     def _handle_response_stream(self, response_stream):
         for resp in response_stream:
             if resp.error.code != error_code.OK:
-                self._end_audio_request()
+                self._end_audio_request('error')
                 raise Error('Server error: ' + resp.error.message)
 
             if self._stop_sending_audio(resp):
@@ -214,27 +640,16 @@ class GenericSpeechRequest(object):
         # Server has closed the connection
         return self._finish_request() or ''
 
-    def _start_logging_request(self):
-        """Open a WAV file to log the request audio."""
-        self._audio_log_ix += 1
-        request_filename = '%s/request.%03d.wav' % (
-            self._audio_log_dir, self._audio_log_ix)
-        logger.info('Writing request to %s', request_filename)
-
-        self._request_log_wav = wave.open(request_filename, 'w')
-
-        self._request_log_wav.setnchannels(1)
-        self._request_log_wav.setsampwidth(AUDIO_SAMPLE_SIZE)
-        self._request_log_wav.setframerate(AUDIO_SAMPLE_RATE_HZ)
-
     def _finish_request(self):
         """Called after the final response is received."""
 
-        if self._request_log_wav:
-            self._request_log_wav.close()
-
         return _Result(None, None)
 
+    def _can_retry(self):
+        """Returns False if responses that can't be taken back, such as
+        response audio, have already been passed on."""
+        return True
+
     def do_request(self):
         """Establishes a connection and starts sending audio to the cloud
         endpoint. Responses are handled by the subclass until one returns a
@@ -247,21 +662,79 @@ class GenericSpeechRequest(object):
 
         Raises speech.Error on error.
         """
-        try:
-            service = self._make_service(self._channel_factory.make_channel())
+        if self._audio_log:
+            self._request_log = self._audio_log.start_request()
+        if self._trimmer:
+            self._trimmer.reset()
 
-            response_stream = self._create_response_stream(
-                service, self._request_stream(), self.DEADLINE_SECS)
-
-            if self._audio_logging_enabled:
-                self._start_logging_request()
-
-            return self._handle_response_stream(response_stream)
-        except (
-                google.auth.exceptions.GoogleAuthError,
-                grpc.RpcError,
-        ) as exc:
-            raise Error('Exception in speech request') from exc
+        result = None
+        try:
+            result = self._do_request_with_retries()
+            return result
+        finally:
+            # Once per request, however many streams were tried.
+            if self._trimmer:
+                self._trimmer.finish()
+            if self._request_log:
+                self._request_log.finish(*(result or (None, None)))
+                self._request_log = None
+
+    def cancel(self):
+        """Stops the request in progress, from another thread.
+
+        do_request() raises Error, and does not retry.
+        """
+        with self._utterance_lock:
+            self._cancelled = True
+            # Stop the request stream from waiting for more audio.
+            self._stream_id += 1
+            self._audio_queue.wake()
+            call = self._call
+        if call is not None:
+            call.cancel()
+
+    def _do_request_with_retries(self):
+        first_error_time = None
+        retries = 0
+        while True:
+            try:
+                service = self._make_service(self._channel_factory.make_channel())
+
+                with self._utterance_lock:
+                    if self._cancelled:
+                        raise Error('Speech request cancelled')
+                    stream_id = self._stream_id
+                    response_stream = self._create_response_stream(
+                        service, self._request_stream(stream_id), self.DEADLINE_SECS)
+                    self._call = response_stream
+
+                return self._handle_response_stream(response_stream)
+            except grpc.RpcError as exc:
+                if self._cancelled:
+                    raise Error('Speech request cancelled') from exc
+
+                code = _rpc_error_code(exc)
+                if code in self.RECONNECT_CODES:
+                    self._channel_factory.reset_channel()
+
+                now = time.monotonic()
+                first_error_time = first_error_time or now
+                if code not in self.RETRY_CODES or retries >= self.max_retries or \
+                        now - first_error_time > self.retry_deadline_secs or \
+                        not self._can_retry():
+                    raise Error('Exception in speech request') from exc
+            except google.auth.exceptions.GoogleAuthError as exc:
+                raise Error('Exception in speech request') from exc
+
+            retries += 1
+            with self._utterance_lock:
+                # Stop the failed stream from taking more audio.
+                self._stream_id += 1
+                self._audio_queue.wake()
+                replay_secs = sum(len(c) for c in self._utterance) / (
+                    AUDIO_SAMPLE_SIZE * AUDIO_SAMPLE_RATE_HZ)
+            logger.warning('%s, sending %.1f s of audio again (retry %d)',
+                           code, replay_secs, retries)
 
 
 class CloudSpeechRequest(GenericSpeechRequest):
@@ -270,15 +743,20 @@ class CloudSpeechRequest(GenericSpeechRequest):
 
     Args:
         credentials_file: path to service account credentials JSON file
+        api_target: host:port of a local server to use instead of the Cloud
+            Speech API, without TLS or credentials
     """
 
     SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 
-    def __init__(self, credentials_file):
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file
-        credentials, _ = google.auth.default(scopes=[self.SCOPE])
+    def __init__(self, credentials_file, api_target=None):
+        if api_target:
+            credentials = None
+        else:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file
+            credentials, _ = google.auth.default(scopes=[self.SCOPE])
 
-        super().__init__('speech.googleapis.com', credentials)
+        super().__init__(api_target or 'speech.googleapis.com', credentials)
 
         self.language_code = aiy.i18n.get_language_code()
 
@@ -286,10 +764,37 @@ class CloudSpeechRequest(GenericSpeechRequest):
             raise ValueError("cloud_speech_pb2.py doesn't have StreamingRecognizeRequest.")
 
         self._transcript = None
+        self._partial_cb = None
+        self._min_stability = None
+        self._confirmations = None
+        self.final_result_time = None
+        self._stable_text = None
+        self._stable_count = 0
+        self._partial_done = False
 
     def reset(self):
         super().reset()
         self._transcript = None
+        self.final_result_time = None
+        self._stable_text = None
+        self._stable_count = 0
+        self._partial_done = False
+
+    def set_partial_transcript_cb(self, cb, min_stability=0.8, confirmations=1):
+        """Ask for interim results and pass stable partial transcripts to cb.
+
+        Only the leading interim results with at least min_stability are
+        passed on, so words that the server is still likely to revise don't
+        reach cb. With confirmations above 1, the same text must also be seen
+        in that many responses in a row. If cb returns True, the partial transcript was
+        handled and cb isn't called again for this request.
+
+        cb: function taking the partial transcript, or None to turn interim
+            results off.
+        """
+        self._partial_cb = cb
+        self._min_stability = min_stability
+        self._confirmations = confirmations
 
     def _make_service(self, channel):
         return cloud_speech.SpeechStub(channel)
@@ -308,6 +813,7 @@ class CloudSpeechRequest(GenericSpeechRequest):
         streaming_config = cloud_speech.StreamingRecognitionConfig(
             config=recognition_config,
             single_utterance=True,  # TODO(rodrigoq): find a way to handle pauses
+            interim_results=self._partial_cb is not None,
         )
 
         return cloud_speech.StreamingRecognizeRequest(
@@ -332,10 +838,48 @@ class CloudSpeechRequest(GenericSpeechRequest):
 
     def _handle_response(self, resp):
         """Store the last transcript we received."""
-        if resp.results:
+        if not resp.results:
+            return
+
+        if self._partial_cb is None:
             self._transcript = ' '.join(
                 result.alternatives[0].transcript for result in resp.results)
             logger.info('transcript: %s', self._transcript)
+            self._notify_transcript(self._transcript)
+            return
+
+        final = [result for result in resp.results if result.is_final]
+        if final:
+            self._transcript = ' '.join(
+                result.alternatives[0].transcript for result in final)
+            self.final_result_time = time.monotonic()
+            logger.info('transcript: %s', self._transcript)
+            self._notify_transcript(self._transcript)
+        else:
+            self._handle_partial(resp.results)
+
+    def _handle_partial(self, results):
+        """Pass the stable start of the interim results to the callback."""
+        if self._partial_done:
+            return
+
+        stable = []
+        for result in results:
+            if result.stability < self._min_stability:
+                break
+            stable.append(result.alternatives[0].transcript.strip())
+        text = ' '.join(stable)
+        logger.debug('partial transcript: %r (stable %r)', ' '.join(
+            result.alternatives[0].transcript.strip() for result in results), text)
+
+        if not text or text != self._stable_text:
+            self._stable_text = text
+            self._stable_count = 1 if text else 0
+        else:
+            self._stable_count += 1
+
+        if self._stable_count >= self._confirmations and self._partial_cb(text):
+            self._partial_done = True
 
     def _finish_request(self):
         super()._finish_request()
@@ -344,24 +888,49 @@ class CloudSpeechRequest(GenericSpeechRequest):
 
 class AssistantSpeechRequest(GenericSpeechRequest):
 
-    """A request to the Assistant API, which returns audio and text."""
+    """A request to the Assistant API, which returns audio and text.
+
+    Args:
+        credentials: OAuth2 credentials for the Assistant API
+        api_target: host:port of a local server to use instead of the
+            Assistant API, without TLS or credentials
+    """
 
-    def __init__(self, credentials):
+    def __init__(self, credentials, api_target=None):
+        if api_target:
+            credentials = None
 
-        super().__init__('embeddedassistant.googleapis.com', credentials)
+        super().__init__(api_target or 'embeddedassistant.googleapis.com', credentials)
 
         self._conversation_state = None
-        self._response_audio = b''
+        self._response_audio = []
         self._transcript = None
+        self._audio_out_cb = None
 
     def reset(self):
         super().reset()
-        self._response_audio = b''
+        self._response_audio = []
         self._transcript = None
 
+    @property
+    def transcript(self):
+        """The transcript received so far for the current request, or None."""
+        return self._transcript
+
+    def set_audio_out_cb(self, cb):
+        """Callback to invoke with each piece of response audio as it arrives.
+
+        The whole response is still returned by do_request().
+        """
+        self._audio_out_cb = cb
+
     def _make_service(self, channel):
         return embedded_assistant_pb2.EmbeddedAssistantStub(channel)
 
+    def _can_retry(self):
+        # Response audio may already be playing.
+        return not self._response_audio
+
     def _create_config_request(self):
         audio_in_config = embedded_assistant_pb2.AudioInConfig(
             encoding='LINEAR16',
@@ -398,14 +967,19 @@ class AssistantSpeechRequest(GenericSpeechRequest):
 
     def _handle_response(self, resp):
         """Accumulate audio and text from the remote end. It will be handled
-        in _finish_request().
+        in _finish_request(). Audio is also passed on to the audio out
+        callback as it arrives.
         """
 
         if resp.result.spoken_request_text:
             logger.info('transcript: %s', resp.result.spoken_request_text)
             self._transcript = resp.result.spoken_request_text
+            self._notify_transcript(self._transcript)
 
-        self._response_audio += resp.audio_out.audio_data
+        if resp.audio_out.audio_data:
+            self._response_audio.append(resp.audio_out.audio_data)
+            if self._audio_out_cb:
+                self._audio_out_cb(resp.audio_out.audio_data)
 
         if resp.result.conversation_state:
             self._conversation_state = resp.result.conversation_state
@@ -418,22 +992,250 @@ class AssistantSpeechRequest(GenericSpeechRequest):
     def _finish_request(self):
         super()._finish_request()
 
-        if self._response_audio and self._audio_logging_enabled:
-            self._log_audio_out(self._response_audio)
+        return _Result(self._transcript, b''.join(self._response_audio))
+
+
+class HedgedSpeechRequest(object):
+
+    """Races a Cloud Speech request against an Assistant request.
 
-        return _Result(self._transcript, self._response_audio)
+    Both get the same audio. The first transcript that is a local command wins,
+    and the other request is cancelled straight away. If neither is, the
+    Assistant's response is used, or the Cloud Speech transcript if the
+    Assistant fails. When either server detects the end of speech, the other
+    request stops sending audio too.
 
-    def _log_audio_out(self, frames):
-        response_filename = '%s/response.%03d.wav' % (
-            self._audio_log_dir, self._audio_log_ix)
-        logger.info('Writing response to %s', response_filename)
+    Args:
+        cloud_request: a CloudSpeechRequest
+        assistant_request: an AssistantSpeechRequest
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, cloud_request, assistant_request):
+        self._requests = collections.OrderedDict([
+            ('cloud', cloud_request), ('assistant', assistant_request)])
+        self._is_local_command = lambda transcript: False
+        self._endpointer_cb = None
+        self._cond = threading.Condition()
+
+        for name, request in self._requests.items():
+            request.set_endpointer_cb(functools.partial(self._on_endpoint, name))
+            request.set_transcript_cb(functools.partial(self._on_transcript, name))
+
+        self._stats = {name: {'wins': 0, 'transcripts': 0, 'total_latency_ms': 0.0}
+                       for name in self._requests}
+        self._stats['assistant']['response_wins'] = 0
+        self.reset()
+
+    def set_local_command_matcher(self, is_local_command):
+        """Sets a function that returns True if a transcript is a command
+        that is handled locally, such as Actor.can_handle."""
+        self._is_local_command = is_local_command
+
+    def set_endpointer_cb(self, cb):
+        self._endpointer_cb = cb
+
+    def add_phrases(self, phrases):
+        for request in self._requests.values():
+            request.add_phrases(phrases)
+
+    def set_audio_logging_enabled(self, audio_logging_enabled=True, log=None):
+        # The Assistant request has the response audio too.
+        self._requests['assistant'].set_audio_logging_enabled(audio_logging_enabled, log)
+
+    def set_trimmer(self, trimmer):
+        self._requests['cloud'].set_trimmer(trimmer)
+        self._requests['assistant'].set_trimmer(copy.deepcopy(trimmer))
+
+    def set_audio_batching(self, batch_secs, max_queued_secs):
+        for request in self._requests.values():
+            request.set_audio_batching(batch_secs, max_queued_secs)
+
+    def set_retry_policy(self, max_retries, deadline_secs):
+        for request in self._requests.values():
+            request.set_retry_policy(max_retries, deadline_secs)
+
+    def set_audio_out_cb(self, cb):
+        self._requests['assistant'].set_audio_out_cb(cb)
+
+    def set_partial_transcript_cb(self, cb, min_stability=0.8, confirmations=1):
+        self._requests['cloud'].set_partial_transcript_cb(cb, min_stability, confirmations)
+
+    def warm_up(self):
+        for request in self._requests.values():
+            request.warm_up()
+
+    def seconds_until_credentials_expire(self):
+        expiries = [request.seconds_until_credentials_expire()
+                    for request in self._requests.values()]
+        expiries = [e for e in expiries if e is not None]
+        return min(expiries) if expiries else None
+
+    def get_audio_queue_stats(self):
+        return {name: request.get_audio_queue_stats()
+                for name, request in self._requests.items()}
+
+    def get_hedge_stats(self):
+        """Returns how often each backend won, and its mean latency from the
+        end of speech to the transcript."""
+        stats = {}
+        for name, backend in self._stats.items():
+            stats[name] = dict(backend)
+            total = stats[name].pop('total_latency_ms')
+            count = backend['transcripts']
+            stats[name]['mean_latency_ms'] = total / count if count else 0
+        return stats
+
+    @property
+    def transcript(self):
+        """The winning transcript, or the first one received so far."""
+        with self._cond:
+            if self._winner:
+                return self._transcripts[self._winner]
+            for name in self._requests:
+                if name in self._transcripts:
+                    return self._transcripts[name]
+        return None
+
+    @property
+    def dialog_follow_on(self):
+        return self._winner is None and self._requests['assistant'].dialog_follow_on
+
+    @property
+    def final_result_time(self):
+        return self._requests['cloud'].final_result_time
+
+    @property
+    def endpoint_times(self):
+        """The earliest time each source asked either request to end."""
+        times = {}
+        for request in self._requests.values():
+            for source, when in request.endpoint_times.items():
+                times[source] = min(when, times.get(source, when))
+        return times
+
+    def reset(self):
+        for request in self._requests.values():
+            request.reset()
+        with self._cond:
+            self._winner = None
+            self._transcripts = {}
+            self._results = {}
+            self._end_of_speech_time = None
+            self._endpointed = False
+
+    def add_data(self, data):
+        for request in self._requests.values():
+            request.add_data(data)
+
+    def end_audio(self):
+        for request in self._requests.values():
+            request.end_audio()
+
+    def end_of_speech(self):
+        for request in self._requests.values():
+            request.end_of_speech()
+
+    def _on_endpoint(self, name):
+        if self._end_utterance(name):
+            logger.info('%s ended the utterance', name)
+
+    def _end_utterance(self, ended_by=None):
+        """Stops the requests other than ended_by sending audio, recorded as a
+        'hedge' endpoint, and notifies the endpointer callback once.
+
+        Returns False if the utterance had already ended.
+        """
+        with self._cond:
+            if self._endpointed:
+                return False
+            self._endpointed = True
+            self._end_of_speech_time = time.monotonic()
+
+        for name, request in self._requests.items():
+            if name != ended_by:
+                request.end_of_speech('hedge')
+        if self._endpointer_cb:
+            self._endpointer_cb()
+        return True
+
+    def _on_transcript(self, name, transcript):
+        now = time.monotonic()
+        with self._cond:
+            if name in self._transcripts:
+                return
+            self._transcripts[name] = transcript
+
+            stats = self._stats[name]
+            stats['transcripts'] += 1
+            stats['total_latency_ms'] += 1000 * (now - (self._end_of_speech_time or now))
+
+            if self._winner is None and transcript and self._is_local_command(transcript):
+                self._winner = name
+                stats['wins'] += 1
+                self._cond.notify_all()
+
+        if self._winner == name:
+            logger.info('%s won with local command %r', name, transcript)
+            for other_name, request in self._requests.items():
+                if other_name != name:
+                    request.cancel()
+            # The winner is cancelled too, maybe before either endpointed, so
+            # the utterance has to end here for the caller to stop recording.
+            self._end_utterance()
+
+    def cancel(self):
+        """Stops both requests, from another thread. do_request() raises Error."""
+        for request in self._requests.values():
+            request.cancel()
+
+    def _run(self, name):
+        try:
+            result = self._requests[name].do_request()
+        except Error as e:
+            result = e
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Unexpected error in %s request', name)
+            result = Error('Unexpected error in %s request: %s' % (name, e))
+        with self._cond:
+            self._results[name] = result
+            self._cond.notify_all()
+
+    def do_request(self):
+        """Runs both requests, and returns the result of the winner.
+
+        Raises speech.Error if both fail.
+        """
+        threads = [threading.Thread(target=self._run, args=(name,))
+                   for name in self._requests]
+        for thread in threads:
+            thread.start()
+
+        with self._cond:
+            while self._winner is None and len(self._results) < len(self._requests):
+                self._cond.wait()
+            winner = self._winner
+
+        if winner:
+            # The winner's transcript is all that is needed.
+            self._requests[winner].cancel()
+        for thread in threads:
+            thread.join()
+
+        if winner:
+            return _Result(self._transcripts[winner], None)
+
+        assistant = self._results['assistant']
+        cloud = self._results['cloud']
+        if not isinstance(assistant, Error):
+            self._stats['assistant']['response_wins'] += 1
+            return assistant
+        if not isinstance(cloud, Error):
+            logger.warning('Assistant request failed, using Cloud Speech: %s', assistant)
+            return cloud
+        raise assistant
 
-        response_wav = wave.open(response_filename, 'w')
-        response_wav.setnchannels(1)
-        response_wav.setsampwidth(AUDIO_SAMPLE_SIZE)
-        response_wav.setframerate(AUDIO_SAMPLE_RATE_HZ)
-        response_wav.writeframes(frames)
-        response_wav.close()
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -449,6 +1251,7 @@ if __name__ == '__main__':
         req = CloudSpeechRequest('/home/pi/credentials.json')
     else:
         req = CloudSpeechRequest('/home/pi/cloud_speech.json')
+    req.set_audio_batching(req.BATCH_SECS, None)
 
     with open(args.file, 'rb') as f:
         while True:
@@ -0,0 +1,234 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep startup fast: import modules when they are first used, run the phases
+of startup concurrently, and measure how long each import and phase takes.
+
+With --startup-profile, imports on every thread, including those of the
+startup phases, are timed from when main.py calls
+PROFILE.start_import_timing(), straight after importing this module, until the
+box is first ready.
+"""
+
+import builtins
+import contextlib
+import importlib.util
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger('startup')
+
+
+def lazy_import(name):
+    """Returns module name, which is only loaded when one of its attributes
+    is first used. Only use it for modules first used on one thread."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %r' % name, name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class StartupProfile(object):
+
+    """Times the imports, and the phases of startup, until the box is first
+    ready."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        # (module, seconds including its own imports, nesting depth, thread)
+        self.imports = []
+        # (phase, start seconds after self.start, seconds)
+        self.phases = []
+        self.ready_s = None
+        self.log_when_ready = False
+        self._import = None
+        # The nesting depth of the imports in progress on each thread.
+        self._local = threading.local()
+
+    def start_import_timing(self):
+        if self._import is None:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def stop_import_timing(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # pylint: disable=redefined-builtin
+        original = self._import or builtins.__import__
+        module = name
+        if level:
+            # Relative, eg from . import x, y in package p is timed as p.{x,y}.
+            package = (globals or {}).get('__package__') or ''
+            package = package.rsplit('.', level - 1)[0] if level > 1 else package
+            if not module:
+                names = list(fromlist or ())
+                module = names[0] if len(names) == 1 else '{%s}' % ','.join(
+                    names[:2] + ['...'] * (len(names) > 2))
+            module = '.'.join(filter(None, [package, module]))
+        if module in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            self._local.depth = depth
+            self.imports.append((module, time.perf_counter() - start, depth,
+                                 threading.current_thread().name))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of startup in a with block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start - self.start, time.monotonic() - start))
+
+    def ready(self):
+        """Called when the box is ready. Returns True the first time."""
+        if self.ready_s is not None:
+            return False
+        self.ready_s = time.monotonic() - self.start
+        self.stop_import_timing()
+        if self.log_when_ready:
+            logger.info('startup profile:\n%s', self.report())
+        return True
+
+    def report(self, top=15):
+        """Returns the timings, slowest imports first, as text."""
+        lines = []
+        if self.ready_s is not None:
+            lines.append('ready after %.0f ms' % (1000 * self.ready_s))
+        lines.append('phases:')
+        for name, start, seconds in self.phases:
+            lines.append('  %7.0f ms  %-20s (from %.0f ms)' % (1000 * seconds, name, 1000 * start))
+        lines.append('slowest imports, including the modules they import:')
+        for name, seconds, depth, thread in sorted(self.imports, key=lambda i: -i[1])[:top]:
+            lines.append('  %7.1f ms  %-20s %s%s' % (1000 * seconds, thread,
+                                                     '  ' * min(depth, 4), name))
+        return '\n'.join(lines)
+
+
+PROFILE = StartupProfile()
+
+
+class Startup(object):
+
+    """Runs the phases of startup, each on its own thread as soon as the
+    phases it requires have finished:
+
+        phases = Startup()
+        phases.add('credentials', get_credentials)
+        phases.add('recognizer', make_recognizer, requires=['credentials'])
+        recognizer = phases.result('recognizer')
+
+    A phase is called with the results of the phases it requires, which must
+    have been added before it. If it raises, including with sys.exit(), so do
+    result() and the phases that require it. An optional phase only logs its
+    error, for integrations that the box can run without.
+    """
+
+    def __init__(self, profile=PROFILE):
+        self._profile = profile
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, function, requires=(), optional=False):
+        """Start running function as phase name once its requirements are
+        done."""
+        phase = _Phase(name, function, [self._phases[r] for r in requires], optional)
+        self._phases[name] = phase
+        threading.Thread(target=self._run, args=(phase,), name='startup ' + name,
+                         daemon=True).start()
+
+    def result(self, name, timeout=None):
+        """Waits for phase name, and returns its result or raises its error.
+        Raises TimeoutError if it isn't done in time."""
+        phase = self._phases[name]
+        if not phase.done.wait(timeout):
+            raise TimeoutError('startup phase %r is taking too long' % name)
+        if phase.error is not None:
+            raise phase.error
+        return phase.value
+
+    def when_done(self, name, callback):
+        """Calls callback with the result of phase name when it succeeds: now
+        if it already has, otherwise on the phase's thread."""
+        phase = self._phases[name]
+        with self._lock:
+            if not phase.done.is_set():
+                phase.callbacks.append(callback)
+                return
+        if phase.error is None:
+            callback(phase.value)
+
+    def _run(self, phase):
+        args = []
+        for required in phase.requires:
+            required.done.wait()
+            if required.error is not None:
+                phase.error = required.error
+                break
+            args.append(required.value)
+        else:
+            start = time.monotonic()
+            try:
+                with self._profile.phase(phase.name):
+                    phase.value = phase.function(*args)
+                logger.info('%s took %.0f ms', phase.name, 1000 * (time.monotonic() - start))
+            except BaseException as e:  # pylint: disable=broad-except
+                phase.error = e
+                if phase.optional and not isinstance(e, SystemExit):
+                    logger.exception('%s failed after %.0f ms', phase.name,
+                                     1000 * (time.monotonic() - start))
+                else:
+                    logger.info('%s failed after %.0f ms', phase.name,
+                                1000 * (time.monotonic() - start))
+
+        with self._lock:
+            phase.done.set()
+            callbacks, phase.callbacks = phase.callbacks, []
+        if phase.error is None:
+            for callback in callbacks:
+                try:
+                    callback(phase.value)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('attaching %s failed', phase.name)
+
+
+class _Phase(object):
+
+    def __init__(self, name, function, requires, optional):
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.optional = optional
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
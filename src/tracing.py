@@ -0,0 +1,231 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time actions and the I/O they do, in histograms and an optional trace.
+
+Code to be timed runs in a span:
+
+    with tracing.span('wemo', device='Table', op='on'):
+        ...
+
+Each span adds its duration and outcome, 'ok' or the name of the exception,
+to the histogram for its name and labels, eg wemo{device=Table,op=on}. Spans
+started inside another on the same thread are its children. With a trace file,
+each span is also written to it as a line of JSON when it ends.
+
+The histograms can be logged with dump(), or on a signal after
+install_signal_handler(), eg with kill -USR1.
+"""
+
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger('tracing')
+
+# Upper bounds of the histogram buckets in ms, doubling from 0.1 ms to 105 s.
+BUCKET_BOUNDS_MS = [0.1 * 2 ** i for i in range(21)]
+
+
+class Histogram(object):
+
+    """Counts durations in buckets that double in size, and outcomes."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.outcomes = collections.Counter()
+
+    def add(self, duration_ms, outcome='ok'):
+        index = 0
+        while index < len(BUCKET_BOUNDS_MS) and duration_ms > BUCKET_BOUNDS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        self.outcomes[outcome] += 1
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the given fraction
+        of durations, so it overestimates by up to 2x."""
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                if index == len(BUCKET_BOUNDS_MS):
+                    return self.max_ms
+                return min(self.max_ms, BUCKET_BOUNDS_MS[index])
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / max(1, self.count),
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_ms,
+            'outcomes': dict(self.outcomes),
+        }
+
+
+class Registry(object):
+
+    """Histograms by span name and labels, and the trace file."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(Histogram)
+        self._trace_file = None
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def set_trace_file(self, path):
+        """Append each span to path as a line of JSON, or stop if path is
+        None."""
+        with self._lock:
+            if self._trace_file:
+                self._trace_file.close()
+            self._trace_file = open(path, 'a') if path else None
+
+    def current_span(self):
+        """Returns the innermost span on this thread, or None."""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **labels):
+        """Time the code in the with block.
+
+        The span is a child of parent, a span from current_span() on another
+        thread, or of the current span on this thread."""
+
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if parent is None and stack:
+            parent = stack[-1]
+        current = _Span(name, labels, next(self._ids), parent)
+        stack.append(current)
+        outcome = 'ok'
+        try:
+            yield current
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            self._end(current, outcome)
+
+    def record(self, name, duration_s, outcome='ok', **labels):
+        """Add a duration that was measured some other way."""
+        with self._lock:
+            self._histograms[_key(name, labels)].add(1000 * duration_s, outcome)
+
+    def get_stats(self):
+        """Returns a dict from histogram name to its statistics."""
+        with self._lock:
+            return {key: histogram.as_dict()
+                    for key, histogram in sorted(self._histograms.items())}
+
+    def dump(self):
+        """Log the histograms."""
+        for key, stats in self.get_stats().items():
+            logger.info('%s: %d, mean %.1f ms, p50 %.1f ms, p90 %.1f ms, max %.1f ms, %s',
+                        key, stats['count'], stats['mean_ms'], stats['p50_ms'],
+                        stats['p90_ms'], stats['max_ms'], stats['outcomes'])
+
+    def _end(self, current, outcome):
+        duration_ms = 1000 * (time.perf_counter() - current.start)
+        with self._lock:
+            self._histograms[_key(current.name, current.labels)].add(duration_ms, outcome)
+            if self._trace_file:
+                self._trace_file.write(json.dumps({
+                    'name': current.name,
+                    'labels': current.labels,
+                    'trace_id': current.trace_id,
+                    'span_id': current.span_id,
+                    'parent_id': current.parent.span_id if current.parent else None,
+                    'time': current.time,
+                    'duration_ms': round(duration_ms, 3),
+                    'outcome': outcome,
+                    'thread': threading.current_thread().name,
+                }) + '\n')
+                self._trace_file.flush()
+
+
+class _Span(object):
+
+    def __init__(self, name, labels, span_id, parent):
+        self.name = name
+        self.labels = labels
+        self.span_id = span_id
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else span_id
+        self.time = time.time()
+        self.start = time.perf_counter()
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s=%s' % item for item in sorted(labels.items())))
+
+
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def span(name, parent=None, **labels):
+    """Time the code in a with block, in the default registry."""
+    return _registry.span(name, parent, **labels)
+
+
+def current_span():
+    return _registry.current_span()
+
+
+def traced(name, **labels):
+    """Decorator that runs the function in a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _registry.span(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    """Log the histograms when the process gets signum. Must be called on
+    the main thread."""
+    def handler(signum, frame):
+        # The handler interrupts the main thread, which might hold the lock.
+        threading.Thread(target=_registry.dump, daemon=True).start()
+    signal.signal(signum, handler)
+    logger.info('kill -%d %d to log action timings', signum, os.getpid())
@@ -39,7 +39,7 @@ class ClapTrigger(Trigger):
 
     def add_data(self, data):
         """ audio is mono 16bit signed at 16kHz """
-        audio = np.fromstring(data, 'int16')
+        audio = np.frombuffer(data, 'int16')
         if not self.have_clap:
             # alternative: np.abs(audio).sum() > thresh
             shifted = np.roll(audio, 1)
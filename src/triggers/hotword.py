@@ -0,0 +1,259 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Detect a custom wake word in the audio stream."""
+
+import logging
+import os
+import time
+
+import numpy as np
+
+import kws
+import vad
+from triggers.trigger import Trigger
+
+logger = logging.getLogger('trigger')
+
+
+def hotword_features(data, aggressiveness=2):
+    """Returns the features of the wake word in a recording, or None if there
+    is no speech."""
+    features = kws.utterance_features(data, aggressiveness, normalize=False)
+    if features is None:
+        return None
+    # Only the speech itself, since quiet frames match any noise.
+    pad = kws.SPEECH_PAD_FRAMES
+    return features[pad:len(features) - pad, 1:]
+
+
+def load_hotword(directory, aggressiveness=2):
+    """Returns the features of the wake word recordings in directory and its
+    subdirectories, such as those made with src/kws.py record."""
+    recordings = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.wav'):
+                path = os.path.join(root, name)
+                features = hotword_features(kws.read_wav(path), aggressiveness)
+                if features is None:
+                    raise ValueError('no speech in %s' % path)
+                recordings.append(features)
+    if len(recordings) < 2:
+        raise ValueError('%s needs at least two recordings of the wake word' % directory)
+    return recordings
+
+
+class HotwordDetector(object):
+
+    """Finds the wake word in a stream of audio.
+
+    The audio is aligned with each recording of the wake word by DTW, open at
+    the start, and updated for every 10 ms frame, so the word is detected as
+    soon as it ends. Frames are compared without the energy coefficient and
+    without mean normalization, so the volume doesn't matter, but the
+    recordings should be made with the same microphone.
+
+    To stay within cpu_budget, the fraction of real time it may take, frames
+    are only aligned while the VAD hears speech, and if that is still too slow,
+    only every second or third frame is used.
+
+    Audio is mono 16-bit signed at 16 kHz.
+
+    Args:
+        recordings: features of the recordings, from load_hotword()
+        threshold: how close a match must be, relative to how far apart the
+            recordings are from each other
+        cpu_budget: fraction of real time to use, eg 0.2 for 20% of a core
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    DEFAULT_THRESHOLD = 2.0
+    DEFAULT_CPU_BUDGET = 0.2
+    MAX_STRIDE = 3
+    # Keep aligning for this long after the last speech.
+    SPEECH_HOLD_S = 0.3
+    # Time over which CPU use is averaged.
+    BUDGET_WINDOW_S = 5.0
+
+    def __init__(self, recordings, threshold=DEFAULT_THRESHOLD,
+                 cpu_budget=DEFAULT_CPU_BUDGET, aggressiveness=2):
+        self.threshold = threshold
+        self.cpu_budget = cpu_budget
+
+        templates = kws.Templates()
+        for features in recordings:
+            templates.add('hotword', features)
+        self.scale = templates.get_scale('hotword')
+
+        # Templates for each stride, every stride'th frame of the recordings.
+        self._templates = {}
+        for stride in range(1, self.MAX_STRIDE + 1):
+            strided = [features[::stride] for features in recordings]
+            lengths = np.array([len(features) for features in strided])
+            padded = np.zeros((len(strided), lengths.max(), strided[0].shape[1]), np.float32)
+            for i, features in enumerate(strided):
+                padded[i, :len(features)] = features
+            self._templates[stride] = (padded, lengths,
+                                       np.sum(padded * padded, axis=2)[:, :, None])
+
+        self._mfcc = kws.MfccExtractor()
+        self._vad = vad.VoiceActivityDetector(aggressiveness)
+        self._hold_frames = int(round(self.SPEECH_HOLD_S / self._vad.FRAME_S))
+        self.stride = self._next_stride = 1
+        self.cpu_usage = 0.0
+        self.reset()
+
+    def reset(self):
+        """Forget the audio so far, eg after the wake word was detected."""
+        self._mfcc.reset()
+        self._vad.reset()
+        self._previous = None
+        self._silent_frames = self._hold_frames
+        self._reset_alignment()
+
+    def _reset_alignment(self):
+        padded, _, _ = self._templates[self.stride]
+        self._costs = np.full(padded.shape[:2], np.inf)
+        self._path_lengths = np.zeros(padded.shape[:2])
+        self._stayed = np.zeros(padded.shape[:2], bool)
+        self._frame = 0
+
+    def process(self, data):
+        """Returns True if the wake word ended in this chunk of audio."""
+        start = time.perf_counter()
+        detected = self._process(data)
+        self._update_budget(time.perf_counter() - start, len(data) / (2 * kws.SAMPLE_RATE_HZ))
+        return detected
+
+    def _process(self, data):
+        speech = self._vad.classify(data)
+        if speech.any():
+            self._silent_frames = len(speech) - 1 - int(np.flatnonzero(speech)[-1])
+        else:
+            self._silent_frames += len(speech)
+
+        if self._silent_frames >= self._hold_frames + len(speech):
+            # No speech in this chunk or just before it.
+            self._previous = bytes(data)
+            if self._frame or self.stride != self._next_stride:
+                if self.stride != self._next_stride:
+                    logger.info('wake word detector using %.0f%% CPU, now every %d frames',
+                                100 * self.cpu_usage, self._next_stride)
+                    self.stride = self._next_stride
+                self._mfcc.reset()
+                self._reset_alignment()
+            return False
+
+        features = []
+        if self._previous is not None:
+            # Speech has just started: include the chunk before the onset.
+            features.append(self._mfcc.process(self._previous))
+            self._previous = None
+        features.append(self._mfcc.process(data))
+        features = np.concatenate(features)[:, 1:]
+        return self._align(features)
+
+    def _align(self, features):
+        """Extends the alignments by each frame. Returns True on a match."""
+        padded, lengths, template_norms = self._templates[self.stride]
+        first = (-self._frame) % self.stride
+        self._frame += len(features)
+        features = features[first::self.stride]
+        if not len(features):
+            return False
+
+        # Distance from every template frame to every new frame.
+        costs = (template_norms + np.sum(features * features, axis=1)[None, None, :] -
+                 2 * padded.dot(features.T))
+        costs = np.sqrt(np.maximum(costs, 0))
+
+        ends = np.arange(len(lengths)), lengths - 1
+        detected = False
+        for i in range(len(features)):
+            # Each new frame matches one template frame, which moves on by 1
+            # or 2 frames, or stays put if it didn't last time, from the path
+            # with the lowest mean distance. The first template frame can
+            # also start a new path.
+            frame_costs = costs[:, :, i]
+            prev, prev_lengths = self._costs, self._path_lengths
+            best = np.where(self._stayed, np.inf, prev) + frame_costs
+            best_lengths = prev_lengths + 1
+            best[:, 0] = frame_costs[:, 0]
+            best_lengths[:, 0] = 1
+            stayed = np.isfinite(best)
+            stayed[:, 0] = False
+            for shift in (1, 2):
+                shifted = prev[:, :-shift] + frame_costs[:, shift:]
+                shifted_lengths = prev_lengths[:, :-shift] + 1
+                better = shifted * best_lengths[:, shift:] < best[:, shift:] * shifted_lengths
+                better |= ~np.isfinite(best[:, shift:])
+                best[:, shift:] = np.where(better, shifted, best[:, shift:])
+                best_lengths[:, shift:] = np.where(better, shifted_lengths,
+                                                   best_lengths[:, shift:])
+                stayed[:, shift:] &= ~better
+            self._costs, self._path_lengths, self._stayed = best, best_lengths, stayed
+
+            path_lengths = self._path_lengths[ends]
+            distances = self._costs[ends] / path_lengths
+            distances[path_lengths > 2 * lengths] = np.inf
+            if np.min(distances) <= self.threshold * self.scale:
+                logger.info('wake word distance %.2f (scale %.2f)',
+                            np.min(distances), self.scale)
+                detected = True
+                break
+
+        if detected:
+            self._reset_alignment()
+        return detected
+
+    def _update_budget(self, elapsed, audio_s):
+        weight = min(1.0, audio_s / self.BUDGET_WINDOW_S)
+        self.cpu_usage += weight * (elapsed / audio_s - self.cpu_usage)
+        # The stride changes between words, so no alignment is lost.
+        if self.cpu_usage > self.cpu_budget:
+            self._next_stride = min(self.stride + 1, self.MAX_STRIDE)
+        elif self.stride > 1 and \
+                self.cpu_usage * self.stride / (self.stride - 1) < self.cpu_budget / 2:
+            self._next_stride = self.stride - 1
+
+
+class HotwordTrigger(Trigger):
+
+    """Detect a custom wake word in the audio stream.
+
+    The wake word is enrolled from a few recordings of it, made with
+    src/kws.py record, in hotword_dir.
+    """
+
+    def __init__(self, recorder, hotword_dir, threshold=HotwordDetector.DEFAULT_THRESHOLD,
+                 cpu_budget=HotwordDetector.DEFAULT_CPU_BUDGET):
+        super().__init__()
+
+        self.detector = HotwordDetector(load_hotword(hotword_dir), threshold, cpu_budget)
+        self.have_hotword = True  # don't start yet
+        recorder.add_processor(self)
+
+    def start(self):
+        self.detector.reset()
+        self.have_hotword = False
+
+    def add_data(self, data):
+        """ audio is mono 16bit signed at 16kHz """
+        if not self.have_hotword and self.detector.process(data):
+            logger.info("hotword detected")
+            self.have_hotword = True
+            self.callback()
@@ -0,0 +1,278 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Detect speech in the audio stream, to end requests without waiting for the
+server and to avoid sending the silence before the user speaks."""
+
+import collections
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger('vad')
+
+# Per aggressiveness level 0-3. Higher levels need more energy above the noise
+# floor to count a frame as speech, and wait less silence before ending.
+_MARGIN_DB = [6.0, 9.0, 12.0, 15.0]
+_MAX_ZCR = [0.5, 0.4, 0.35, 0.3]
+_HANGOVER_S = [1.0, 0.8, 0.6, 0.4]
+
+
+class VoiceActivityDetector(object):
+
+    """Classifies 10 ms frames of audio as speech or not.
+
+    A frame is speech if its energy is well above the tracked noise floor and
+    its zero-crossing rate is low enough to be voiced. Very loud frames are
+    speech whatever their zero-crossing rate, so fricatives in the middle of a
+    word don't look like silence.
+
+    Audio is mono 16-bit signed at 16 kHz.
+    """
+
+    FRAME_S = 0.01
+    MIN_ENERGY_DB = 30.0  # about 30 RMS, below this is silence
+    # Upper bound for the first noise floor estimate, in case the user is
+    # already speaking when detection starts. About 180 RMS.
+    MAX_INITIAL_FLOOR_DB = 45.0
+    FLOOR_ADAPT = 0.05
+
+    def __init__(self, aggressiveness=2, sample_rate_hz=16000):
+        if aggressiveness not in range(len(_MARGIN_DB)):
+            raise ValueError('aggressiveness must be 0-%d' % (len(_MARGIN_DB) - 1))
+
+        self.aggressiveness = aggressiveness
+        self.frame_samples = int(self.FRAME_S * sample_rate_hz)
+        self._margin_db = _MARGIN_DB[aggressiveness]
+        self._max_zcr = _MAX_ZCR[aggressiveness]
+        self.reset()
+
+    def reset(self):
+        self._leftover = np.zeros(0, np.int16)
+        self._floor_db = None
+
+    def classify(self, data):
+        """Returns a bool array, True for each complete frame of speech.
+
+        Samples that don't fill a frame are kept for the next call.
+        """
+        samples = np.frombuffer(data, np.int16)
+        if self._leftover.size:
+            samples = np.concatenate((self._leftover, samples))
+
+        count = len(samples) // self.frame_samples
+        frames = samples[:count * self.frame_samples].reshape(count, self.frame_samples)
+        self._leftover = samples[count * self.frame_samples:].copy()
+        if not count:
+            return np.zeros(0, bool)
+
+        frames = frames.astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1.0)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+        if self._floor_db is None:
+            self._floor_db = min(float(np.min(energy_db)), self.MAX_INITIAL_FLOOR_DB)
+
+        threshold_db = max(self._floor_db, self.MIN_ENERGY_DB) + self._margin_db
+        loud = energy_db > threshold_db
+        speech = loud & ((zcr < self._max_zcr) | (energy_db > threshold_db + self._margin_db))
+
+        # Follow the noise floor: down at once, up slowly during non-speech.
+        self._floor_db = min(self._floor_db, float(np.min(energy_db)))
+        if not speech.all():
+            quiet_db = float(np.mean(energy_db[~speech]))
+            self._floor_db += self.FLOOR_ADAPT * (quiet_db - self._floor_db)
+
+        return speech
+
+
+class LocalEndpointer(object):
+
+    """A recorder processor that ends the speech request on local silence.
+
+    Once at least MIN_SPEECH_S of speech has been heard, a run of silence as
+    long as the hangover time ends the request's audio, which also calls its
+    endpointer callback. In shadow mode, it only records when it would have
+    fired, to measure how much earlier than the server it is.
+    """
+
+    MIN_SPEECH_S = 0.2
+
+    def __init__(self, request, aggressiveness=2, shadow=False, hangover_s=None):
+        self._request = request
+        self._vad = VoiceActivityDetector(aggressiveness)
+        self.shadow = shadow
+
+        if hangover_s is None:
+            hangover_s = _HANGOVER_S[aggressiveness]
+        frame_s = self._vad.FRAME_S
+        self._min_speech_frames = int(round(self.MIN_SPEECH_S / frame_s))
+        self._hangover_frames = int(round(hangover_s / frame_s))
+
+        self._leads = []
+        self._missed = 0
+        self.reset()
+
+    def reset(self):
+        """Get ready for a new request."""
+        self._vad.reset()
+        self._speech_frames = 0
+        self._silent_frames = 0
+        self.fired_at = None
+
+    def add_data(self, data):
+        if self.fired_at is not None:
+            return
+
+        speech = self._vad.classify(data)
+        if not speech.size:
+            return
+
+        if speech.any():
+            self._speech_frames += int(np.count_nonzero(speech))
+            self._silent_frames = len(speech) - 1 - int(np.flatnonzero(speech)[-1])
+        else:
+            self._silent_frames += len(speech)
+
+        if self._speech_frames >= self._min_speech_frames and \
+                self._silent_frames >= self._hangover_frames:
+            self.fired_at = time.monotonic()
+            logger.info('local end of speech%s', ' (shadow)' if self.shadow else '')
+            if not self.shadow:
+                self._request.end_of_speech()
+
+    def request_finished(self):
+        """Compare with the server's endpointer, after the request is done."""
+        server = self._request.endpoint_times.get('server')
+        if self.fired_at is None or server is None:
+            self._missed += 1
+            logger.info('local endpointer: no comparison (local %s, server %s)',
+                        'fired' if self.fired_at else 'silent',
+                        'fired' if server else 'silent')
+            return
+
+        lead = server - self.fired_at
+        self._leads.append(lead)
+        logger.info('local endpointer fired %.0f ms before the server', 1000 * lead)
+
+    def get_stats(self):
+        """Returns how much earlier than the server the local endpointer fired.
+
+        Without shadow mode, the server only notices the end of audio after
+        we stop sending it, so the lead is the round trip to the server.
+        """
+        leads = self._leads or [0.0]
+        return {
+            'requests': len(self._leads) + self._missed,
+            'compared': len(self._leads),
+            'mean_lead_ms': 1000 * sum(leads) / len(leads),
+            'max_lead_ms': 1000 * max(leads),
+            'min_lead_ms': 1000 * min(leads),
+        }
+
+
+class LeadingSilenceTrimmer(object):
+
+    """Holds back request audio until speech starts.
+
+    Audio is released from the first chunk with ONSET_S of speech, together
+    with up to lead_in_s of the audio before it, so the server still hears the
+    start of the first word. If no speech starts within max_hold_s, trimming
+    gives up and everything after that is sent, so the server can still decide
+    there was no speech.
+
+    Audio is mono 16-bit signed at 16 kHz.
+    """
+
+    ONSET_S = 0.03
+    BYTES_PER_SECOND = 2 * 16000
+
+    def __init__(self, aggressiveness=2, lead_in_s=0.3, max_hold_s=3.0):
+        self._vad = VoiceActivityDetector(aggressiveness)
+        self._onset_frames = int(round(self.ONSET_S / self._vad.FRAME_S))
+        self._lead_in_bytes = int(lead_in_s * self.BYTES_PER_SECOND)
+        self._max_hold_bytes = int(max_hold_s * self.BYTES_PER_SECOND)
+
+        self._requests = 0
+        self._total_trimmed_bytes = 0
+        self.reset()
+
+    def reset(self):
+        """Get ready for a new request."""
+        self._vad.reset()
+        self._held = collections.deque()
+        self._held_bytes = 0
+        self._seen_bytes = 0
+        self._released = False
+        self.trimmed_bytes = 0
+
+    def process(self, data):
+        """Returns the list of chunks that can be sent now."""
+        if self._released:
+            return [data]
+
+        self._seen_bytes += len(data)
+        onset = self._vad.classify(data).sum() >= self._onset_frames
+        self._held.append(data)
+        self._held_bytes += len(data)
+
+        if onset or self._seen_bytes > self._max_hold_bytes:
+            if not onset:
+                logger.info('no speech after %.1f s, sending audio',
+                            self._seen_bytes / self.BYTES_PER_SECOND)
+            return self._release(len(data) + self._lead_in_bytes)
+
+        # Drop whole chunks that are too old to be part of the lead-in.
+        while self._held_bytes - len(self._held[0]) >= self._lead_in_bytes:
+            self._drop(self._held.popleft())
+        return []
+
+    def _drop(self, chunk):
+        self._held_bytes -= len(chunk)
+        self.trimmed_bytes += len(chunk)
+
+    def _release(self, keep_bytes):
+        self._released = True
+        excess = self._held_bytes - keep_bytes
+        excess -= excess % 2  # whole samples
+        if excess > 0:
+            self._drop(self._held[0])
+            self._held[0] = self._held[0][excess:]
+            self._held_bytes += len(self._held[0])
+            self.trimmed_bytes -= len(self._held[0])
+
+        chunks = list(self._held)
+        self._held.clear()
+        return chunks
+
+    def finish(self):
+        """Called at the end of the request audio. Held audio is discarded."""
+        for chunk in self._held:
+            self._drop(chunk)
+        self._held.clear()
+
+        self._requests += 1
+        self._total_trimmed_bytes += self.trimmed_bytes
+        logger.info('trimmed %.2f s of leading silence',
+                    self.trimmed_bytes / self.BYTES_PER_SECOND)
+
+    def get_stats(self):
+        """Returns the seconds of audio trimmed for the last and all requests."""
+        return {
+            'requests': self._requests,
+            'last_trimmed_s': self.trimmed_bytes / self.BYTES_PER_SECOND,
+            'total_trimmed_s': self._total_trimmed_bytes / self.BYTES_PER_SECOND,
+        }
@@ -1,12 +1,13 @@
 import time
 import signal
-import peewee
+import threading
 import datetime
-from peewee import *
 from miranda import upnp
 import xml.etree.ElementTree as ET
 from contextlib import contextmanager
 
+import tracing
+
 
 WEMO_SERVCE_IP = "192.168.2.12:"
 
@@ -25,6 +26,11 @@ class TimeoutException(Exception): pass
 
 @contextmanager
 def time_limit(seconds):
+    # SIGALRM can only be handled on the main thread. Actions run on other
+    # threads, where the timeout on the SOAP socket stops them instead.
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
     def signal_handler(signum, frame):
         raise TimeoutException ("Timed out!")
     signal.signal(signal.SIGALRM, signal_handler)
@@ -50,8 +56,9 @@ class wemo_device():
         if current_state == "ABC123":
             conn = upnp()
             try:
-                with time_limit(self.timeout_val):
-                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1','http://'+ str(self.ip_address) + '/upnp/control/basicevent1', 'GetBinaryState', {})
+                with tracing.span('wemo', device=self.shortname, op='GetBinaryState'), \
+                        time_limit(self.timeout_val):
+                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1','http://'+ str(self.ip_address) + '/upnp/control/basicevent1', 'GetBinaryState', {}, timeout=self.timeout_val)
                 tree = ET.fromstring(resp)    
                 current_state = tree.find('.//BinaryState').text
                 if str(current_state) != "1" and str(current_state) != "0": current_state = "2"
@@ -68,8 +75,9 @@ class wemo_device():
         if current_state == "0" or current_state == "2":
             conn = upnp()
             try:
-                with time_limit(self.timeout_val):
-                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1', 'http://' + str(self.ip_address) + '/upnp/control/basicevent1', 'SetBinaryState', {'BinaryState': (1, 'Boolean')})
+                with tracing.span('wemo', device=self.shortname, op='SetBinaryState'), \
+                        time_limit(self.timeout_val):
+                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1', 'http://' + str(self.ip_address) + '/upnp/control/basicevent1', 'SetBinaryState', {'BinaryState': (1, 'Boolean')}, timeout=self.timeout_val)
                 #new state is returned in the response...checks current state again to confirm success
                 tree = ET.fromstring(resp)    
                 new_state = tree.find('.//BinaryState').text
@@ -94,8 +102,9 @@ class wemo_device():
         if current_state == "1" or current_state == "2":
             conn = upnp()
             try:
-                with time_limit(self.timeout_val):
-                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1', 'http://' + str(self.ip_address) + '/upnp/control/basicevent1', 'SetBinaryState', {'BinaryState': (0, 'Boolean')})
+                with tracing.span('wemo', device=self.shortname, op='SetBinaryState'), \
+                        time_limit(self.timeout_val):
+                    resp = conn.sendSOAP(str(self.ip_address), 'urn:Belkin:service:basicevent:1', 'http://' + str(self.ip_address) + '/upnp/control/basicevent1', 'SetBinaryState', {'BinaryState': (0, 'Boolean')}, timeout=self.timeout_val)
                 #new state is returned in the response...checks current state again to confirm success
                 tree = ET.fromstring(resp)    
                 new_state = tree.find('.//BinaryState').text
@@ -14,6 +14,8 @@
 
 '''Test the action base classes.'''
 
+import threading
+import time
 import unittest
 
 import actionbase
@@ -28,6 +30,16 @@ class TestAction(object):
         self.voice_command = voice_command
 
 
+class TestCompletableAction(TestAction):
+
+    def __init__(self, complete_commands):
+        super().__init__()
+        self.complete_commands = complete_commands
+
+    def is_complete(self, voice_command):
+        return voice_command in self.complete_commands
+
+
 class TestKeywordHandler(unittest.TestCase):
 
     def test_keyword_phrases(self):
@@ -91,6 +103,213 @@ class TestActor(unittest.TestCase):
         actor.add_keyword('foo', foo_action)
         self.assertIsNone(foo_action.voice_command)
 
+    def test_matched_handler_knows_complete_command(self):
+        actor = actionbase.Actor()
+        action = TestCompletableAction(['turn off the table'])
+        actor.add_keyword('turn off', action)
+        handler = actor.match('turn off the')
+        self.assertFalse(handler.is_complete('turn off the'))
+        self.assertTrue(handler.is_complete('turn off the table'))
+        self.assertIsNone(action.voice_command)
+
+    def test_actions_without_is_complete_are_never_complete(self):
+        actor = actionbase.Actor()
+        action = TestAction()
+        actor.add_keyword('foo', action)
+        self.assertFalse(actor.match('moo foo').is_complete('moo foo'))
+
+    def test_first_added_keyword_wins(self):
+        actor = actionbase.Actor()
+        on_action = TestAction()
+        actor.add_keyword('turn on', on_action)
+        table_action = TestAction()
+        actor.add_keyword('on the table', table_action)
+        self.assertTrue(actor.handle('Turn on the table'))
+        self.assertIsNotNone(on_action.voice_command)
+        self.assertIsNone(table_action.voice_command)
+
+    def test_match_sees_keywords_added_later(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('foo', TestAction())
+        self.assertIsNone(actor.match('moo bar'))
+        actor.add_keyword('bar', TestAction())
+        self.assertIs(actor.match('moo bar'), actor.handlers[1])
+
+
+class TestKeywordMatcher(unittest.TestCase):
+
+    def test_finds_overlapping_keywords(self):
+        matcher = actionbase.KeywordMatcher(['she', 'He', 'hers', 'his', 'is'])
+        self.assertEqual(matcher.find_all('USHERS'), [0, 1, 2])
+        self.assertEqual(matcher.find('this'), 3)
+        self.assertIsNone(matcher.find('no match'))
+
+    def test_matches_substring_search(self):
+        keywords = ['turn on', 'turn off', 'on tv', 'the music', 'music', 'on']
+        matcher = actionbase.KeywordMatcher(keywords)
+        for command in ('turn off the music', 'play on tv', 'turn it on', 'stop'):
+            self.assertEqual(matcher.find_all(command),
+                             [i for i, keyword in enumerate(keywords) if keyword in command])
+
+
+class BlockingAction(object):
+
+    def __init__(self, key=None, timeout=None, log=None):
+        self.key = key
+        if timeout is not None:
+            self.timeout = timeout
+        self.log = log if log is not None else []
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.cancelled = False
+
+    def get_serial_key(self, voice_command):
+        return self.key
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self, voice_command):
+        self.log.append(voice_command)
+        self.started.set()
+        self.release.wait(5)
+
+
+class TestActionExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = actionbase.ActionExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_actor_returns_before_action_finishes(self):
+        actor = actionbase.Actor()
+        actor.set_executor(self.executor)
+        action = BlockingAction()
+        actor.add_keyword('foo', action)
+        self.assertTrue(actor.handle('foo'))
+        self.assertTrue(action.started.wait(5))
+        action.release.set()
+
+    def test_same_key_runs_in_order(self):
+        log = []
+        first = BlockingAction('table', log=log)
+        second = BlockingAction('table', log=log)
+        other = BlockingAction('tv', log=log)
+        jobs = [self.executor.submit(first, 'first'), self.executor.submit(second, 'second'),
+                self.executor.submit(other, 'other')]
+        self.assertTrue(other.started.wait(5))
+        self.assertFalse(second.started.is_set())
+        first.release.set()
+        second.release.set()
+        other.release.set()
+        self.assertEqual([job.wait(5) for job in jobs], ['done'] * 3)
+        self.assertLess(log.index('first'), log.index('second'))
+
+    def test_timeout_cancels_and_frees_key(self):
+        slow = BlockingAction('table', timeout=0.05)
+        fast = BlockingAction('table')
+        fast.release.set()
+        slow_job = self.executor.submit(slow, 'slow')
+        fast_job = self.executor.submit(fast, 'fast')
+        self.assertEqual(slow_job.wait(5), 'timed_out')
+        self.assertTrue(slow.cancelled)
+        self.assertEqual(fast_job.wait(5), 'done')
+        slow.release.set()
+        self.assertEqual(self.executor.get_stats()['timed_out'], 1)
+
+    def test_cancel_pending(self):
+        running = BlockingAction('table')
+        pending = BlockingAction('table')
+        running_job = self.executor.submit(running, 'running')
+        pending_job = self.executor.submit(pending, 'pending')
+        self.assertTrue(running.started.wait(5))
+        self.assertEqual(self.executor.cancel('table'), 2)
+        self.assertEqual(running_job.wait(5), 'cancelled')
+        self.assertEqual(pending_job.wait(5), 'cancelled')
+        self.assertTrue(running.cancelled)
+        running.release.set()
+        time.sleep(0.05)
+        self.assertFalse(pending.started.is_set())
+
+    def test_cancel_can_wait_for_other_threads(self):
+        executor = self.executor
+
+        class SubmittingAction(BlockingAction):
+
+            def cancel(self):
+                # Such as waiting for a device thread that submits an action.
+                undo = BlockingAction()
+                undo.release.set()
+                thread = threading.Thread(target=executor.submit, args=(undo, 'undo'))
+                thread.start()
+                thread.join(5)
+                self.cancelled = not thread.is_alive()
+
+        action = SubmittingAction('table', timeout=0.05)
+        job = self.executor.submit(action, 'slow')
+        self.assertEqual(job.wait(5), 'timed_out')
+        action.release.set()
+        for _ in range(100):
+            if action.cancelled:
+                break
+            time.sleep(0.05)
+        self.assertTrue(action.cancelled)
+
+    def test_drops_when_full(self):
+        executor = actionbase.ActionExecutor(max_workers=1, max_pending=1)
+        self.addCleanup(executor.shutdown)
+        action = BlockingAction()
+        self.assertIsNotNone(executor.submit(action, 'one'))
+        self.assertTrue(action.started.wait(5))
+        self.assertIsNotNone(executor.submit(action, 'two'))
+        self.assertIsNone(executor.submit(action, 'three'))
+        action.release.set()
+
+
+class TestGrammar(unittest.TestCase):
+
+    def make_grammar(self):
+        grammar = actionbase.Grammar()
+        grammar.add_slot('device', {'table': 'Table', 'table lamp': 'Lamp', 'TV': 'TV'})
+        grammar.add_slot('operation', {'play': 'Play', 'volume up': 'Up'})
+        grammar.add_rule('power_on', 'turn on the {device}')
+        grammar.add_rule('tv', '{operation} on TV')
+        return grammar
+
+    def test_parses_intent_and_slots(self):
+        grammar = self.make_grammar()
+        self.assertEqual(grammar.parse('Turn on the  table lamp'),
+                         ('power_on', {'device': 'Lamp'}))
+        self.assertEqual(grammar.parse('turn on the table'), ('power_on', {'device': 'Table'}))
+        self.assertEqual(grammar.parse('volume up on tv'), ('tv', {'operation': 'Up'}))
+
+    def test_needs_whole_command(self):
+        grammar = self.make_grammar()
+        self.assertIsNone(grammar.parse('turn on the'))
+        self.assertIsNone(grammar.parse('turn on the table please'))
+        self.assertIsNone(grammar.parse('turn on the fan'))
+
+    def test_first_rule_wins(self):
+        grammar = self.make_grammar()
+        grammar.add_rule('other', 'turn on the {device}')
+        self.assertEqual(grammar.parse('turn on the TV').intent, 'power_on')
+
+    def test_phrases(self):
+        grammar = self.make_grammar()
+        self.assertEqual(grammar.get_phrases('tv'), ['play on tv', 'volume up on tv'])
+        self.assertEqual(len(grammar.get_phrases()), 5)
+
+    def test_handler_phrases_include_action_phrases(self):
+        grammar = self.make_grammar()
+
+        class TVAction(TestAction):
+            def get_phrases(self):
+                return grammar.get_phrases('tv')
+
+        actor = actionbase.Actor()
+        actor.add_keyword('on TV', TVAction())
+        self.assertEqual(actor.get_phrases(), ['on tv', 'play on tv', 'volume up on tv'])
+
 
 if __name__ == '__main__':
     unittest.main()
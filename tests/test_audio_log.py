@@ -0,0 +1,138 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the audio log writer.'''
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import wave
+
+import audio_log
+
+# 0.1 s of 16-bit mono audio at 16 kHz.
+AUDIO_CHUNK = b'\1\0' * 1600
+
+
+class TestAudioLog(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+
+    def make_log(self, **kwargs):
+        log = audio_log.AudioLog(self.log_dir, **kwargs)
+        self.addCleanup(lambda: log.is_alive() and log.close())
+        return log
+
+    def log_request(self, log, chunks, transcript, response_audio=None):
+        request_log = log.start_request()
+        for _ in range(chunks):
+            request_log.write(AUDIO_CHUNK)
+        request_log.finish(transcript, response_audio)
+
+    def read_index(self):
+        with open(os.path.join(self.log_dir, audio_log.INDEX_FILE)) as index:
+            return [json.loads(line) for line in index]
+
+    def test_writes_request_response_and_index(self):
+        log = self.make_log()
+        self.log_request(log, 5, 'hello', AUDIO_CHUNK)
+        log.close()
+
+        with wave.open(os.path.join(self.log_dir, 'request.001.wav')) as wav:
+            self.assertEqual(wav.getnframes(), 5 * 1600)
+        with wave.open(os.path.join(self.log_dir, 'response.001.wav')) as wav:
+            self.assertEqual(wav.getnframes(), 1600)
+
+        entry, = self.read_index()
+        self.assertEqual(entry['ix'], 1)
+        self.assertEqual(entry['transcript'], 'hello')
+        self.assertAlmostEqual(entry['time'], time.time(), delta=10)
+
+    def test_numbering_continues_after_restart(self):
+        log = self.make_log()
+        self.log_request(log, 1, 'one')
+        log.close()
+
+        log = self.make_log()
+        self.log_request(log, 1, 'two')
+        log.close()
+
+        self.assertEqual([e['ix'] for e in self.read_index()], [1, 2])
+        self.assertTrue(os.path.exists(os.path.join(self.log_dir, 'request.002.wav')))
+
+    def test_rotates_by_size(self):
+        # Each request is a little over 3200 bytes.
+        log = self.make_log(max_bytes=8000)
+        for i in range(4):
+            self.log_request(log, 1, str(i))
+        log.close()
+
+        self.assertEqual([e['transcript'] for e in self.read_index()], ['2', '3'])
+        self.assertEqual(sorted(os.listdir(self.log_dir)), [
+            audio_log.INDEX_FILE, 'request.003.wav', 'request.004.wav'])
+
+    def test_rotates_by_age_but_keeps_newest(self):
+        log = self.make_log(max_age_s=0)
+        self.log_request(log, 1, 'old')
+        self.log_request(log, 1, 'new')
+        log.close()
+
+        self.assertEqual([e['transcript'] for e in self.read_index()], ['new'])
+        self.assertFalse(os.path.exists(os.path.join(self.log_dir, 'request.001.wav')))
+
+    def test_default_size_fits_free_space(self):
+        stat = os.statvfs(self.log_dir)
+        log = self.make_log()
+        self.assertLessEqual(log.max_bytes, audio_log.DEFAULT_MAX_BYTES)
+        self.assertLessEqual(log.max_bytes, stat.f_bavail * stat.f_frsize)
+
+    def test_keeps_total_size(self):
+        log = self.make_log(max_bytes=8000)
+        for i in range(4):
+            self.log_request(log, 1, str(i))
+        log.close()
+
+        sizes = [os.path.getsize(os.path.join(self.log_dir, name))
+                 for name in ('request.003.wav', 'request.004.wav')]
+        self.assertEqual(log.total_bytes, sum(sizes))
+        self.assertEqual([e['bytes'] for e in self.read_index()], sizes)
+
+    def test_rotates_files_left_by_a_crash(self):
+        log = self.make_log()
+        self.log_request(log, 1, 'indexed')
+        log.close()
+        # A request that was still being logged, and a stray response.
+        for name in ('request.002.wav', 'response.005.wav'):
+            with open(os.path.join(self.log_dir, name), 'wb') as f:
+                f.write(AUDIO_CHUNK * 2)
+
+        log = self.make_log(max_bytes=10000)
+        self.assertEqual([e['ix'] for e in self.read_index()], [1, 2, 5])
+        self.assertEqual(log.total_bytes, sum(
+            os.path.getsize(os.path.join(self.log_dir, name))
+            for name in os.listdir(self.log_dir) if name.endswith('.wav')))
+        self.log_request(log, 1, 'new')
+        log.close()
+
+        self.assertEqual([e['ix'] for e in self.read_index()], [5, 6])
+        self.assertFalse(os.path.exists(os.path.join(self.log_dir, 'request.002.wav')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the batch transcription tool against a fake server.'''
+
+import array
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+
+import batch_transcribe
+import fake_speech_server
+
+# 1 s of loud 16-bit mono audio at 16 kHz.
+SECOND = array.array('h', [5000, -5000] * 8000).tobytes()
+
+
+class TestTranscriber(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_wav(self, name, seconds):
+        path = os.path.join(self.tmpdir, name)
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            wav.writeframes(SECOND * seconds)
+        return path
+
+    def test_finds_requests_in_audio_logs(self):
+        for name in ('request.001.wav', 'response.001.wav', 'request.002.wav'):
+            self.write_wav(name, 1)
+        self.assertEqual(batch_transcribe.find_files([self.tmpdir]), [
+            os.path.join(self.tmpdir, 'request.001.wav'),
+            os.path.join(self.tmpdir, 'request.002.wav')])
+
+    def test_sends_all_of_a_long_file(self):
+        server = fake_speech_server.FakeSpeechServer(
+            [fake_speech_server.Script('a long story')])
+        self.addCleanup(server.stop)
+        transcriber = batch_transcribe.Transcriber(1, None, server.start())
+        self.addCleanup(transcriber.shutdown)
+
+        # Longer than the audio a live request keeps queued.
+        path = self.write_wav('long.wav', 15)
+        result = transcriber.submit(path).result(timeout=30)
+
+        self.assertEqual(result['transcript'], 'a long story')
+        self.assertEqual(result['audio_s'], 15)
+        self.assertEqual(server.stats['audio_bytes'], len(SECOND) * 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test finding and connecting to the Chromecast Audio, with a stub
+pychromecast.'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import action_MY
+
+CAST_NAME = 'Test Cast'
+
+
+class FakeCast(object):
+
+    def __init__(self, host, port, name=CAST_NAME, **kwargs):
+        self.host = host
+        self.port = port
+        self.device = types.SimpleNamespace(friendly_name=name)
+        self.socket_client = types.SimpleNamespace(is_connected=True)
+        self.disconnected = False
+
+    def wait(self, timeout=None):
+        pass
+
+    def disconnect(self, blocking=True):
+        self.disconnected = True
+
+
+class TestCastDevice(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_file = os.path.join(self.tmpdir, 'cache', 'chromecast.json')
+
+        self.pychromecast = types.ModuleType('pychromecast')
+        self.pychromecast.PyChromecastError = type('PyChromecastError', (Exception,), {})
+        self.pychromecast.Chromecast = mock.Mock(side_effect=FakeCast)
+        self.pychromecast.get_chromecasts = mock.Mock(return_value=[])
+        patcher = mock.patch.dict(sys.modules, {'pychromecast': self.pychromecast})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_cache(self, text):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as f:
+            f.write(text)
+
+    def make_device(self):
+        device = action_MY.CastDevice(CAST_NAME, self.cache_file)
+        device.DISCOVER_RETRY_S = 0.01
+        return device
+
+    def test_connects_to_cached_address_without_discovery(self):
+        self.write_cache(json.dumps({'name': CAST_NAME, 'host': '10.0.0.2', 'port': 8009}))
+        cast = self.make_device().get(timeout=0)
+        self.assertEqual((cast.host, cast.port), ('10.0.0.2', 8009))
+        self.pychromecast.get_chromecasts.assert_not_called()
+
+    def test_missing_cache_waits_for_discovery(self):
+        device = self.make_device()
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(device.get(timeout=0))
+
+        self.pychromecast.get_chromecasts.return_value = [FakeCast('10.0.0.3', 8009)]
+        device.start_discovery()
+        cast = device.get(timeout=5)
+        self.assertEqual((cast.host, cast.port), ('10.0.0.3', 8009))
+        with open(self.cache_file) as f:
+            self.assertEqual(json.load(f),
+                             {'name': CAST_NAME, 'host': '10.0.0.3', 'port': 8009})
+
+    def test_corrupt_cache_is_ignored(self):
+        self.write_cache('{"name": "Test Ca')
+        device = self.make_device()
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(device.get(timeout=0))
+
+        self.pychromecast.get_chromecasts.return_value = [FakeCast('10.0.0.3', 8009)]
+        device.start_discovery()
+        self.assertEqual(device.get(timeout=5).host, '10.0.0.3')
+        # The cache is usable again after a restart.
+        restarted = action_MY.CastDevice(CAST_NAME, self.cache_file)
+        self.assertEqual(restarted.get(timeout=0).host, '10.0.0.3')
+
+    def test_cache_for_another_device_is_ignored(self):
+        self.write_cache(json.dumps({'name': 'Other Cast', 'host': '10.0.0.2', 'port': 8009}))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(self.make_device().get(timeout=0))
+
+    def test_discovery_tries_again_after_failing(self):
+        found = FakeCast('10.0.0.3', 8009)
+        other = FakeCast('10.0.0.4', 8009, name='Other Cast')
+        self.pychromecast.get_chromecasts.side_effect = [
+            OSError('no network'), [], [other, found]]
+        device = self.make_device()
+        with self.assertLogs(level='WARNING'):
+            device.start_discovery()
+            self.assertIs(device.get(timeout=5), found)
+        self.assertEqual(self.pychromecast.get_chromecasts.call_count, 3)
+        self.assertTrue(other.disconnected)
+        self.assertFalse(found.disconnected)
+
+    def test_reconnects_after_connection_drops(self):
+        self.write_cache(json.dumps({'name': CAST_NAME, 'host': '10.0.0.2', 'port': 8009}))
+        device = self.make_device()
+        first = device.get(timeout=0)
+        self.assertIs(device.get(timeout=0), first)
+
+        first.socket_client.is_connected = False
+        second = device.get(timeout=0)
+        self.assertIsNot(second, first)
+        self.assertTrue(first.disconnected)
+        self.assertEqual((second.host, second.port), ('10.0.0.2', 8009))
+
+    def test_failed_connection_starts_discovery(self):
+        self.write_cache(json.dumps({'name': CAST_NAME, 'host': '10.0.0.2', 'port': 8009}))
+        self.pychromecast.Chromecast.side_effect = self.pychromecast.PyChromecastError()
+        self.pychromecast.get_chromecasts.return_value = [FakeCast('10.0.0.3', 8009)]
+        device = self.make_device()
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(device.get(timeout=0))
+
+        # The device moved: discovery finds it at its new address.
+        for _ in range(100):
+            if device._address == ('10.0.0.3', 8009):
+                break
+            time.sleep(0.05)
+        self.assertEqual(device.get(timeout=0).host, '10.0.0.3')
+
+
+if __name__ == '__main__':
+    unittest.main()
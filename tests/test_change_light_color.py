@@ -18,21 +18,20 @@ class TestChangeLightColor(unittest.TestCase):
     def setUp(self):
         self._say_text = None
 
-    @mock.patch("action.phue")
-    def test_change_light_color_no_bridge(self, mockedPhue):
-        mockedPhue.PhueRegistrationException = phue.PhueRegistrationException
+    @mock.patch("phue.Bridge")
+    def test_change_light_color_no_bridge(self, Bridge):
         bridge = mock.MagicMock()
-        bridge.connect.side_effect = mockedPhue.PhueRegistrationException(0, "error")
-        mockedPhue.Bridge.return_value = bridge
+        bridge.connect.side_effect = phue.PhueRegistrationException(0, "error")
+        Bridge.return_value = bridge
 
         action.ChangeLightColor(self._say, "philips-hue", "Lounge Lamp", "0077be").run()
 
         self.assertEqual(self._say_text,
                          "No bridge registered, press button on bridge and try again")
 
-    @mock.patch("action.phue")
+    @mock.patch("phue.Bridge")
     @mock.patch("action.Converter")
-    def test_change_light_color(self, Converter, mockedPhue):
+    def test_change_light_color(self, Converter, Bridge):
 
         xyValue = [0.1, 0.2]
 
@@ -46,11 +45,11 @@ class TestChangeLightColor(unittest.TestCase):
         }
         bridge = mock.MagicMock()
         bridge.get_light_objects.return_value = lights
-        mockedPhue.Bridge.return_value = bridge
+        Bridge.return_value = bridge
 
         action.ChangeLightColor(self._say, "philips-hue", "Lounge Lamp", "0077be").run()
 
-        mockedPhue.Bridge.assert_called_with("philips-hue")
+        Bridge.assert_called_with("philips-hue")
         bridge.connect.assert_called()
         bridge.get_light_objects.assert_called_with("name")
         self.assertEqual(light.on, True)
@@ -0,0 +1,125 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the custom wake word trigger.'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+
+import numpy as np
+
+from triggers import hotword
+
+RATE = 16000
+CHUNK = 1600
+
+# Tone sequences stand in for spoken words.
+WAKE_WORD = [700, 300, 1100, 500]
+OTHER = [700, 300, 1500, 900]
+
+
+def phrase(freqs, stretch=1.0, seed=0):
+    rand = np.random.RandomState(seed)
+    parts = [np.zeros(int(0.3 * RATE))]
+    for freq in freqs:
+        t = np.arange(int(0.25 * stretch * RATE)) / RATE
+        parts.append(6000 * (np.sin(2 * np.pi * freq * t) + 0.5 * np.sin(4 * np.pi * freq * t)))
+    parts.append(np.zeros(int(0.3 * RATE)))
+    samples = np.concatenate(parts)
+    return (samples + rand.randn(len(samples)) * 100).astype(np.int16).tobytes()
+
+
+def noise(seconds, seed=0):
+    rand = np.random.RandomState(seed)
+    return (rand.randn(int(seconds * RATE)) * 200).astype(np.int16).tobytes()
+
+
+def recordings():
+    return [hotword.hotword_features(phrase(WAKE_WORD, stretch, seed))
+            for seed, stretch in enumerate((0.9, 1.0, 1.1))]
+
+
+def detections(detector, data):
+    found = []
+    for i in range(0, len(data), 2 * CHUNK):
+        if detector.process(data[i:i + 2 * CHUNK]):
+            found.append(i / (2 * RATE))
+    return found
+
+
+class FakeRecorder(object):
+
+    def __init__(self):
+        self.processors = []
+
+    def add_processor(self, processor):
+        self.processors.append(processor)
+
+
+class TestHotwordDetector(unittest.TestCase):
+
+    def test_detects_wake_word_at_its_end(self):
+        detector = hotword.HotwordDetector(recordings())
+        found = detections(detector, noise(2) + phrase(WAKE_WORD, 1.05, seed=5) + noise(2))
+        self.assertEqual(len(found), 1)
+        # The word ends 3.35 s in.
+        self.assertAlmostEqual(found[0], 3.3, delta=0.3)
+
+    def test_ignores_other_words(self):
+        detector = hotword.HotwordDetector(recordings())
+        self.assertEqual(detections(detector, noise(1) + phrase(OTHER, seed=5) + noise(1)), [])
+
+    def test_uses_fewer_frames_over_budget(self):
+        detector = hotword.HotwordDetector(recordings(), cpu_budget=1e-6)
+        detections(detector, (phrase(OTHER, seed=5) + noise(0.5)) * 3)
+        self.assertGreater(detector.stride, 1)
+
+
+class TestHotwordTrigger(unittest.TestCase):
+
+    def setUp(self):
+        self.hotword_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hotword_dir)
+        for seed, stretch in enumerate((0.9, 1.0, 1.1)):
+            with wave.open(os.path.join(self.hotword_dir, '%02d.wav' % seed), 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(RATE)
+                wav.writeframes(phrase(WAKE_WORD, stretch, seed))
+
+    def test_calls_back_once_after_start(self):
+        recorder = FakeRecorder()
+        trigger = hotword.HotwordTrigger(recorder, self.hotword_dir)
+        calls = []
+        trigger.set_callback(lambda: calls.append(True))
+        self.assertEqual(recorder.processors, [trigger])
+
+        data = phrase(WAKE_WORD, seed=7)
+        chunks = [data[i:i + 2 * CHUNK] for i in range(0, len(data), 2 * CHUNK)]
+        for chunk in chunks:
+            trigger.add_data(chunk)
+        self.assertEqual(calls, [])
+
+        # Once started, it only fires until the next start().
+        trigger.start()
+        for chunk in chunks * 2:
+            trigger.add_data(chunk)
+        self.assertEqual(calls, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
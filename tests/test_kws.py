@@ -0,0 +1,131 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test local keyword spotting.'''
+
+import unittest
+
+import numpy as np
+
+import kws
+
+RATE = 16000
+CHUNK = 1600
+
+# Stand-ins for spoken phrases: a tone for each "syllable".
+TABLE = [300, 1200, 600]
+MUSIC = [1000, 400, 1500]
+OTHER = [500, 500, 2000]
+
+
+def phrase(freqs, stretch=1.0, seed=0, silence_s=0.5):
+    rand = np.random.RandomState(seed)
+    parts = [np.zeros(int(silence_s * RATE))]
+    for freq in freqs:
+        t = np.arange(int(0.25 * stretch * RATE)) / RATE
+        parts.append(6000 * (np.sin(2 * np.pi * freq * t) + 0.5 * np.sin(4 * np.pi * freq * t)))
+    parts.append(np.zeros(int(silence_s * RATE)))
+    samples = np.concatenate(parts)
+    samples += rand.randn(len(samples)) * 100
+    return samples.astype(np.int16).tobytes()
+
+
+def chunks(data):
+    return [data[i:i + 2 * CHUNK] for i in range(0, len(data), 2 * CHUNK)]
+
+
+def make_templates():
+    templates = kws.Templates()
+    for name, freqs in (('turn on the table', TABLE), ('my music play', MUSIC)):
+        for seed, stretch in enumerate((0.9, 1.1)):
+            templates.add(name, kws.utterance_features(phrase(freqs, stretch, seed)))
+    return templates
+
+
+class TestMfcc(unittest.TestCase):
+
+    def test_streaming_matches_whole(self):
+        data = phrase(TABLE)
+        whole = kws.MfccExtractor().process(data)
+        extractor = kws.MfccExtractor()
+        streamed = np.concatenate([extractor.process(chunk) for chunk in chunks(data)])
+        frames = (len(data) // 2 - kws.FRAME_SAMPLES) // kws.HOP_SAMPLES + 1
+        self.assertEqual(whole.shape, (frames, kws.NUM_CEPSTRA))
+        np.testing.assert_allclose(streamed, whole, rtol=1e-3, atol=1e-3)
+
+    def test_trims_silence(self):
+        features = kws.utterance_features(phrase(TABLE, silence_s=1.0))
+        # 0.75 s of tones, padded either side.
+        self.assertLess(abs(len(features) - 75 - 2 * kws.SPEECH_PAD_FRAMES), 5)
+        self.assertIsNone(kws.utterance_features(np.zeros(RATE, np.int16).tobytes()))
+
+
+class TestTemplates(unittest.TestCase):
+
+    def test_dtw_allows_stretching(self):
+        template = kws.utterance_features(phrase(TABLE))
+        lengths = np.array([len(template)])
+        stretched = kws.utterance_features(phrase(TABLE, 1.4, seed=1))
+        other = kws.utterance_features(phrase(MUSIC, 1.4, seed=1))
+        distance = kws.dtw_distances(template[None], lengths, stretched)[0]
+        self.assertLess(distance, 3)
+        self.assertGreater(kws.dtw_distances(template[None], lengths, other)[0],
+                           3 * distance)
+
+    def test_match(self):
+        templates = make_templates()
+        phrase_, distance, scale, runner_up = templates.match(
+            kws.utterance_features(phrase(MUSIC, 1.2, seed=5)))
+        self.assertEqual(phrase_, 'my music play')
+        self.assertLess(distance, kws.DEFAULT_THRESHOLD * scale)
+        self.assertLess(distance, kws.DEFAULT_MARGIN * runner_up)
+
+    def test_needs_two_recordings(self):
+        templates = kws.Templates()
+        templates.add('hello', kws.utterance_features(phrase(TABLE)))
+        with self.assertRaises(ValueError):
+            templates.prepare()
+
+
+class TestKeywordSpotter(unittest.TestCase):
+
+    def run_spotter(self, data, shadow=False):
+        heard = []
+        spotter = kws.KeywordSpotter(make_templates(), heard.append, shadow=shadow)
+        for chunk in chunks(data):
+            spotter.add_data(chunk)
+        spotter.end_of_utterance()
+        return spotter, heard
+
+    def test_matches_after_end_of_speech(self):
+        spotter, heard = self.run_spotter(phrase(TABLE, 1.1, seed=3) + phrase(MUSIC))
+        # Decided on the first phrase, and ignored the rest.
+        self.assertEqual(heard, ['turn on the table'])
+        spotter.request_finished('turn on the table')
+        self.assertEqual(spotter.get_stats()['agreed'], 1)
+
+    def test_rejects_unknown_phrase(self):
+        spotter, heard = self.run_spotter(phrase(OTHER, seed=3))
+        self.assertEqual(heard, [])
+        self.assertTrue(spotter.decided)
+        self.assertIsNone(spotter.phrase)
+
+    def test_shadow_does_not_call_back(self):
+        spotter, heard = self.run_spotter(phrase(MUSIC, seed=3), shadow=True)
+        self.assertEqual(heard, [])
+        self.assertEqual(spotter.phrase, 'my music play')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the recognition loop in main.py against a fake speech server.'''
+
+import threading
+import unittest
+from unittest import mock
+
+import actionbase
+import fake_speech_server
+import speech
+
+try:
+    import main
+except ImportError:
+    main = None
+
+# 0.1 s of 16-bit mono audio at 16 kHz.
+AUDIO_CHUNK = b'\0' * 3200
+
+
+class FakeRecorder(object):
+
+    """Sends a second of audio to each processor as it is added."""
+
+    def add_processor(self, processor, preroll=False, name=None):
+        for _ in range(10):
+            processor.add_data(AUDIO_CHUNK)
+
+    def remove_processor(self, processor):
+        pass
+
+    def get_dispatch_stats(self):
+        return {}
+
+
+class FakeTrigger(object):
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    def start(self):
+        pass
+
+
+class FakeStatusUi(object):
+
+    def __init__(self):
+        self.ready = threading.Semaphore(0)
+
+    def status(self, status):
+        if status == 'ready':
+            self.ready.release()
+
+
+class TestAction(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def run(self, voice_command):
+        self.commands.append(voice_command)
+
+
+@unittest.skipIf(main is None, "can't import main")
+class TestSyncMicRecognizer(unittest.TestCase):
+
+    def test_recognizes_with_local_server(self):
+        server = fake_speech_server.FakeSpeechServer(
+            [fake_speech_server.Script('hello', endpoint_after_s=0.5)])
+        self.addCleanup(server.stop)
+        recognizer = speech.CloudSpeechRequest(None, server.start())
+
+        actor = actionbase.Actor()
+        action = TestAction()
+        actor.add_keyword('hello', action)
+        status_ui = FakeStatusUi()
+        mic_recognizer = main.SyncMicRecognizer(
+            actor, recognizer, FakeRecorder(), mock.Mock(), mock.Mock(), FakeTrigger(),
+            status_ui, False)
+
+        with mic_recognizer:
+            self.assertTrue(status_ui.ready.acquire(timeout=5))
+            # The recognizer thread keeps going after each request.
+            for _ in range(2):
+                mic_recognizer.recognize()
+                self.assertTrue(status_ui.ready.acquire(timeout=10))
+        self.assertEqual(action.commands, ['hello', 'hello'])
+
+
+if __name__ == '__main__':
+    unittest.main()
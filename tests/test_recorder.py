@@ -0,0 +1,314 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test chunk assembly in the recorder.'''
+
+import io
+import threading
+import unittest
+
+import aiy._drivers._recorder
+
+CHUNK_BYTES = 3200
+
+
+class ShortReads(io.RawIOBase):
+
+    """A stream that returns at most read_size bytes per call, like a pipe."""
+
+    def __init__(self, data, read_size):
+        super().__init__()
+        self._data = io.BytesIO(data)
+        self._read_size = read_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        return self._data.readinto(memoryview(buf)[:self._read_size])
+
+
+class KeepingProcessor(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def add_data(self, data):
+        self.chunks.append(data)
+
+
+class CopyingProcessor(KeepingProcessor):
+
+    def add_data(self, data):
+        self.chunks.append(bytes(data))
+
+
+def make_audio(chunks):
+    return b''.join(bytes([i % 256]) * CHUNK_BYTES for i in range(chunks))
+
+
+class TestRecorder(unittest.TestCase):
+
+    def capture(self, data, *processors, read_size=CHUNK_BYTES, as_bytes=False):
+        recorder = aiy._drivers._recorder.Recorder()
+        for processor in processors:
+            recorder.add_processor(processor, as_bytes=as_bytes)
+        recorder._capture(ShortReads(data, read_size))
+        return recorder
+
+    def test_chunks_are_read_only_views(self):
+        processor = KeepingProcessor()
+        self.capture(make_audio(1), processor)
+        self.assertIsInstance(processor.chunks[0], memoryview)
+        self.assertTrue(processor.chunks[0].readonly)
+
+    def test_chunks_assembled_from_short_reads(self):
+        data = make_audio(3)
+        processor = CopyingProcessor()
+        self.capture(data, processor, read_size=1000)
+        self.assertEqual(b''.join(processor.chunks), data)
+        self.assertEqual([len(c) for c in processor.chunks], [CHUNK_BYTES] * 3)
+
+    def test_partial_trailing_chunk_is_dropped(self):
+        processor = CopyingProcessor()
+        self.capture(make_audio(2) + b'\x00' * 100, processor)
+        self.assertEqual(len(processor.chunks), 2)
+
+    def test_ring_wraps_around(self):
+        chunks = aiy._drivers._recorder.Recorder.RING_CHUNKS + 3
+        data = make_audio(chunks)
+        processor = CopyingProcessor()
+        self.capture(data, processor)
+        self.assertEqual(b''.join(processor.chunks), data)
+
+    def test_as_bytes_processor_can_keep_chunks(self):
+        chunks = aiy._drivers._recorder.Recorder.RING_CHUNKS + 1
+        data = make_audio(chunks)
+        processor = KeepingProcessor()
+        self.capture(data, processor, as_bytes=True)
+        self.assertIsInstance(processor.chunks[0], bytes)
+        self.assertEqual(b''.join(processor.chunks), data)
+
+    def test_remove_processor(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        processor = KeepingProcessor()
+        recorder.add_processor(processor)
+        recorder.remove_processor(processor)
+        recorder._capture(ShortReads(make_audio(1), CHUNK_BYTES))
+        self.assertEqual(processor.chunks, [])
+
+
+class TestPreroll(unittest.TestCase):
+
+    def test_preroll_disabled_by_default(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder._capture(ShortReads(make_audio(5), CHUNK_BYTES))
+        processor = CopyingProcessor()
+        recorder.add_processor(processor, preroll=True)
+        self.assertEqual(processor.chunks, [])
+
+    def test_preroll_has_most_recent_chunks(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_preroll_duration(0.3)
+        data = make_audio(20)
+        recorder._capture(ShortReads(data, CHUNK_BYTES))
+        self.assertEqual(recorder.get_preroll(), data[-3 * CHUNK_BYTES:])
+
+    def test_preroll_shorter_than_recording(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_preroll_duration(0.5)
+        data = make_audio(2)
+        recorder._capture(ShortReads(data, CHUNK_BYTES))
+        self.assertEqual(recorder.get_preroll(), data)
+
+    def test_long_preroll_grows_ring(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        chunks = aiy._drivers._recorder.Recorder.RING_CHUNKS * 2
+        recorder.set_preroll_duration(chunks * recorder.CHUNK_S)
+        data = make_audio(chunks + 5)
+        recorder._capture(ShortReads(data, CHUNK_BYTES))
+        self.assertEqual(recorder.get_preroll(), data[-chunks * CHUNK_BYTES:])
+
+    def test_add_processor_prepends_preroll(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_preroll_duration(0.2)
+        first = make_audio(4)
+        recorder._capture(ShortReads(first, CHUNK_BYTES))
+        processor = CopyingProcessor()
+        recorder.add_processor(processor, preroll=True)
+        second = make_audio(2)
+        recorder._capture(ShortReads(second, CHUNK_BYTES))
+        self.assertEqual(processor.chunks[0], first[-2 * CHUNK_BYTES:])
+        self.assertEqual(b''.join(processor.chunks[1:]), second)
+        self.assertEqual(recorder.get_preroll(), second)
+
+    def test_preroll_is_delivered_outside_the_lock(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_preroll_duration(0.2)
+        recorder._capture(ShortReads(make_audio(4), CHUNK_BYTES))
+        processor = BlockedProcessor()
+        adding = threading.Thread(
+            target=recorder.add_processor, args=(processor,), kwargs={'preroll': True},
+            daemon=True)
+        adding.start()
+        self.assertTrue(processor.started.wait(5))
+
+        # The recorder isn't locked while the processor takes the preroll...
+        reader = threading.Thread(target=recorder.get_preroll, daemon=True)
+        reader.start()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        # ...but live chunks wait for it.
+        live = make_audio(2)
+        capture = threading.Thread(
+            target=recorder._capture, args=(ShortReads(live, CHUNK_BYTES),), daemon=True)
+        capture.start()
+        capture.join(0.2)
+        self.assertTrue(capture.is_alive())
+
+        processor.release.set()
+        adding.join(5)
+        capture.join(5)
+        self.assertFalse(capture.is_alive())
+        self.assertEqual(len(processor.chunks), 3)
+        self.assertEqual(b''.join(processor.chunks[1:]), live)
+
+
+class BlockedProcessor(CopyingProcessor):
+
+    """Blocks in add_data until released, like a stalled SD card write."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def add_data(self, data):
+        self.started.set()
+        self.release.wait()
+        super().add_data(data)
+
+
+class TestThreadedDispatch(unittest.TestCase):
+
+    def test_processor_gets_all_chunks(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_threaded_dispatch(queue_chunks=4, overrun_policy='block')
+        processor = CopyingProcessor()
+        recorder.add_processor(processor)
+        worker = recorder._processors[0][1]
+        data = make_audio(aiy._drivers._recorder.Recorder.RING_CHUNKS + 2)
+        recorder._capture(ShortReads(data, CHUNK_BYTES))
+        recorder.remove_processor(processor)
+        worker.join()
+
+        self.assertEqual(b''.join(processor.chunks), data)
+        stats = recorder.get_dispatch_stats()['CopyingProcessor']
+        self.assertEqual(stats['chunks'], len(processor.chunks))
+        self.assertEqual(stats['dropped'], 0)
+
+    def test_slow_processor_drops_instead_of_stalling(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_threaded_dispatch(queue_chunks=2)
+        processor = BlockedProcessor()
+        recorder.add_processor(processor)
+        recorder._capture(ShortReads(make_audio(10), CHUNK_BYTES))
+
+        stats = recorder.get_dispatch_stats()['BlockedProcessor']
+        # Two chunks are queued, and maybe one is held by the blocked worker.
+        self.assertGreaterEqual(stats['dropped'], 7)
+        self.assertEqual(stats['max_queue_depth'], 2)
+        processor.release.set()
+
+    def test_removing_blocked_processor_unblocks_capture(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_threaded_dispatch(queue_chunks=2, overrun_policy='block')
+        processor = BlockedProcessor()
+        recorder.add_processor(processor)
+        worker = recorder._processors[0][1]
+        capture = threading.Thread(
+            target=recorder._capture, args=(ShortReads(make_audio(10), CHUNK_BYTES),))
+        capture.start()
+        # The worker holds one chunk and the capture thread waits for room.
+        self.assertTrue(processor.started.wait(5))
+        for _ in range(500):
+            if worker._queue.full():
+                break
+            threading.Event().wait(0.01)
+
+        recorder.remove_processor(processor)
+        capture.join(5)
+        self.assertFalse(capture.is_alive())
+        processor.release.set()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        # Only the chunk it was blocked on, none of the stale queued ones.
+        self.assertEqual(len(processor.chunks), 1)
+
+    def test_chunks_after_removal_are_dropped(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_threaded_dispatch(queue_chunks=4)
+        processor = CopyingProcessor()
+        recorder.add_processor(processor)
+        worker = recorder._processors[0][1]
+        recorder.remove_processor(processor)
+        # The capture thread can still hold the old list of processors.
+        worker.add_data(make_audio(1))
+        worker.join(5)
+        self.assertEqual(processor.chunks, [])
+
+    def test_stats_are_kept_per_processor(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.set_threaded_dispatch(queue_chunks=4, overrun_policy='block')
+        first, second, third = CopyingProcessor(), CopyingProcessor(), CopyingProcessor()
+        recorder.add_processor(first)
+        recorder._capture(ShortReads(make_audio(1), CHUNK_BYTES))
+        recorder.add_processor(second)
+        recorder.add_processor(third, name='named')
+        recorder._capture(ShortReads(make_audio(2), CHUNK_BYTES))
+        workers = [sink for _, sink, _ in recorder._processors]
+        for processor in (first, second, third):
+            recorder.remove_processor(processor)
+        for worker in workers:
+            worker.join(5)
+
+        stats = recorder.get_dispatch_stats()
+        self.assertEqual(sorted(stats), ['CopyingProcessor', 'CopyingProcessor-2', 'named'])
+        self.assertEqual(stats['CopyingProcessor']['chunks'], 3)
+        self.assertEqual(stats['CopyingProcessor-2']['chunks'], 2)
+        self.assertEqual(stats['named']['chunks'], 2)
+
+        # A new processor under a free name continues its counters.
+        fourth = CopyingProcessor()
+        recorder.add_processor(fourth, name='named')
+        worker = recorder._processors[0][1]
+        recorder._capture(ShortReads(make_audio(1), CHUNK_BYTES))
+        recorder.remove_processor(fourth)
+        worker.join(5)
+        self.assertEqual(recorder.get_dispatch_stats()['named']['chunks'], 3)
+
+    def test_inline_dispatch_has_no_stats(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        recorder.add_processor(CopyingProcessor())
+        recorder._capture(ShortReads(make_audio(2), CHUNK_BYTES))
+        self.assertEqual(recorder.get_dispatch_stats(), {})
+
+    def test_unknown_overrun_policy(self):
+        recorder = aiy._drivers._recorder.Recorder()
+        with self.assertRaises(ValueError):
+            recorder.set_threaded_dispatch(overrun_policy='shrug')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the recorder's audio sources.'''
+
+import os
+import tempfile
+import time
+import unittest
+import wave
+
+import aiy._drivers._recorder
+import aiy._drivers._sources as sources
+
+
+def read_all(stream, size=3200):
+    data = bytearray()
+    buf = bytearray(size)
+    while True:
+        count = stream.readinto(memoryview(buf))
+        if not count:
+            return bytes(data)
+        data += buf[:count]
+
+
+class CopyingProcessor(object):
+
+    def __init__(self):
+        self.data = b''
+
+    def add_data(self, data):
+        self.data += bytes(data)
+
+
+class TestSources(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.audio = bytes(range(256)) * 25
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_wav(self, rate=16000):
+        path = os.path.join(self.dir.name, 'test.wav')
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes(self.audio)
+        return path
+
+    def test_wav_file(self):
+        source = sources.make_source('file:' + self.write_wav(), realtime=False)
+        self.assertEqual(read_all(source.open()), self.audio)
+
+    def test_raw_file(self):
+        path = os.path.join(self.dir.name, 'test.raw')
+        with open(path, 'wb') as f:
+            f.write(self.audio)
+        source = sources.make_source('file:' + path, realtime=False)
+        self.assertEqual(read_all(source.open()), self.audio)
+
+    def test_looped_file_repeats(self):
+        source = sources.make_source('loop:' + self.write_wav(), realtime=False)
+        stream = source.open()
+        buf = bytearray(len(self.audio) * 3)
+        count = 0
+        while count < len(buf):
+            count += stream.readinto(memoryview(buf)[count:])
+        self.assertEqual(bytes(buf), self.audio * 3)
+        self.assertFalse(source.FINITE)
+
+    def test_closed_files_read_nothing(self):
+        raw_path = os.path.join(self.dir.name, 'test.raw')
+        with open(raw_path, 'wb') as f:
+            f.write(self.audio)
+        for path in (self.write_wav(), raw_path):
+            source = sources.make_source('loop:' + path, realtime=False)
+            stream = source.open()
+            source.close()
+            self.assertEqual(stream.readinto(bytearray(100)), 0)
+
+    def test_finite_sources(self):
+        path = self.write_wav()
+        self.assertTrue(sources.make_source('file:' + path).FINITE)
+        self.assertFalse(sources.make_source('loop:' + path).FINITE)
+        self.assertTrue(sources.SyntheticSource('tone', duration=1).FINITE)
+        self.assertFalse(sources.SyntheticSource('tone').FINITE)
+
+    def test_wav_with_wrong_rate_is_rejected(self):
+        source = sources.make_source('file:' + self.write_wav(rate=8000))
+        with self.assertRaises(ValueError):
+            source.open()
+
+    def test_realtime_is_paced(self):
+        source = sources.SyntheticSource('silence', duration=0.3)
+        start = time.monotonic()
+        data = read_all(source.open())
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        self.assertEqual(len(data), 0.3 * 16000 * 2)
+
+    def test_free_running_is_faster_than_realtime(self):
+        source = sources.SyntheticSource('speech', duration=30, realtime=False)
+        start = time.monotonic()
+        data = read_all(source.open())
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(len(data), 30 * 16000 * 2)
+
+    def test_synthetic_signals(self):
+        for signal in sources.SyntheticSource.SIGNALS:
+            source = sources.SyntheticSource(signal, duration=0.1, realtime=False)
+            self.assertEqual(len(read_all(source.open())), 3200)
+
+    def test_unknown_specs(self):
+        for spec in ('bogus', 'file', 'synthetic:bogus'):
+            with self.assertRaises(ValueError):
+                sources.make_source(spec)
+
+    def test_source_without_stream_cannot_be_created(self):
+        class NoStream(sources._PacedSource):  # pylint: disable=protected-access
+            pass
+
+        with self.assertRaises(TypeError):
+            NoStream()
+
+    def test_arecord_device(self):
+        source = sources.make_source('arecord:hw:1,0')
+        self.assertIn('hw:1,0', str(source))
+        self.assertFalse(source.FINITE)
+
+    def test_recorder_reads_source_to_end(self):
+        source = sources.make_source('file:' + self.write_wav(), realtime=False)
+        recorder = aiy._drivers._recorder.Recorder(source=source)
+        processor = CopyingProcessor()
+        recorder.add_processor(processor)
+        recorder.start()
+        recorder.join()
+        whole_chunks = len(self.audio) // 3200 * 3200
+        self.assertEqual(processor.data, self.audio[:whole_chunks])
+
+
+if __name__ == '__main__':
+    unittest.main()
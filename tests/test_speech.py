@@ -0,0 +1,396 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test speech requests against the fake speech server.'''
+
+import array
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import grpc
+
+import audio_log
+import fake_speech_server
+import speech
+
+# 0.1 s of 16-bit mono audio at 16 kHz.
+AUDIO_CHUNK = b'\0' * 3200
+LOUD_CHUNK = array.array('h', [5000, -5000] * 800).tobytes()
+
+
+class TestAudioQueue(unittest.TestCase):
+
+    def test_sends_single_chunks_when_not_behind(self):
+        audio_queue = speech._AudioQueue(10 * 3200, 5 * 3200)
+        audio_queue.put(AUDIO_CHUNK)
+        self.assertEqual(audio_queue.get_batch(), (AUDIO_CHUNK, False))
+
+    def test_merges_queued_chunks_up_to_batch_size(self):
+        audio_queue = speech._AudioQueue(10 * 3200, 3 * 3200)
+        for _ in range(4):
+            audio_queue.put(AUDIO_CHUNK)
+        audio_queue.put(None)
+        self.assertEqual(audio_queue.get_batch(), (AUDIO_CHUNK * 3, False))
+        self.assertEqual(audio_queue.get_batch(), (AUDIO_CHUNK, True))
+
+        stats = audio_queue.get_stats()
+        self.assertEqual(stats['messages'], 2)
+        self.assertEqual(stats['max_batch_chunks'], 3)
+        self.assertEqual(stats['max_depth_chunks'], 5)
+
+    def test_drops_oldest_silence_when_full(self):
+        audio_queue = speech._AudioQueue(3 * 3200, 10 * 3200)
+        audio_queue.put(LOUD_CHUNK)
+        audio_queue.put(AUDIO_CHUNK)
+        audio_queue.put(LOUD_CHUNK)
+        audio_queue.put(LOUD_CHUNK)
+        self.assertEqual(audio_queue.get_batch(), (LOUD_CHUNK * 3, False))
+
+        audio_queue.put(LOUD_CHUNK)
+        self.assertEqual(audio_queue.get_stats()['dropped_silence'], 1)
+        self.assertEqual(audio_queue.get_stats()['dropped_speech'], 0)
+
+    def test_drops_oldest_speech_without_silence(self):
+        audio_queue = speech._AudioQueue(2 * 3200, 10 * 3200)
+        for _ in range(3):
+            audio_queue.put(LOUD_CHUNK)
+        audio_queue.put(None)
+        self.assertEqual(audio_queue.get_batch(), (LOUD_CHUNK * 2, True))
+        self.assertEqual(audio_queue.get_stats()['dropped_speech'], 1)
+
+    def test_keeps_everything_without_limit(self):
+        audio_queue = speech._AudioQueue(None, 3 * 3200)
+        for _ in range(200):
+            audio_queue.put(LOUD_CHUNK)
+        self.assertEqual(audio_queue.get_batch(), (LOUD_CHUNK * 3, False))
+        stats = audio_queue.get_stats()
+        self.assertEqual(stats['dropped_silence'] + stats['dropped_speech'], 0)
+        self.assertEqual(stats['max_depth_chunks'], 200)
+
+
+class CountingTrimmer(object):
+
+    """Sends all audio, and records how it was called."""
+
+    def __init__(self, request):
+        self.request = request
+        self.processed = 0
+        self.finished = 0
+        self.lock_held = False
+
+    def reset(self):
+        pass
+
+    def process(self, data):
+        self.processed += 1
+        # The capture thread must be able to queue audio meanwhile.
+        thread = threading.Thread(target=self._check_lock)
+        thread.start()
+        thread.join()
+        return [data]
+
+    def _check_lock(self):
+        lock = self.request._utterance_lock
+        if lock.acquire(False):
+            lock.release()
+        else:
+            self.lock_held = True
+
+    def finish(self):
+        self.finished += 1
+
+
+class SpeechTestCase(unittest.TestCase):
+
+    def start_server(self, *scripts, assistant_scripts=None):
+        server = fake_speech_server.FakeSpeechServer(
+            list(scripts), assistant_scripts=assistant_scripts)
+        self.addCleanup(server.stop)
+        return server, server.start()
+
+    @staticmethod
+    def send_audio(request, seconds):
+        request.reset()
+        for _ in range(int(seconds * 10)):
+            request.add_data(AUDIO_CHUNK)
+        request.end_audio()
+
+
+class TestCloudSpeechRequest(SpeechTestCase):
+
+    def test_returns_transcript(self):
+        _, target = self.start_server(fake_speech_server.Script('turn on the light'))
+        request = speech.CloudSpeechRequest(None, target)
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'turn on the light')
+
+    def test_local_server_has_no_credentials_to_expire(self):
+        request = speech.CloudSpeechRequest(None, 'localhost:1')
+        self.assertIsNone(request.seconds_until_credentials_expire())
+
+    def test_server_endpointer_ends_audio(self):
+        server, target = self.start_server(
+            fake_speech_server.Script('hello', endpoint_after_s=0.5))
+        request = speech.CloudSpeechRequest(None, target)
+        ended = []
+        request.set_endpointer_cb(lambda: ended.append(True))
+        self.send_audio(request, 2)
+        self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertEqual(ended, [True])
+        self.assertIn('server', request.endpoint_times)
+        self.assertLess(server.stats['audio_bytes'], 2 * 32000)
+
+    def test_local_and_server_endpoints_end_audio_once(self):
+        request = speech.CloudSpeechRequest(None, 'localhost:1')
+        ended = []
+        request.set_endpointer_cb(lambda: ended.append(True))
+        request.reset()
+        barrier = threading.Barrier(8)
+
+        def end(source):
+            barrier.wait()
+            request._end_audio_request(source)
+
+        threads = [threading.Thread(target=end, args=(source,))
+                   for source in ['local', 'server'] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(ended, [True])
+        self.assertEqual(set(request.endpoint_times), {'local', 'server'})
+        # One end of the audio in the queue.
+        self.assertEqual(request._audio_queue.get_batch(), (b'', True))
+
+    def test_partial_transcript_needs_stability(self):
+        _, target = self.start_server(fake_speech_server.Script(
+            'turn off the table',
+            interim=[(0.2, 'turn off', 0.1), (0.4, 'turn off the table', 0.9)]))
+        request = speech.CloudSpeechRequest(None, target)
+        partials = []
+        request.set_partial_transcript_cb(lambda text: partials.append(text) or True)
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'turn off the table')
+        self.assertEqual(partials, ['turn off the table'])
+
+    def test_injected_error_raises(self):
+        server, target = self.start_server(
+            fake_speech_server.Script(error='UNAVAILABLE', error_after_s=0.2),
+            fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        request.set_retry_policy(0, 0)
+        self.send_audio(request, 1)
+        with self.assertRaises(speech.Error):
+            request.do_request()
+        self.assertEqual(server.stats['errors'], 1)
+
+        # The next script succeeds, on a new channel.
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'hello')
+
+    def test_retry_sends_utterance_again(self):
+        server, target = self.start_server(
+            fake_speech_server.Script(error='UNAVAILABLE', error_after_s=0.5),
+            fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertEqual(server.stats['speech'], 2)
+        # Half a second before the error, then all of it again.
+        self.assertEqual(server.stats['audio_bytes'], 16000 + 32000)
+
+    def test_retry_trims_audio_once(self):
+        _, target = self.start_server(
+            fake_speech_server.Script(error='UNAVAILABLE', error_after_s=0.5),
+            fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        trimmer = CountingTrimmer(request)
+        request.set_trimmer(trimmer)
+        request.set_audio_batching(0.1, 10)
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertEqual(trimmer.processed, 10)
+        self.assertEqual(trimmer.finished, 1)
+        self.assertFalse(trimmer.lock_held)
+
+    def test_retry_budget(self):
+        server, target = self.start_server(
+            fake_speech_server.Script(error='UNAVAILABLE'))
+        request = speech.CloudSpeechRequest(None, target)
+        request.set_retry_policy(2, 10)
+        self.send_audio(request, 1)
+        with self.assertRaises(speech.Error):
+            request.do_request()
+        self.assertEqual(server.stats['speech'], 3)
+
+    def test_no_retry_for_other_errors(self):
+        server, target = self.start_server(
+            fake_speech_server.Script(error='INVALID_ARGUMENT'))
+        request = speech.CloudSpeechRequest(None, target)
+        self.send_audio(request, 1)
+        with self.assertRaises(speech.Error):
+            request.do_request()
+        self.assertEqual(server.stats['speech'], 1)
+
+    def test_audio_logging(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        log = audio_log.AudioLog(log_dir)
+        _, target = self.start_server(fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        request.set_audio_logging_enabled(True, log)
+        self.send_audio(request, 1)
+        request.do_request()
+        log.close()
+
+        with open(os.path.join(log_dir, audio_log.INDEX_FILE)) as index:
+            entry = json.loads(index.readline())
+        self.assertEqual(entry['transcript'], 'hello')
+        self.assertEqual(os.path.getsize(os.path.join(log_dir, entry['request'])),
+                         44 + 10 * len(AUDIO_CHUNK))
+
+
+class TestChannel(SpeechTestCase):
+
+    def setUp(self):
+        # Errors on gRPC's threads, such as polling a closed channel.
+        self.thread_errors = []
+        excepthook = threading.excepthook
+        threading.excepthook = self.thread_errors.append
+        self.addCleanup(setattr, threading, 'excepthook', excepthook)
+
+    def test_requests_share_channel(self):
+        server, target = self.start_server(fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        for _ in range(3):
+            self.send_audio(request, 0.5)
+            self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertEqual(server.stats['speech'], 3)
+        self.assertEqual(server.stats['connections'], 1)
+
+    def test_warm_up_connects_before_request(self):
+        server, target = self.start_server(fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        request.warm_up()
+        channel = request._channel_factory.make_channel()
+        grpc.channel_ready_future(channel).result(timeout=5)
+        self.assertEqual(server.stats['speech'], 0)
+
+        self.send_audio(request, 0.5)
+        self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertIs(request._channel_factory.make_channel(), channel)
+
+    def test_reset_channel_reconnects(self):
+        server, target = self.start_server(fake_speech_server.Script('hello'))
+        request = speech.CloudSpeechRequest(None, target)
+        factory = request._channel_factory
+        self.send_audio(request, 0.5)
+        request.do_request()
+        channel = factory.make_channel()
+
+        # Right after warm_up(), gRPC is still polling the channel.
+        request.warm_up()
+        factory.reset_channel()
+        factory._closer.join()
+        # gRPC would notice the closed channel on its next poll.
+        time.sleep(0.5)
+        self.assertEqual(self.thread_errors, [])
+
+        self.assertIsNot(factory.make_channel(), channel)
+        self.send_audio(request, 0.5)
+        self.assertEqual(request.do_request().transcript, 'hello')
+        self.assertEqual(server.stats['connections'], 2)
+
+
+class TestAssistantSpeechRequest(SpeechTestCase):
+
+    def test_returns_transcript_and_audio(self):
+        _, target = self.start_server(fake_speech_server.Script(
+            'what time is it', response_audio_s=0.5, follow_on=True))
+        request = speech.AssistantSpeechRequest(None, target)
+        chunks = []
+        request.set_audio_out_cb(chunks.append)
+        self.send_audio(request, 1)
+        result = request.do_request()
+        self.assertEqual(result.transcript, 'what time is it')
+        self.assertEqual(len(result.response_audio), 16000)
+        self.assertEqual(b''.join(chunks), result.response_audio)
+        self.assertTrue(request.dialog_follow_on)
+
+
+class TestHedgedSpeechRequest(SpeechTestCase):
+
+    def make_request(self, cloud_script, assistant_script):
+        _, target = self.start_server(cloud_script, assistant_scripts=[assistant_script])
+        request = speech.HedgedSpeechRequest(
+            speech.CloudSpeechRequest(None, target),
+            speech.AssistantSpeechRequest(None, target))
+        request.set_local_command_matcher(lambda transcript: 'light' in transcript)
+        return request
+
+    def test_local_command_from_faster_backend_wins(self):
+        request = self.make_request(
+            fake_speech_server.Script('turn on the light'),
+            fake_speech_server.Script('turn on the light', latency_s=2,
+                                      response_audio_s=1))
+        self.send_audio(request, 1)
+        start = time.monotonic()
+        result = request.do_request()
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(result, ('turn on the light', None))
+        self.assertEqual(request.get_hedge_stats()['cloud']['wins'], 1)
+
+    def test_win_before_endpoint_ends_utterance(self):
+        request = self.make_request(fake_speech_server.Script(), fake_speech_server.Script())
+        endpoints = []
+        request.set_endpointer_cb(lambda: endpoints.append(time.monotonic()))
+        request.reset()
+        request.add_data(AUDIO_CHUNK)
+
+        # A final transcript that arrives before either server endpoints.
+        win = threading.Timer(0.5, request._on_transcript, ('cloud', 'turn on the light'))
+        win.start()
+        self.addCleanup(win.join)
+        self.assertEqual(request.do_request(), ('turn on the light', None))
+
+        # The caller stops recording, and it isn't mistaken for a local endpoint.
+        self.assertEqual(len(endpoints), 1)
+        self.assertIn('hedge', request.endpoint_times)
+        self.assertNotIn('local', request.endpoint_times)
+
+    def test_falls_back_to_assistant_response(self):
+        request = self.make_request(
+            fake_speech_server.Script('what time is it'),
+            fake_speech_server.Script('what time is it', response_audio_s=0.5))
+        self.send_audio(request, 1)
+        result = request.do_request()
+        self.assertEqual(result.transcript, 'what time is it')
+        self.assertEqual(len(result.response_audio), 16000)
+        self.assertEqual(request.get_hedge_stats()['assistant']['response_wins'], 1)
+
+    def test_uses_cloud_transcript_if_assistant_fails(self):
+        request = self.make_request(
+            fake_speech_server.Script('what time is it'),
+            fake_speech_server.Script(error='INVALID_ARGUMENT'))
+        self.send_audio(request, 1)
+        self.assertEqual(request.do_request().transcript, 'what time is it')
+
+
+if __name__ == '__main__':
+    unittest.main()
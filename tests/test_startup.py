@@ -0,0 +1,289 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test that main.py starts quickly: without loading modules it doesn't need
+yet, and with the phases of startup running concurrently.'''
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import types
+import unittest
+
+import startup
+
+SRC_DIR = os.path.realpath(os.path.join(__file__, '..', '..', 'src'))
+
+# Importing main.py must take less than this. It takes about 50 ms on a laptop,
+# so this leaves room for a slow machine, but not for grpc or numpy.
+IMPORT_BUDGET_S = 1.0
+
+# main() must be ready for a command in less than this, with fake audio and
+# devices, and a speech server that isn't there. It takes about 0.6 s on a
+# laptop, mostly loading grpc to connect to the server, so this only catches
+# startup waiting for something it shouldn't, not small slowdowns.
+READY_BUDGET_S = 10.0
+
+# Only loaded once the code that uses them runs.
+LAZY_MODULES = ['grpc', 'google.auth', 'google_auth_oauthlib', 'google.protobuf',
+                'phue', 'pychromecast', 'peewee', 'numpy', 'wemo_backend']
+
+IMPORT_MAIN = '''
+import builtins, json, sys, time, types
+original_import = builtins.__import__
+start = time.perf_counter()
+try:
+    import main
+except ImportError as e:
+    print(json.dumps({'error': str(e)}))
+    sys.exit()
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'loaded': [name for name, module in sys.modules.items()
+               if type(module) is types.ModuleType],
+    'imports_timed': builtins.__import__ is not original_import,
+}))
+'''
+
+RUN_MAIN = '''
+import json, sys, threading, time
+from unittest import mock
+try:
+    import main
+except ImportError as e:
+    print(json.dumps({'error': str(e)}))
+    sys.exit()
+import startup
+
+
+class Trigger(object):
+
+    def __init__(self, recorder):
+        pass
+
+    def set_callback(self, callback):
+        pass
+
+    def start(self):
+        pass
+
+
+real_sleep = time.sleep
+
+
+def sleep(seconds):
+    # Stop main() waiting for Ctrl+C once it is ready.
+    if threading.current_thread() is threading.main_thread():
+        raise KeyboardInterrupt
+    real_sleep(seconds)
+
+
+sys.argv = ['main.py', '--trigger', 'clap', '--speech-api-target', 'localhost:1']
+# Nothing may reach the network: the Chromecast isn't looked for, and the
+# modules for the other devices can't be imported.
+devices = {'pychromecast': None, 'phue': None, 'wemo_backend': None}
+with mock.patch('aiy.audio.get_player'), mock.patch('aiy.audio.get_recorder'), \\
+        mock.patch('aiy.audio.set_audio_source'), \\
+        mock.patch('triggers.clap.ClapTrigger', Trigger), mock.patch('time.sleep', sleep), \\
+        mock.patch('action_MY.CastDevice.start_discovery'), \\
+        mock.patch.dict(sys.modules, devices):
+    try:
+        main.main()
+    except KeyboardInterrupt:
+        pass
+print(json.dumps({
+    'ready_s': startup.PROFILE.ready_s,
+    'phases': [phase[0] for phase in startup.PROFILE.phases],
+}))
+'''
+
+
+def run_in_src(script):
+    """Runs script in a new interpreter, and returns the JSON it printed."""
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    process = subprocess.run([sys.executable, '-c', script], env=env, cwd=SRC_DIR,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode:
+        raise AssertionError(process.stderr.decode('utf-8'))
+    return json.loads(process.stdout.decode('utf-8').splitlines()[-1])
+
+
+class TestMainImports(unittest.TestCase):
+
+    def setUp(self):
+        self.result = run_in_src(IMPORT_MAIN)
+        if 'error' in self.result:
+            self.skipTest("can't import main: %s" % self.result['error'])
+
+    def test_slow_modules_are_not_loaded(self):
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, self.result['loaded'])
+
+    def test_within_budget(self):
+        self.assertLess(self.result['seconds'], IMPORT_BUDGET_S)
+
+    def test_imports_are_only_timed_for_profile(self):
+        self.assertFalse(self.result['imports_timed'])
+
+
+class TestMainStartup(unittest.TestCase):
+
+    def test_ready_within_budget(self):
+        result = run_in_src(RUN_MAIN)
+        if 'error' in result:
+            self.skipTest("can't import main: %s" % result['error'])
+        self.assertIsNotNone(result['ready_s'])
+        self.assertLess(result['ready_s'], READY_BUDGET_S)
+        self.assertIn('recognizer', result['phases'])
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def test_loads_on_first_use(self):
+        sys.modules.pop('colorsys', None)
+        self.addCleanup(sys.modules.pop, 'colorsys', None)
+
+        colorsys = startup.lazy_import('colorsys')
+        self.assertIsNot(type(colorsys), types.ModuleType)
+        self.assertEqual(colorsys.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+        self.assertIs(type(colorsys), types.ModuleType)
+
+    def test_returns_loaded_module(self):
+        self.assertIs(startup.lazy_import('json'), json)
+
+    def test_missing_module(self):
+        with self.assertRaises(ImportError):
+            startup.lazy_import('no_such_module_here')
+
+
+class TestStartupProfile(unittest.TestCase):
+
+    def test_report(self):
+        profile = startup.StartupProfile()
+        profile.start_import_timing()
+        self.addCleanup(profile.stop_import_timing)
+        sys.modules.pop('colorsys', None)
+        self.addCleanup(sys.modules.pop, 'colorsys', None)
+        with profile.phase('actor'):
+            import colorsys  # noqa
+        self.assertTrue(profile.ready())
+        self.assertFalse(profile.ready())
+
+        self.assertEqual([phase[0] for phase in profile.phases], ['actor'])
+        self.assertIn('colorsys', [name for name, _, _, _ in profile.imports])
+        report = profile.report()
+        self.assertIn('ready after', report)
+        self.assertIn('actor', report)
+        self.assertIn('colorsys', report)
+
+    def test_times_imports_on_phase_threads(self):
+        profile = startup.StartupProfile()
+        profile.start_import_timing()
+        self.addCleanup(profile.stop_import_timing)
+        sys.modules.pop('colorsys', None)
+        self.addCleanup(sys.modules.pop, 'colorsys', None)
+
+        def load():
+            import colorsys  # noqa
+        phases = startup.Startup(profile)
+        phases.add('actor', load)
+        phases.result('actor', timeout=5)
+
+        self.assertIn(('colorsys', 0, 'startup actor'),
+                      [(name, depth, thread) for name, _, depth, thread in profile.imports])
+        self.assertIn('startup actor', profile.report())
+
+    def test_names_relative_imports(self):
+        profile = startup.StartupProfile()
+        profile.start_import_timing()
+        self.addCleanup(profile.stop_import_timing)
+        sys.modules.pop('json.tool', None)
+        self.addCleanup(sys.modules.pop, 'json.tool', None)
+        exec('from . import tool', {'__package__': 'json', '__name__': 'json.x'})
+        self.assertIn('json.tool', [name for name, _, _, _ in profile.imports])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_independent_phases_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        phases = startup.Startup(startup.StartupProfile())
+        phases.add('credentials', lambda: barrier.wait() is not None)
+        phases.add('recorder', lambda: barrier.wait() is not None)
+        self.assertTrue(phases.result('credentials', timeout=5))
+        self.assertTrue(phases.result('recorder', timeout=5))
+
+    def test_gets_results_of_required_phases(self):
+        profile = startup.StartupProfile()
+        phases = startup.Startup(profile)
+        phases.add('credentials', lambda: 'token')
+        phases.add('recorder', lambda: 'mic')
+        phases.add('recognizer', lambda *args: args, requires=['credentials', 'recorder'])
+        self.assertEqual(phases.result('recognizer', timeout=5), ('token', 'mic'))
+        self.assertEqual(sorted(phase[0] for phase in profile.phases),
+                         ['credentials', 'recognizer', 'recorder'])
+
+    def test_error_is_raised_by_result_and_dependents(self):
+        phases = startup.Startup(startup.StartupProfile())
+        phases.add('credentials', lambda: sys.exit(1))
+        phases.add('recognizer', lambda credentials: self.fail('ran'),
+                   requires=['credentials'])
+        with self.assertRaises(SystemExit):
+            phases.result('recognizer', timeout=5)
+        with self.assertRaises(SystemExit):
+            phases.result('credentials', timeout=5)
+
+    def test_times_out(self):
+        event = threading.Event()
+        self.addCleanup(event.set)
+        phases = startup.Startup(startup.StartupProfile())
+        phases.add('trigger', event.wait)
+        with self.assertRaises(TimeoutError):
+            phases.result('trigger', timeout=0.01)
+
+    def test_optional_phase_is_attached_when_done(self):
+        loaded = threading.Event()
+        attached = []
+        was_attached = threading.Event()
+
+        def attach(value):
+            attached.append(value)
+            was_attached.set()
+
+        phases = startup.Startup(startup.StartupProfile())
+        phases.add('keyword spotter', lambda: loaded.wait() and 'spotter', optional=True)
+        phases.when_done('keyword spotter', attach)
+        self.assertEqual(attached, [])
+        loaded.set()
+        # The callback runs on the phase's thread.
+        self.assertTrue(was_attached.wait(5))
+        self.assertEqual(attached, ['spotter'])
+
+        # Once done, it runs straight away.
+        phases.when_done('keyword spotter', attach)
+        self.assertEqual(attached, ['spotter', 'spotter'])
+
+    def test_failed_optional_phase_is_not_attached(self):
+        phases = startup.Startup(startup.StartupProfile())
+        with self.assertLogs('startup', 'ERROR'):
+            phases.add('keyword spotter', lambda: 1 / 0, optional=True)
+            with self.assertRaises(ZeroDivisionError):
+                phases.result('keyword spotter', timeout=5)
+        phases.when_done('keyword spotter', self.fail)
+
+
+if __name__ == '__main__':
+    unittest.main()
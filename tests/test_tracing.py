@@ -0,0 +1,108 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the action timing histograms and trace.'''
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import actionbase
+import tracing
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles_within_bucket(self):
+        histogram = tracing.Histogram()
+        for duration_ms in range(1, 101):
+            histogram.add(duration_ms)
+        stats = histogram.as_dict()
+        self.assertEqual(stats['count'], 100)
+        self.assertAlmostEqual(stats['mean_ms'], 50.5)
+        self.assertTrue(50 <= stats['p50_ms'] <= 100)
+        self.assertTrue(90 <= stats['p90_ms'] <= 100)
+        self.assertEqual(stats['max_ms'], 100)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = tracing.Registry()
+        fd, self.trace_path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, self.trace_path)
+        self.registry.set_trace_file(self.trace_path)
+        self.addCleanup(self.registry.set_trace_file, None)
+
+    def read_trace(self):
+        with open(self.trace_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_nested_spans(self):
+        with self.registry.span('action', keyword='turn on') as parent:
+            with self.registry.span('wemo', device='Table', op='on'):
+                pass
+        stats = self.registry.get_stats()
+        self.assertEqual(stats['action{keyword=turn on}']['count'], 1)
+        self.assertEqual(stats['wemo{device=Table,op=on}']['outcomes'], {'ok': 1})
+
+        child, parent_event = self.read_trace()
+        self.assertEqual(child['parent_id'], parent.span_id)
+        self.assertEqual(child['trace_id'], parent_event['trace_id'])
+        self.assertIsNone(parent_event['parent_id'])
+
+    def test_parent_on_another_thread(self):
+        with self.registry.span('request') as parent:
+            thread = threading.Thread(target=self.child_span, args=(parent,))
+            thread.start()
+            thread.join()
+        child = self.read_trace()[0]
+        self.assertEqual(child['name'], 'child')
+        self.assertEqual(child['parent_id'], parent.span_id)
+
+    def child_span(self, parent):
+        with self.registry.span('child', parent):
+            pass
+
+    def test_records_exception_outcome(self):
+        with self.assertRaises(ValueError):
+            with self.registry.span('action'):
+                raise ValueError()
+        self.assertEqual(self.registry.get_stats()['action']['outcomes'], {'ValueError': 1})
+        self.assertEqual(self.read_trace()[0]['outcome'], 'ValueError')
+
+
+class TestActorTiming(unittest.TestCase):
+
+    class Action(object):
+
+        def run(self, voice_command):
+            pass
+
+    def test_records_match_and_run(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('timing test', self.Action())
+        before = tracing.get_registry().get_stats()
+        actor.handle('a timing test')
+        stats = tracing.get_registry().get_stats()
+        for key in ('match{keyword=timing test}', 'action{keyword=timing test}'):
+            count = before[key]['count'] if key in before else 0
+            self.assertEqual(stats[key]['count'], count + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
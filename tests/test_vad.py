@@ -0,0 +1,155 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the local voice activity detection.'''
+
+import unittest
+
+import numpy as np
+
+import vad
+
+RATE = 16000
+CHUNK = 1600
+
+
+def noise(seconds, level=300, seed=0):
+    rand = np.random.RandomState(seed)
+    return (rand.randn(int(seconds * RATE)) * level).astype(np.int16)
+
+
+def voiced(seconds, freq=180.0, level=8000):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (level * np.sin(2 * np.pi * freq * t)).astype(np.int16)
+
+
+def chunks(samples):
+    data = samples.tobytes()
+    return [data[i:i + 2 * CHUNK] for i in range(0, len(data), 2 * CHUNK)]
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.ended = 0
+        self.endpoint_times = {}
+
+    def end_of_speech(self):
+        self.ended += 1
+
+
+class TestVoiceActivityDetector(unittest.TestCase):
+
+    def test_speech_and_silence(self):
+        detector = vad.VoiceActivityDetector()
+        self.assertFalse(detector.classify(noise(0.5).tobytes()).any())
+        self.assertTrue(detector.classify(voiced(0.5).tobytes()).all())
+        self.assertFalse(detector.classify(noise(0.5, seed=1).tobytes()).any())
+
+    def test_partial_frames_are_kept(self):
+        detector = vad.VoiceActivityDetector()
+        data = voiced(0.1).tobytes()
+        self.assertEqual(len(detector.classify(data[:250])), 0)
+        self.assertEqual(len(detector.classify(data[250:])), 10)
+
+    def test_bad_aggressiveness(self):
+        with self.assertRaises(ValueError):
+            vad.VoiceActivityDetector(aggressiveness=4)
+
+
+class TestLocalEndpointer(unittest.TestCase):
+
+    def feed(self, endpointer, samples):
+        for chunk in chunks(samples):
+            endpointer.add_data(memoryview(chunk))
+
+    def test_fires_after_hangover(self):
+        request = FakeRequest()
+        endpointer = vad.LocalEndpointer(request, hangover_s=0.5)
+        self.feed(endpointer, np.concatenate((noise(0.5), voiced(1.0), noise(0.4))))
+        self.assertEqual(request.ended, 0)
+        self.feed(endpointer, noise(0.2, seed=1))
+        self.assertEqual(request.ended, 1)
+
+    def test_fires_once(self):
+        request = FakeRequest()
+        endpointer = vad.LocalEndpointer(request, hangover_s=0.3)
+        self.feed(endpointer, np.concatenate((voiced(0.5), noise(1.0), voiced(0.5), noise(1.0))))
+        self.assertEqual(request.ended, 1)
+
+    def test_silence_only_does_not_fire(self):
+        request = FakeRequest()
+        endpointer = vad.LocalEndpointer(request)
+        self.feed(endpointer, noise(3.0))
+        self.assertEqual(request.ended, 0)
+
+    def test_shadow_mode_only_records(self):
+        request = FakeRequest()
+        endpointer = vad.LocalEndpointer(request, hangover_s=0.3, shadow=True)
+        self.feed(endpointer, np.concatenate((voiced(0.5), noise(1.0))))
+        self.assertEqual(request.ended, 0)
+        self.assertIsNotNone(endpointer.fired_at)
+
+        request.endpoint_times['server'] = endpointer.fired_at + 0.25
+        endpointer.request_finished()
+        stats = endpointer.get_stats()
+        self.assertEqual(stats['compared'], 1)
+        self.assertAlmostEqual(stats['mean_lead_ms'], 250)
+
+    def test_reset_rearms(self):
+        request = FakeRequest()
+        endpointer = vad.LocalEndpointer(request, hangover_s=0.3)
+        self.feed(endpointer, np.concatenate((voiced(0.5), noise(1.0))))
+        endpointer.reset()
+        self.feed(endpointer, np.concatenate((voiced(0.5), noise(1.0))))
+        self.assertEqual(request.ended, 2)
+
+
+class TestLeadingSilenceTrimmer(unittest.TestCase):
+
+    def run_trimmer(self, trimmer, samples):
+        sent = []
+        for chunk in chunks(samples):
+            sent.extend(trimmer.process(chunk))
+        trimmer.finish()
+        return b''.join(sent)
+
+    def test_trims_silence_before_speech(self):
+        trimmer = vad.LeadingSilenceTrimmer(lead_in_s=0.2)
+        silence = noise(1.0)
+        speech = voiced(0.5)
+        sent = self.run_trimmer(trimmer, np.concatenate((silence, speech)))
+        self.assertEqual(sent, silence[-int(0.2 * RATE):].tobytes() + speech.tobytes())
+        self.assertAlmostEqual(trimmer.get_stats()['last_trimmed_s'], 0.8)
+
+    def test_passes_audio_after_onset(self):
+        trimmer = vad.LeadingSilenceTrimmer(lead_in_s=0.0)
+        samples = np.concatenate((voiced(0.5), noise(1.0)))
+        self.assertEqual(self.run_trimmer(trimmer, samples), samples.tobytes())
+
+    def test_gives_up_after_max_hold(self):
+        trimmer = vad.LeadingSilenceTrimmer(lead_in_s=0.1, max_hold_s=1.0)
+        samples = noise(2.0)
+        sent = self.run_trimmer(trimmer, samples)
+        # Gives up on the chunk after 1.0 s, and keeps 0.1 s of lead-in.
+        self.assertEqual(sent, samples[int(0.9 * RATE):].tobytes())
+
+    def test_all_silence_sends_nothing(self):
+        trimmer = vad.LeadingSilenceTrimmer(max_hold_s=5.0)
+        self.assertEqual(self.run_trimmer(trimmer, noise(1.0)), b'')
+        self.assertAlmostEqual(trimmer.get_stats()['total_trimmed_s'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()